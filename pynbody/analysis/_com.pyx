@@ -1,6 +1,7 @@
 cimport numpy as np
 cimport cython
 from cython.parallel import prange
+from libc.math cimport INFINITY, NAN
 import numpy as np
 
 import logging
@@ -144,3 +145,104 @@ def move_sphere_center(np.ndarray[np.float64_t, ndim=2] pos,
             raise RuntimeError, "shrink_sphere_center failed to converge after %d iterations"%itermax
 
     return com_x
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+cdef int _shrink_sphere_center_one(double[:,:] pos, double[:] mass, Py_ssize_t start, Py_ssize_t stop,
+                                   int min_particles, double shrink_factor, double starting_rmax,
+                                   int itermax, double[:,:] result, Py_ssize_t h) nogil except -1:
+    """Shrinking-sphere centre of particles start:stop, written into result[h]. Returns 1 if the iteration
+    fails to converge.
+
+    This follows the same iteration as shrink_sphere_center, but the radii and masses are accumulated in
+    double rather than single precision, so the centres can differ from it at the level of float rounding."""
+    cdef Py_ssize_t i
+    cdef Py_ssize_t npart = stop-start
+    cdef double cx=0, cy=0, cz=0
+    cdef double offset_x, offset_y, offset_z, tot_mass
+    cdef double pix, piy, piz, mi
+    cdef double current_rmax = INFINITY, current_rmax2
+    cdef int iternum = 0
+
+    if npart==0:
+        result[h,0] = NAN; result[h,1] = NAN; result[h,2] = NAN
+        return 0
+
+    # initial rough centre is the unweighted mean position
+    for i in range(start, stop):
+        cx+=pos[i,0]; cy+=pos[i,1]; cz+=pos[i,2]
+    cx/=npart; cy/=npart; cz/=npart
+
+    while npart>min_particles :
+        offset_x=0; offset_y=0; offset_z=0; tot_mass=0
+        current_rmax2 = current_rmax*current_rmax
+        npart = 0
+        for i in range(start, stop):
+            pix=pos[i,0]-cx; piy=pos[i,1]-cy; piz=pos[i,2]-cz
+            if pix*pix+piy*piy+piz*piz<current_rmax2 :
+                mi = mass[i]
+                offset_x+=pix*mi
+                offset_y+=piy*mi
+                offset_z+=piz*mi
+                tot_mass+=mi
+                npart+=1
+
+        if npart==0:
+            break
+
+        cx+=offset_x/tot_mass; cy+=offset_y/tot_mass; cz+=offset_z/tot_mass
+
+        iternum+=1
+        if iternum>1 :
+            current_rmax*=shrink_factor
+        else :
+            current_rmax = starting_rmax
+
+        if iternum>itermax:
+            return 1
+
+    result[h,0] = cx; result[h,1] = cy; result[h,2] = cz
+    return 0
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def shrink_sphere_center_batch(np.ndarray[np.float64_t, ndim=2] pos,
+                               np.ndarray[np.float64_t, ndim=1] mass,
+                               np.ndarray[np.int64_t, ndim=1] offsets,
+                               int min_particles,
+                               float shrink_factor,
+                               np.ndarray[np.float64_t, ndim=1] starting_rmax,
+                               int num_threads,
+                               int itermax=1000) :
+    """Find the shrinking-sphere centres of many groups of particles at once.
+
+    The particles must be sorted by group, so that group h consists of particles offsets[h]:offsets[h+1].
+    Groups are distributed between threads; each one is processed with the same iteration as
+    shrink_sphere_center would apply to it alone (though in double precision throughout). Returns an
+    (ngroups, 3) array of centres (NaN for empty groups)."""
+
+    cdef Py_ssize_t ngroups = len(offsets)-1
+    cdef Py_ssize_t h
+    cdef np.ndarray[np.float64_t, ndim=2] result = np.empty((ngroups, 3))
+    cdef np.ndarray[np.int32_t, ndim=1] failed = np.zeros(ngroups, dtype=np.int32)
+
+    cdef double[:,:] pos_view = pos
+    cdef double[:] mass_view = mass
+    cdef double[:,:] result_view = result
+    cdef long long[:] offsets_view = offsets
+    cdef double[:] rmax_view = starting_rmax
+    cdef int[:] failed_view = failed
+
+    with nogil:
+        for h in prange(ngroups, schedule='dynamic', num_threads=num_threads):
+            failed_view[h] = _shrink_sphere_center_one(pos_view, mass_view, offsets_view[h], offsets_view[h+1],
+                                                       min_particles, shrink_factor, rmax_view[h], itermax,
+                                                       result_view, h)
+
+    if failed.any():
+        raise RuntimeError("shrink_sphere_center failed to converge after %d iterations"%itermax)
+
+    return result
@@ -81,6 +81,7 @@ def decomp(h, aligned=False, j_disk_min=0.8, j_disk_max=1.1, E_cut=None, j_circ_
         angmom.faceon(h, cen=cen, vcen=vcen, disk_size=angmom_size)
 
     # Find KE, PE and TE
+    # (if the snapshot stores no potential, it is calculated for the whole snapshot; see pynbody.gravity)
     ke = h['ke']
     pe = h['phi']
 
@@ -102,6 +102,101 @@ def shrink_sphere_center(sim, r=None, shrink_factor=0.7, min_particles=100, verb
     return array.SimArray(com, sim['pos'].units)
 
 
+def _reference_density(sim, rho_def):
+    if rho_def == 'matter':
+        return sim.properties["omegaM0"] * cosmology.rho_crit(sim, z=0) * (1.0 + sim.properties["z"]) ** 3
+    elif rho_def == 'critical':
+        return cosmology.rho_crit(sim, z=sim.properties["z"])
+    else:
+        raise ValueError(rho_def + "is not a valid definition for the reference density")
+
+
+def _target_densities(sim, overden, rho_def):
+    """Convert an overdensity or list of overdensities into target densities.
+
+    Each overdensity is either a number, in which case it is relative to *rho_def*, or a string such
+    as '200c' or '200m' specifying the overdensity relative to the critical or matter density respectively."""
+    scalar = np.ndim(overden) == 0
+    targets = []
+    for o in np.atleast_1d(np.asarray(overden, dtype=object)):
+        this_rho_def = rho_def
+        if isinstance(o, str):
+            suffixes = {'c': 'critical', 'm': 'matter'}
+            if o[-1] in suffixes:
+                this_rho_def = suffixes[o[-1]]
+                o = o[:-1]
+            o = float(o)
+        targets.append(o * _reference_density(sim, this_rho_def))
+    return np.array(targets, dtype=float), scalar
+
+
+def _overdensity_radii(r, mass, offsets, targets, r_max):
+    """Find where the mean enclosed density crosses each target density, for each segment of particles.
+
+    Within each segment offsets[i]:offsets[i+1], *r* must be sorted in ascending order. Between consecutive
+    particles the enclosed mass is constant, so the crossing radius follows directly from the cumulative
+    mass; the outermost crossing is returned, limited to r_max[i]. Returns an array of shape
+    (nsegments, ntargets), NaN for empty segments."""
+
+    nseg = len(offsets) - 1
+    lengths = np.diff(offsets)
+    nonempty = lengths > 0
+    starts = offsets[:-1][nonempty]
+    result = np.empty((nseg, len(targets)))
+    result[:] = np.nan
+    if len(r) == 0:
+        return result
+
+    cumulative_mass = np.cumsum(mass)
+    segment_start_mass = np.concatenate(([0], cumulative_mass))[offsets[:-1]]
+    cumulative_mass -= np.repeat(segment_start_mass, lengths)
+
+    index = np.arange(len(r))
+    for j, target in enumerate(targets):
+        # radius at which the mass enclosed out to (and including) each particle has the target mean density
+        r_cross = np.cbrt(3 * cumulative_mass / (4 * math.pi * target))
+        # the outermost particle beyond which the density first drops below the target
+        last = np.maximum.reduceat(np.where(r_cross > r, index, -1), starts)
+        radii = np.where(last >= 0, r_cross[np.maximum(last, 0)], 0.0)
+        result[nonempty, j] = np.minimum(radii, r_max[nonempty])
+
+    return result
+
+
+def _overdensity_radius_unsorted(r, mass, target, r_max, nbins=1000):
+    """Find the outermost radius at which the mean enclosed density crosses target, without sorting all particles.
+
+    The particles are first binned radially, which brackets the crossing between a few bins; only the particles
+    in those bins are then sorted. The result is identical to that of _overdensity_radii applied to the fully
+    sorted particles."""
+    if len(r) == 0:
+        return np.nan
+    bin_index = np.minimum((r * (nbins / r_max)).astype(np.intp), nbins - 1)
+    mass_per_bin = np.bincount(bin_index, weights=mass, minlength=nbins)
+    mass_below = np.concatenate(([0], np.cumsum(mass_per_bin)))
+    edges = np.arange(nbins + 1) * (r_max / nbins)
+    r_cross_edges = np.cbrt(3 * mass_below[1:] / (4 * math.pi * target))
+
+    # a crossing within a bin is only possible if the density including the whole bin exceeds the target at its
+    # inner edge, and is certain if the bin is occupied and the density exceeds the target at its outer edge
+    possible = np.where(r_cross_edges > edges[:-1])[0]
+    if len(possible) == 0:
+        return 0.0
+    occupied = np.bincount(bin_index, minlength=nbins) > 0
+    certain = np.where((r_cross_edges >= edges[1:]) & occupied)[0]
+    first_bin = certain[-1] if len(certain) > 0 else 0
+    last_bin = possible[-1]
+
+    in_range = np.where((bin_index >= first_bin) & (bin_index <= last_bin))[0]
+    order = np.argsort(r[in_range])
+    r_sorted = r[in_range][order]
+    r_cross = np.cbrt(3 * (mass_below[first_bin] + np.cumsum(mass[in_range][order])) / (4 * math.pi * target))
+    crossing = np.where(r_cross > r_sorted)[0]
+    if len(crossing) == 0:
+        return 0.0
+    return min(r_cross[crossing[-1]], r_max)
+
+
 def virial_radius(sim, cen=None, overden=178, r_max=None, rho_def='matter'):
     """Calculate the virial radius of the halo centered on the given
     coordinates.
@@ -109,6 +204,9 @@ def virial_radius(sim, cen=None, overden=178, r_max=None, rho_def='matter'):
     The default is here defined by the sphere centered on cen which contains a
     mean density of overden * rho_M_0 * (1+z)^3.
 
+    The radius is read off the cumulative mass profile rather than found by repeated scans over
+    the particles, so several overdensities can be found at little extra cost.
+
     **Input**:
 
     *sim* : a simulation snapshot - this can be any subclass of SimSnap, especially a halo.
@@ -120,7 +218,9 @@ def virial_radius(sim, cen=None, overden=178, r_max=None, rho_def='matter'):
     *rmax (default=None): Maximum radius to start the search. If None, inferred from the halo particle positions.
 
     *overden (default=178): Overdensity corresponding to the required halo boundary definition.
-    178 is the virial criterion for spherical collapse in an EdS Universe. Common possible values are 200, 500 etc
+    178 is the virial criterion for spherical collapse in an EdS Universe. Common possible values are 200, 500 etc.
+    A string such as '200c' or '500m' gives the overdensity relative to the critical or matter density, overriding
+    *rho_def*. A list of overdensities can be passed, in which case an array of radii is returned.
 
     *rho_def (default='matter'): Physical density used to define the overdensity. Default is the matter density at
     the redshift of the simulation. An other choice is "critical" for the critical density at this redshift.
@@ -135,47 +235,33 @@ def virial_radius(sim, cen=None, overden=178, r_max=None, rho_def='matter'):
         else:
             sim = sim[filt.Sphere(r_max)]
 
-    r_min = 0.0
-
     if cen is not None:
         tx = transformation.inverse_translate(sim, cen)
     else:
         tx = transformation.null(sim)
 
-    if rho_def == 'matter':
-       ref_density = sim.properties["omegaM0"] * cosmology.rho_crit(sim, z=0) * (1.0 + sim.properties["z"]) ** 3
-    elif rho_def == 'critical':
-        ref_density = cosmology.rho_crit(sim, z=sim.properties["z"])
-    else:
-        raise ValueError(rho_def + "is not a valid definition for the reference density")
-
-    target_rho = overden * ref_density
+    target_rho, scalar = _target_densities(sim, overden, rho_def)
     logger.info("target_rho=%s", target_rho)
 
     with tx:
         sim = sim[filt.Sphere(r_max)]
         with sim.immediate_mode:
-            mass_ar = np.asarray(sim['mass'])
-            r_ar = np.asarray(sim['r'])
-
-        """
-        #pure numpy implementation
-        rho = lambda r: np.dot(
-            mass_ar, r_ar < r) / (4. * math.pi * (r ** 3) / 3)
-
-        #numexpr alternative - not much faster because sum is not threaded
-        def rho(r) :
-            r_ar; mass_ar; # just to get these into the local namespace
-            return ne.evaluate("sum((r_ar<r)*mass_ar)")/(4.*math.pi*(r**3)/3)
-        """
-        rho = lambda r: util.sum_if_lt(mass_ar,r_ar,r)/(4. * math.pi * (r ** 3) / 3)
-        result = util.bisect(r_min, r_max, lambda r: target_rho -
-                             rho(r), epsilon=0, eta=1.e-3 * target_rho, verbose=False)
+            mass_ar = np.asarray(sim['mass'], dtype=float)
+            r_ar = np.asarray(sim['r'], dtype=float)
 
-    return result
+    result = np.array([_overdensity_radius_unsorted(r_ar, mass_ar, target, float(r_max)) for target in target_rho])
+
+    if scalar:
+        return result[0]
+    else:
+        return result
 
 
 def potential_minimum(sim):
+    """Return the position of the particle in sim with the lowest potential.
+
+    If the snapshot does not store a potential, it is calculated for the whole ancestor snapshot (see
+    pynbody.gravity)."""
     i = sim["phi"].argmin()
     return sim["pos"][i].copy()
 
@@ -267,7 +353,8 @@ def center(sim, mode=None, retcen=False, vel=True, cen_size="1 kpc", move_all=Tr
 
     Accepted values for *mode* are
 
-      *pot*: potential minimum
+      *pot*: potential minimum (if the snapshot has no stored potential, this calculates the
+             potential of the whole ancestor snapshot; see pynbody.gravity)
 
       *com*: center of mass
 
@@ -333,6 +420,408 @@ def center(sim, mode=None, retcen=False, vel=True, cen_size="1 kpc", move_all=Tr
 
     return tx
 
+def _group_segments(sim, group_array=None, halo_ids=None):
+    """Sort the particles of a snapshot by group once, for the batch functions below.
+
+    *sim* may be a HaloCatalogue or a SimSnap; *group_array* is an array (or the name of an array) giving the group
+    of every particle in the snapshot. If *sim* is a catalogue and no group array is given, it is taken from
+    the catalogue's own get_group_array.
+
+    Returns (base, order, offsets, halo_ids), such that the particles of halo_ids[i] are
+    base[order[offsets[i]:offsets[i+1]]]."""
+
+    from .. import halo as halo_module
+
+    ignore = None
+    if isinstance(sim, halo_module.HaloCatalogue):
+        catalogue = sim
+        base = catalogue.base
+        ignore = getattr(catalogue, '_ignore', None)
+        if group_array is None:
+            try:
+                group_array = catalogue.get_group_array()
+            except NotImplementedError:
+                group_array = None
+            if group_array is not None and len(group_array) != len(base):
+                # group array covers only one family, so can't be used to segment the whole snapshot
+                group_array = None
+        if group_array is None:
+            # fall back to asking the catalogue for the particles in each halo
+            logger.warning("No group array covering the whole snapshot is available; building each halo "
+                           "separately, which is much slower. Pass group_array to avoid this.")
+            if halo_ids is None:
+                halo_ids = [h.properties['halo_id'] for h in catalogue]
+            halo_ids = np.asarray(halo_ids)
+            indices = [np.asarray(catalogue[i].get_index_list(base)) for i in halo_ids]
+            lengths = np.array([len(i) for i in indices], dtype=np.int64)
+            order = np.concatenate(indices).astype(np.int64) if len(indices) else np.zeros(0, dtype=np.int64)
+            offsets = np.concatenate(([0], np.cumsum(lengths)))
+            return base, order, offsets, halo_ids
+    else:
+        base = sim
+        if group_array is None:
+            raise ValueError("A group array must be specified when passing a SimSnap rather than a HaloCatalogue")
+
+    if isinstance(group_array, str):
+        group_array = base[group_array]
+
+    group_array = np.asarray(group_array)
+    if len(group_array) != len(base):
+        raise ValueError("The group array must have one entry per particle in the snapshot")
+
+    order = np.argsort(group_array, kind='mergesort')  # mergesort for stability
+    sorted_groups = group_array[order]
+
+    if halo_ids is None:
+        halo_ids = np.unique(sorted_groups)
+        halo_ids = halo_ids[halo_ids >= 0]
+        if ignore is not None:
+            halo_ids = halo_ids[halo_ids != ignore]
+    halo_ids = np.asarray(halo_ids)
+
+    starts = np.searchsorted(sorted_groups, halo_ids, side='left')
+    stops = np.searchsorted(sorted_groups, halo_ids, side='right')
+
+    # halos are returned in the order requested, so gather their particles in that order too
+    lengths = (stops - starts).astype(np.int64)
+    offsets = np.concatenate(([0], np.cumsum(lengths)))
+    if len(halo_ids) > 0 and np.all(np.diff(halo_ids) > 0) and np.all(starts[1:] == stops[:-1]):
+        order = order[starts[0]:stops[-1]]
+    else:
+        order = np.concatenate([order[a:b] for a, b in zip(starts, stops)] + [np.zeros(0, dtype=order.dtype)])
+
+    return base, order, offsets, halo_ids
+
+
+def _segment_reduce(values, offsets):
+    """Sum values over each segment offsets[i]:offsets[i+1], allowing empty segments"""
+    nonempty = offsets[1:] > offsets[:-1]
+    result = np.zeros((len(offsets) - 1,) + values.shape[1:], dtype=values.dtype)
+    if nonempty.any():
+        result[nonempty] = np.add.reduceat(values, offsets[:-1][nonempty], axis=0)
+    return result
+
+
+def batch_center(sim, mode='ssc', group_array=None, halo_ids=None, r=None, shrink_factor=0.7, min_particles=100,
+                 num_threads=config['number_of_threads']):
+    """
+
+    Return the centres of all halos in a catalogue, computed in a single pass over the
+    snapshot rather than one halo at a time.
+
+    The particles are sorted by halo once, and positions and masses are extracted once;
+    no per-halo SimSnap is constructed. Shrinking-sphere centres are found by
+    distributing the halos between threads. If no group array covering the whole
+    snapshot is available, the particles of each halo are instead taken from the
+    catalogue one halo at a time, which is much slower; a warning is logged.
+
+    **Input**:
+
+    *sim* : a HaloCatalogue, or a SimSnap together with a *group_array*
+
+    **Optional Keywords**:
+
+    *mode* (default='ssc'): one of 'ssc' (shrink sphere center), 'com' (center of mass)
+     or 'pot' (potential minimum, calculated for the whole snapshot if it stores no potential)
+
+    *group_array* (default=None): an array, or the name of an array, assigning each particle
+     of the snapshot to a halo. If *sim* is a catalogue, this defaults to its get_group_array().
+     Note that group arrays assign particles to the lowest level of the hierarchy, so parent
+     halos do not include their subhalos' particles.
+
+    *halo_ids* (default=None): the halos for which centres should be returned. By default,
+     all non-negative group numbers present in the group array.
+
+    *r* (default=None): initial search radius for the 'ssc' mode; either a single value (which
+     can be a string or unit) or an array of values, one per halo. By default half the extent
+     of each halo in x, as in :func:`shrink_sphere_center`.
+
+    *shrink_factor*, *min_particles*: as for :func:`shrink_sphere_center`
+
+    *num_threads* (config['number_of_threads']): The number of threads to use
+
+    **Returns**:
+
+    An (Nhalo, 3) SimArray of centres, in the order of *halo_ids*. Halos with no
+    particles have a NaN centre.
+
+    """
+
+    base, order, offsets, halo_ids = _group_segments(sim, group_array, halo_ids)
+    return _batch_center_segments(base, order, offsets, mode, r, shrink_factor, min_particles, num_threads)
+
+
+def _batch_center_segments(base, order, offsets, mode, r, shrink_factor, min_particles, num_threads):
+    """Calculate centres for halos already segmented by _group_segments; see batch_center"""
+    pos_units = base['pos'].units
+    nhalos = len(offsets) - 1
+    lengths = np.diff(offsets)
+    nonempty = lengths > 0
+
+    pos = np.asarray(base['pos'], dtype='double')[order]
+
+    if mode == 'com':
+        mass = np.asarray(base['mass'], dtype='double')[order]
+        tot_mass = _segment_reduce(mass, offsets)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            cen = _segment_reduce(pos * mass[:, np.newaxis], offsets) / tot_mass[:, np.newaxis]
+        cen[~nonempty] = np.nan
+
+    elif mode == 'pot':
+        phi = np.asarray(base['phi'], dtype='double')[order]
+        cen = np.empty((nhalos, 3))
+        cen[:] = np.nan
+        if nonempty.any():
+            # argmin within each segment: sort on (segment, phi) and take the first entry of each segment
+            segment = np.repeat(np.arange(nhalos), lengths)
+            first = np.lexsort((phi, segment))[offsets[:-1][nonempty]]
+            cen[nonempty] = pos[first]
+
+    elif mode == 'ssc':
+        mass = np.asarray(base['mass'], dtype='double')[order]
+        if r is None:
+            x = pos[:, 0]
+            rmax = np.zeros(nhalos)
+            if nonempty.any():
+                starts = offsets[:-1][nonempty]
+                rmax[nonempty] = (np.maximum.reduceat(x, starts) - np.minimum.reduceat(x, starts)) / 2
+        else:
+            if isinstance(r, str) or issubclass(r.__class__, units.UnitBase):
+                if isinstance(r, str):
+                    r = units.Unit(r)
+                r = r.in_units(pos_units, **base.conversion_context())
+            elif isinstance(r, array.SimArray) and r.units != units.no_unit:
+                r = r.in_units(pos_units, **base.conversion_context())
+            rmax = np.array(np.broadcast_to(np.asarray(r, dtype='double'), (nhalos,)))
+
+        cen = _com.shrink_sphere_center_batch(pos, mass, np.asarray(offsets, dtype=np.int64), min_particles,
+                                              shrink_factor, rmax, num_threads)
+
+    else:
+        raise ValueError("Unknown centering mode %r; batch_center supports 'ssc', 'com' and 'pot'" % mode)
+
+    return array.SimArray(cen, pos_units)
+
+
+def batch_virial_radius(sim, cen=None, overden=178, rho_def='matter', group_array=None, halo_ids=None,
+                        num_threads=config['number_of_threads']):
+    """
+
+    Calculate the virial radii of all halos in a catalogue in a single pass over the snapshot.
+
+    Each halo's particles are sorted by radius from its centre once, and the radii for all
+    requested overdensities read off the cumulative mass profile. As with :func:`batch_center`,
+    no per-halo SimSnap is constructed. For each halo, the result is the same as calling
+    :func:`virial_radius` on the halo with its centre.
+
+    **Input**:
+
+    *sim* : a HaloCatalogue, or a SimSnap together with a *group_array*
+
+    **Optional Keywords**:
+
+    *cen* (default=None): an (Nhalo, 3) array of halo centres. If None, these are calculated with
+     :func:`batch_center`.
+
+    *overden*, *rho_def*: as for :func:`virial_radius`
+
+    *group_array*, *halo_ids*: as for :func:`batch_center`
+
+    *num_threads* (config['number_of_threads']): The number of threads to use when calculating centres
+
+    **Returns**:
+
+    An array of radii of shape (Nhalo,), or (Nhalo, Noverden) if a list of overdensities was given,
+    in the order of *halo_ids*.
+
+    """
+
+    base, order, offsets, halo_ids = _group_segments(sim, group_array, halo_ids)
+    pos_units = base['pos'].units
+
+    if cen is None:
+        cen = _batch_center_segments(base, order, offsets, 'ssc', None, 0.7, 100, num_threads)
+    elif isinstance(cen, array.SimArray) and cen.units != units.no_unit:
+        cen = cen.in_units(pos_units, **base.conversion_context())
+    cen = np.asarray(cen, dtype=float)
+    if cen.shape != (len(halo_ids), 3):
+        raise ValueError("One centre must be given for each halo")
+
+    target_rho, scalar = _target_densities(base, overden, rho_def)
+
+    lengths = np.diff(offsets)
+    nonempty = lengths > 0
+    segment = np.repeat(np.arange(len(halo_ids)), lengths)
+
+    pos = np.asarray(base['pos'], dtype=float)[order]
+    mass = np.asarray(base['mass'], dtype=float)[order]
+    x = pos[:, 0]
+    pos -= cen[segment]
+    r = np.sqrt((pos ** 2).sum(axis=1))
+
+    r_max = np.zeros(len(halo_ids))
+    if nonempty.any():
+        starts = offsets[:-1][nonempty]
+        r_max[nonempty] = np.maximum.reduceat(x, starts) - np.minimum.reduceat(x, starts)
+
+    by_radius = np.lexsort((r, segment))
+    result = _overdensity_radii(r[by_radius], mass[by_radius], offsets, target_rho, r_max)
+
+    if scalar:
+        return result[:, 0]
+    else:
+        return result
+
+
+def _overdensity_labels(overden):
+    return [o if isinstance(o, str) else "%g" % o for o in np.atleast_1d(np.asarray(overden, dtype=object))]
+
+
+def spherical_overdensity_catalogue(sim, overden=(178, '200c', '500c', '200m'), rho_def='matter', cen=None,
+                                    group_array=None, halo_ids=None, num_threads=config['number_of_threads']):
+    """
+
+    Calculate spherical overdensity masses and radii, and the maximum circular velocity, for all
+    halos in a catalogue.
+
+    Unlike :func:`batch_virial_radius`, which only considers the particles assigned to each halo,
+    the spheres here include all particles in the snapshot. They are found using a single KD-tree
+    over the whole snapshot (see :func:`pynbody.sph.build_tree`), and the halos are distributed
+    between threads.
+
+    **Input**:
+
+    *sim* : a HaloCatalogue, or a SimSnap together with a *group_array*
+
+    **Optional Keywords**:
+
+    *overden* (default=(178, '200c', '500c', '200m')): the overdensities to calculate, as for
+     :func:`virial_radius`
+
+    *rho_def* (default='matter'): reference density for overdensities that do not specify one
+
+    *cen* (default=None): an (Nhalo, 3) array of halo centres. If None, these are calculated with
+     :func:`batch_center`.
+
+    *group_array*, *halo_ids*: as for :func:`batch_center`
+
+    *num_threads* (config['number_of_threads']): The number of threads to use
+
+    **Returns**:
+
+    A structured numpy array with one row per halo, in the order of *halo_ids*, with fields
+
+      *halo_id*: the halo number
+
+      *cen*: the centre of the halo, in the units of the snapshot positions
+
+      *r<overden>*, *m<overden>*: the radius and enclosed mass for each overdensity, e.g. *r200c*
+      and *m200c*, in the units of the snapshot positions and masses
+
+      *vmax*, *rmax*: the maximum circular velocity in km s^-1 and the radius at which it is reached,
+      considering only radii within the first overdensity radius
+
+    """
+
+    base, order, offsets, halo_ids = _group_segments(sim, group_array, halo_ids)
+    pos_units = base['pos'].units
+    nhalos = len(halo_ids)
+
+    if cen is None:
+        cen = _batch_center_segments(base, order, offsets, 'ssc', None, 0.7, 100, num_threads)
+    elif isinstance(cen, array.SimArray) and cen.units != units.no_unit:
+        cen = cen.in_units(pos_units, **base.conversion_context())
+    cen = np.asarray(cen, dtype=float)
+    if cen.shape != (nhalos, 3):
+        raise ValueError("One centre must be given for each halo")
+
+    target_rho, _ = _target_densities(base, overden, rho_def)
+    labels = _overdensity_labels(overden)
+
+    pos = np.asarray(base['pos'], dtype=float)
+    mass = np.asarray(base['mass'], dtype=float)
+    G = units.G.ratio(units.Unit("km s^-1") ** 2 * pos_units / base['mass'].units, **base.conversion_context())
+
+    from .. import sph
+    sph.build_tree(base)
+    tree = base.kdtree
+    boxsize = tree.boxsize if tree.boxsize is not None and tree.boxsize > 0 else None
+
+    # initial search radius is the extent of the halo's own particles
+    lengths = np.diff(offsets)
+    nonempty = lengths > 0
+    search_radius = np.zeros(nhalos)
+    if nonempty.any():
+        x = pos[order, 0]
+        starts = offsets[:-1][nonempty]
+        search_radius[nonempty] = np.maximum.reduceat(x, starts) - np.minimum.reduceat(x, starts)
+    search_radius[search_radius == 0] = (pos[:, 0].max() - pos[:, 0].min()) * 1e-3
+
+    radii = np.empty((nhalos, len(target_rho)))
+    radii[:] = np.nan
+    masses = np.empty_like(radii)
+    masses[:] = np.nan
+    vmax = np.empty(nhalos)
+    vmax[:] = np.nan
+    rmax = np.empty(nhalos)
+    rmax[:] = np.nan
+
+    def process_halo(i):
+        r_search = search_radius[i]
+        while True:
+            index = tree.particles_in_sphere(cen[i], r_search)
+            offset = pos[index] - cen[i]
+            if boxsize is not None:
+                offset = (offset + boxsize / 2) % boxsize - boxsize / 2
+            r = np.sqrt((offset ** 2).sum(axis=1))
+            r_order = np.argsort(r)
+            r = r[r_order]
+            m = mass[index][r_order]
+            this_radii = _overdensity_radii(r, m, np.array([0, len(r)]), target_rho, np.array([r_search]))[0]
+            if np.all(this_radii < r_search) or len(index) == len(pos):
+                break
+            # the outermost crossing may lie beyond the search sphere, so try again with a larger one
+            r_search *= 2
+
+        cumulative_mass = np.cumsum(m)
+        radii[i] = this_radii
+        masses[i] = np.concatenate(([0], cumulative_mass))[np.searchsorted(r, this_radii, side='left')]
+
+        within = np.searchsorted(r, this_radii[0], side='right')
+        positive = np.searchsorted(r[:within], 0, side='right')
+        if within > positive:
+            vcirc = np.sqrt(G * cumulative_mass[positive:within] / r[positive:within])
+            imax = np.argmax(vcirc)
+            vmax[i] = vcirc[imax]
+            rmax[i] = r[positive + imax]
+
+    def process_halos(first):
+        for i in range(first, nhalos, num_threads):
+            if nonempty[i]:
+                process_halo(i)
+
+    num_threads = max(1, min(num_threads, nhalos))
+    if num_threads == 1:
+        process_halos(0)
+    else:
+        util._thread_map(process_halos, range(num_threads))
+
+    dtype = [('halo_id', np.asarray(halo_ids).dtype), ('cen', np.float64, (3,))]
+    for label in labels:
+        dtype += [('r' + label, np.float64), ('m' + label, np.float64)]
+    dtype += [('vmax', np.float64), ('rmax', np.float64)]
+
+    result = np.zeros(nhalos, dtype=dtype)
+    result['halo_id'] = halo_ids
+    result['cen'] = cen
+    for j, label in enumerate(labels):
+        result['r' + label] = radii[:, j]
+        result['m' + label] = masses[:, j]
+    result['vmax'] = vmax
+    result['rmax'] = rmax
+    return result
+
+
 def halo_shape(sim, N=100, rin=None, rout=None, bins='equal'):
     """
     Returns radii in units of ``sim['pos']``, axis ratios b/a and c/a,
@@ -361,19 +850,19 @@ def halo_shape(sim, N=100, rin=None, rout=None, bins='equal'):
     radial spacing.
 
     Halo must be in a centered frame.
-    Caution is advised when assigning large number of bins and radial
-    ranges with many particles, as the algorithm becomes very slow.
+    The particles are sorted by radius once, so that each iteration of
+    the fit only considers the particles in the radial range that can
+    overlap the current shell.
     """
 
     #-----------------------------FUNCTIONS-----------------------------
     # Define an ellipsoid shell with lengths a,b,c and orientation E:
     def Ellipsoid(r, a,b,c, E):
-        x,y,z = np.dot(np.transpose(E),[r[:,0],r[:,1],r[:,2]])
+        x,y,z = np.dot(r, E).T
         return (x/a)**2 + (y/b)**2 + (z/c)**2
 
     # Define moment of inertia tensor:
-    MoI = lambda r,m: np.array([[np.sum(m*r[:,i]*r[:,j]) for j in range(3)]\
-                               for i in range(3)])
+    MoI = lambda r,m: np.einsum('i,ij,ik->jk', m, r, r)
 
     # Splits 'r' array into N groups containing equal numbers of particles.
     # An array is returned with the radial bins that contain these groups.
@@ -391,13 +880,17 @@ def halo_shape(sim, N=100, rin=None, rout=None, bins='equal'):
     pos = np.array(sim.dm['pos'])[np.where(sim.dm['r'] < rout)]
     mass = np.array(sim.dm['mass'])[np.where(sim.dm['r'] < rout)]
 
+    # Sort by radius so that the candidate particles for any shell are a contiguous slice:
+    order = np.argsort(posr, kind='stable')
+    posr, pos, mass = posr[order], pos[order], mass[order]
+
     rx = [[1.,0.,0.],[0.,0.,-1.],[0.,1.,0.]]
     ry = [[0.,0.,1.],[0.,1.,0.],[-1.,0.,0.]]
     rz = [[0.,-1.,0.],[1.,0.,0.],[0.,0.,1.]]
 
     # Define bins:
     if (bins == 'equal'): # Each bin contains equal number of particles
-        mid = sn(np.sort(posr[np.where((posr >= rin) & (posr <= rout))]),N*2)
+        mid = sn(posr[np.where((posr >= rin) & (posr <= rout))],N*2)
         rbin = mid[1:N*2+1:2]
         mid = mid[0:N*2+1:2]
 
@@ -430,11 +923,14 @@ def halo_shape(sim, N=100, rin=None, rout=None, bins='equal'):
             count += 1
 
             # Collect all particle positions and masses within shell:
-            r = pos[np.where((posr < a+L2) & (posr > c-L1*c/a))]
+            lo = np.searchsorted(posr, c-L1*c/a, side='right')
+            hi = np.searchsorted(posr, a+L2, side='left')
+            r = pos[lo:hi]
             inner = Ellipsoid(r, a-L1,b-L1*b/a,c-L1*c/a, E)
             outer = Ellipsoid(r, a+L2,b+L2*b/a,c+L2*c/a, E)
-            r = r[np.where((inner > 1.) & (outer < 1.))]
-            m = mass[np.where((inner > 1.) & (outer < 1.))]
+            in_shell = (inner > 1.) & (outer < 1.)
+            r = r[in_shell]
+            m = mass[lo:hi][in_shell]
 
             # End iterations if there is no data in range:
             if (len(r) == 0):
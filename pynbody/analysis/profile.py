@@ -11,13 +11,223 @@ properties.
 import numpy as np
 import pynbody
 from .. import units, array, util
+from .. import config_parser
 import math
+import itertools
+import os
+import pickle
+import hashlib
 import logging
 from time import process_time
 import warnings
 logger = logging.getLogger('pynbody.analysis.profile')
 
 
+class _BinIndexList:
+
+    """
+
+    A read-only list of the indices of the particles in each bin of a profile.
+
+    Rather than storing a separate index array for every bin, the indices are
+    held in CSR layout: a single array *order* contains the indices of all binned
+    particles ordered by bin, and the particles in bin i are
+    ``order[offsets[i]:offsets[i+1]]``. Accessing a bin returns a view into *order*.
+
+    """
+
+    def __init__(self, order, offsets):
+        self.order = order
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if i < 0 or i >= len(self):
+            raise IndexError("bin index out of range")
+        return self.order[self.offsets[i]:self.offsets[i + 1]]
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+
+class _QuantileSketch:
+
+    """
+
+    A mergeable summary of a weighted distribution of bounded size, from which
+    approximate quantiles can be estimated.
+
+    Values are held as weighted centroids. Whenever more than twice *size* centroids
+    accumulate, they are sorted and adjacent centroids are merged into *size* groups
+    of roughly equal weight (like a t-digest with a uniform scale function), so the
+    rank error of a quantile estimate is of order 1/*size*. Until that point the
+    summary is exact.
+
+    """
+
+    def __init__(self, size=200):
+        self.size = size
+        self.values = np.zeros(0)
+        self.weights = np.zeros(0)
+
+    def add(self, values, weights=None):
+        """Add the given values (with optional weights) to the summary"""
+        if weights is None:
+            weights = np.ones(len(values))
+        self.values = np.concatenate((self.values, values))
+        self.weights = np.concatenate((self.weights, weights))
+        if len(self.values) > 2 * self.size:
+            self._compress()
+
+    def merge(self, other):
+        """Merge another summary into this one"""
+        self.add(other.values, other.weights)
+
+    def _compress(self):
+        order = np.argsort(self.values, kind='stable')
+        values = self.values[order]
+        weights = self.weights[order]
+        cumulative = np.cumsum(weights)
+        group = ((cumulative - 0.5 * weights) * (self.size / cumulative[-1])).astype(int)
+        group = np.clip(group, 0, self.size - 1)
+        group_weights = np.bincount(group, weights=weights, minlength=self.size)
+        group_values = np.bincount(group, weights=weights * values, minlength=self.size)
+        nonempty = group_weights > 0
+        self.weights = group_weights[nonempty]
+        self.values = group_values[nonempty] / self.weights
+
+    def quantile(self, q):
+        """Estimate the quantile(s) *q* (in the range 0 to 1) of the distribution, or NaN if it is empty"""
+        if len(self.values) == 0:
+            return np.full(np.shape(q), np.nan)
+        order = np.argsort(self.values, kind='stable')
+        values = self.values[order]
+        weights = self.weights[order]
+        cumulative = (np.cumsum(weights) - 0.5 * weights) / weights.sum()
+        return np.interp(q, cumulative, values)
+
+    def median(self):
+        """Estimate the median of the distribution, or NaN if it is empty.
+
+        Unlike quantile(0.5), this does not interpolate: it returns the first value at which the
+        cumulative weight exceeds half the total. While the summary is exact and unweighted, that
+        is the element at position floor(n/2) of the n sorted values, as in Profile's median profiles."""
+        if len(self.values) == 0:
+            return np.nan
+        order = np.argsort(self.values, kind='stable')
+        cumulative = np.cumsum(self.weights[order])
+        return self.values[order][np.searchsorted(cumulative, 0.5 * cumulative[-1], side='right')]
+
+
+class ProfileCache:
+
+    """
+
+    An on-disk cache of individual profiles, allowing profiles of the same particles
+    with the same binning to be reused across sessions.
+
+    Each profile is stored in its own file in the directory *path*, named by a hash of
+    everything that determines it: the particles and their current positions,
+    velocities and masses (so that any transformation of the snapshot leads to a
+    different key), the binning and weighting, the name of the profile and the
+    content of any other arrays it depends on. Profiles whose inputs are not known
+    are never cached, so entries made stale by changes to the particles can never
+    be returned.
+
+    When the total size of the cache exceeds *max_size* bytes, the least recently used
+    entries are deleted. By default the maximum size is taken from the ``cache-max-size``
+    option (in megabytes) in the ``[profile]`` section of the configuration.
+
+    Normally a cache is created automatically by passing ``cache=True`` when constructing
+    a :class:`Profile`.
+
+    """
+
+    _suffix = ".profile"
+
+    def __init__(self, path, max_size=None):
+        if max_size is None:
+            max_size = config_parser.getint('profile', 'cache-max-size') * 2 ** 20
+        self.path = path
+        self.max_size = max_size
+        os.makedirs(path, exist_ok=True)
+
+    def _filename(self, key):
+        return os.path.join(self.path, key + self._suffix)
+
+    def __contains__(self, key):
+        return os.path.exists(self._filename(key))
+
+    def get(self, key):
+        """Return the profile stored under *key*, raising KeyError if there is none"""
+        filename = self._filename(key)
+        try:
+            with open(filename, 'rb') as f:
+                value = pickle.load(f)
+        except (FileNotFoundError, EOFError, pickle.UnpicklingError):
+            raise KeyError(key)
+
+        # record the access for the least-recently-used eviction
+        try:
+            os.utime(filename)
+        except OSError:
+            pass
+        return value
+
+    def put(self, key, value):
+        """Store the profile *value* under *key*, then evict old entries if the cache is too large"""
+        filename = self._filename(key)
+        temp_filename = "%s.%d.tmp" % (filename, os.getpid())
+        with open(temp_filename, 'wb') as f:
+            pickle.dump(value, f)
+        os.replace(temp_filename, filename)
+        self.evict()
+
+    def _entries(self):
+        entries = []
+        for name in os.listdir(self.path):
+            if name.endswith(self._suffix):
+                try:
+                    stat = os.stat(os.path.join(self.path, name))
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, os.path.join(self.path, name)))
+        return entries
+
+    def size(self):
+        """Return the total size of all entries in the cache, in bytes"""
+        return sum(size for _, size, _ in self._entries())
+
+    def evict(self):
+        """Delete the least recently used entries until the cache is no larger than its maximum size"""
+        entries = sorted(self._entries())
+        total = sum(size for _, size, _ in entries)
+        for _, size, filename in entries:
+            if total <= self.max_size:
+                break
+            try:
+                os.remove(filename)
+            except FileNotFoundError:
+                pass
+            total -= size
+            logger.info("Evicted %s from profile cache", filename)
+
+    def clear(self):
+        """Delete all entries from the cache"""
+        for _, _, filename in self._entries():
+            try:
+                os.remove(filename)
+            except FileNotFoundError:
+                pass
+
+
 class Profile:
 
     """
@@ -63,6 +273,22 @@ class Profile:
     *weight_by* (default = 'mass'): name of the array to use for weighting
      averages across particles in each bin
 
+    *cache* (default = None): if True, look up each profile in an on-disk
+     :class:`ProfileCache` before computing it, and store it there
+     afterwards. The cache is kept in the directory given by the
+     ``cache-dir`` option in the ``[profile]`` section of the configuration
+     or, if that is blank, in a directory alongside the snapshot file. A
+     path or a ProfileCache object may also be passed. Only profiles whose
+     dependence on the particle arrays is known are cached: those derived
+     automatically from arrays, their derivatives, and profile properties
+     registered with *cache_inputs*.
+
+    *compact* (default = False): if True, do not keep the per-particle
+     bin number array (``partbin``); only a single permutation array of
+     the binned particles and the offsets of each bin within it are
+     stored, which substantially reduces the memory footprint for very
+     large numbers of particles
+
     **Output**:
 
     a Profile object. To find out which profiles are available, use keys().
@@ -105,7 +331,8 @@ class Profile:
 
 
     Additional functions should use the profile_property to yield the
-    desired profile.
+    desired profile. Declare the particle arrays they depend on with its
+    *cache_inputs* keyword if they are to be stored in the on-disk cache.
 
     **Lazy-loading arrays:** 
 
@@ -144,10 +371,15 @@ class Profile:
 
     _profile_registry = {}
 
+    # names of the particle arrays, other than those in the cache key base, on which each registered profile
+    # property depends; properties that are not listed here are never cached
+    _profile_cache_inputs = {}
+
     def _calculate_x(self, sim):
         return ((sim['pos'][:, 0:self.ndim] ** 2).sum(axis=1)) ** (1, 2)
 
-    def __init__(self, sim, load_from_file=False, ndim=2, type='lin', calc_x=None, weight_by='mass', **kwargs):
+    def __init__(self, sim, load_from_file=False, ndim=2, type='lin', calc_x=None, weight_by='mass',
+                 compact=False, cache=None, **kwargs):
 
         generate_new = True
         if calc_x is None:
@@ -156,6 +388,7 @@ class Profile:
         self.type = type
         self.ndim = ndim
         self._weight_by = weight_by
+        self._compact = compact
         self._x = calc_x(sim)
         x = self._x
 
@@ -171,7 +404,7 @@ class Profile:
                 self.min = data['min']
                 self.nbins = data['nbins']
                 self._profiles = data['profiles']
-                self.binind = data['binind']
+                self._setup_bin_index()
 
                 logger.info("Loaded profile from %s" % filename)
 
@@ -182,59 +415,7 @@ class Profile:
                     "Existing profile not found -- generating one from scratch instead")
 
         if generate_new:
-            self._properties = {}
-            # The profile object is initialized given some array of values
-            # and optional keyword parameters
-
-            if 'max' in kwargs:
-                kwargs['rmax'] = kwargs.pop('max')
-                warnings.warn("Use of max as a keyword argument is deprecated. Use rmax instead.", DeprecationWarning)
-            if 'min' in kwargs:
-                kwargs['rmin'] = kwargs.pop('min')
-                warnings.warn("Use of min as a keyword argument is deprecated. Use rmin instead.", DeprecationWarning)
-
-            if 'rmax' in kwargs:
-                if isinstance(kwargs['rmax'], str):
-                    self.max = units.Unit(kwargs['rmax']).ratio(x.units,
-                                                               **sim.conversion_context())
-                else:
-                    self.max = kwargs['rmax']
-            else:
-                self.max = np.max(x)
-            if 'bins' in kwargs:
-                self.nbins = len(kwargs['bins']) - 1
-            elif 'nbins' in kwargs:
-                self.nbins = kwargs['nbins']
-            else:
-                self.nbins = 100
-
-            if 'rmin' in kwargs:
-                if isinstance(kwargs['rmin'], str):
-                    self.min = units.Unit(kwargs['rmin']).ratio(x.units,
-                                                               **sim.conversion_context())
-                else:
-                    self.min = kwargs['rmin']
-            else:
-                self.min = np.min(x[x > 0])
-
-            if 'bins' in kwargs:
-                self._properties['bin_edges'] = kwargs['bins']
-                self.min = kwargs['bins'].min()
-                self.max = kwargs['bins'].max()
-            elif type == 'log':
-                self._properties['bin_edges'] = np.logspace(
-                    np.log10(self.min), np.log10(self.max), num=self.nbins + 1)
-            elif type == 'lin':
-                self._properties['bin_edges'] = np.linspace(
-                    self.min, self.max, num=self.nbins + 1)
-            elif type == 'equaln':
-                self._properties['bin_edges'] = util.equipartition(
-                    x, self.nbins, self.min, self.max)
-            else:
-                raise RuntimeError("Bin type must be one of: lin, log, equaln")
-
-            self['bin_edges'] = array.SimArray(self['bin_edges'], x.units)
-            self['bin_edges'].sim = self.sim
+            self._setup_bin_edges(x, sim, kwargs)
 
             n, bins = np.histogram(self._x, self['bin_edges'])
             self._setup_bins()
@@ -242,6 +423,169 @@ class Profile:
             # set up the empty list of profiles
             self._profiles = {'n': n}
 
+        self._setup_cache(cache)
+
+    def _setup_cache(self, cache):
+        self._cache = None
+        if cache is None or cache is False:
+            return
+        elif isinstance(cache, ProfileCache):
+            self._cache = cache
+        elif isinstance(cache, str):
+            self._cache = ProfileCache(cache)
+        else:
+            cache_dir = config_parser.get('profile', 'cache-dir').strip()
+            if cache_dir == "":
+                try:
+                    snapshot_filename = self.sim.base.filename
+                except AttributeError:
+                    snapshot_filename = self.sim.filename
+                if not os.path.exists(str(snapshot_filename)):
+                    raise ValueError("The snapshot has no file on disk; specify a directory for the profile cache")
+                cache_dir = str(snapshot_filename) + ".profile-cache"
+            self._cache = ProfileCache(cache_dir)
+
+        self._cache_key_base = self._generate_cache_key_base()
+
+    _cache_version = 1
+
+    def _generate_cache_key_base(self):
+        """Return a hash of the particles, their current positions, velocities and masses, and the binning"""
+        h = hashlib.new('md5')
+        h.update(repr((self._cache_version, type(self).__name__, self.ndim, self._weight_by,
+                       str(self['bin_edges'].units))).encode())
+        h.update(np.ascontiguousarray(self['bin_edges']))
+        h.update(np.ascontiguousarray(self._x))
+        for array_name in ('pos', 'vel', 'mass', self._weight_by):
+            try:
+                with self.sim.immediate_mode:
+                    h.update(np.ascontiguousarray(self.sim[array_name].view(np.ndarray)))
+            except KeyError:
+                h.update(b"-")
+        return h.hexdigest()
+
+    def _cache_inputs(self, name):
+        """Return the names of the particle arrays, other than those in the cache key base, on which the named
+        profile depends, or None if they are not known"""
+        base_name = name.split(",")[0]
+        if base_name in Profile._profile_registry:
+            inputs = Profile._profile_cache_inputs.get(base_name)
+            return None if inputs is None else list(inputs)
+        parsed = self._parse_auto_profile_name(name)
+        if parsed is not None:
+            return [parsed[0]]
+        if name.startswith("d_"):
+            return self._cache_inputs(name[2:])
+        return None
+
+    def _cache_key(self, name):
+        """Return the key under which the named profile is cached, or None if it cannot be cached"""
+        inputs = self._cache_inputs(name)
+        if inputs is None:
+            return None
+        h = hashlib.new('md5')
+        h.update(self._cache_key_base.encode())
+        h.update(name.encode())
+        for array_name in inputs:
+            # the cached profile is only valid for the current content of the array
+            with self.sim.immediate_mode:
+                h.update(np.ascontiguousarray(self.sim[array_name].view(np.ndarray)))
+            h.update(str(self.sim[array_name].units).encode())
+        return h.hexdigest()
+
+    def _load_from_cache(self, name):
+        """Load the named profile from the on-disk cache into memory, returning True if it was found"""
+        if self._cache is None:
+            return False
+        key = self._cache_key(name)
+        if key is None:
+            return False
+        try:
+            self._profiles[name] = self._cache.get(key)
+        except KeyError:
+            return False
+        logger.info("Loaded profile %s from cache", name)
+        try:
+            self._profiles[name].sim = self.sim
+        except AttributeError:
+            pass
+        return True
+
+    def _store_in_cache(self, name):
+        if self._cache is None or name not in self._profiles:
+            return
+        key = self._cache_key(name)
+        if key is None:
+            return
+        value = self._profiles[name]
+        sim = getattr(value, 'sim', None)
+        try:
+            # do not pickle the snapshot along with the profile
+            value.sim = None
+        except AttributeError:
+            pass
+        try:
+            self._cache.put(key, value)
+        finally:
+            if sim is not None:
+                value.sim = sim
+
+    def _setup_bin_edges(self, x, conversion_sim, kwargs):
+        """Set up the bin edges from the binning keywords and the binning quantity *x*"""
+        self._properties = {}
+        # The profile object is initialized given some array of values
+        # and optional keyword parameters
+
+        if 'max' in kwargs:
+            kwargs['rmax'] = kwargs.pop('max')
+            warnings.warn("Use of max as a keyword argument is deprecated. Use rmax instead.", DeprecationWarning)
+        if 'min' in kwargs:
+            kwargs['rmin'] = kwargs.pop('min')
+            warnings.warn("Use of min as a keyword argument is deprecated. Use rmin instead.", DeprecationWarning)
+
+        if 'rmax' in kwargs:
+            if isinstance(kwargs['rmax'], str):
+                self.max = units.Unit(kwargs['rmax']).ratio(x.units,
+                                                           **conversion_sim.conversion_context())
+            else:
+                self.max = kwargs['rmax']
+        else:
+            self.max = np.max(x)
+        if 'bins' in kwargs:
+            self.nbins = len(kwargs['bins']) - 1
+        elif 'nbins' in kwargs:
+            self.nbins = kwargs['nbins']
+        else:
+            self.nbins = 100
+
+        if 'rmin' in kwargs:
+            if isinstance(kwargs['rmin'], str):
+                self.min = units.Unit(kwargs['rmin']).ratio(x.units,
+                                                           **conversion_sim.conversion_context())
+            else:
+                self.min = kwargs['rmin']
+        else:
+            self.min = np.min(x[x > 0])
+
+        if 'bins' in kwargs:
+            self._properties['bin_edges'] = kwargs['bins']
+            self.min = kwargs['bins'].min()
+            self.max = kwargs['bins'].max()
+        elif self.type == 'log':
+            self._properties['bin_edges'] = np.logspace(
+                np.log10(self.min), np.log10(self.max), num=self.nbins + 1)
+        elif self.type == 'lin':
+            self._properties['bin_edges'] = np.linspace(
+                self.min, self.max, num=self.nbins + 1)
+        elif self.type == 'equaln':
+            self._properties['bin_edges'] = util.equipartition(
+                x, self.nbins, self.min, self.max)
+        else:
+            raise RuntimeError("Bin type must be one of: lin, log, equaln")
+
+        self['bin_edges'] = array.SimArray(self['bin_edges'], x.units)
+        self['bin_edges'].sim = self.sim
+
     def _setup_bins(self):
         # middle of the bins for convenience
 
@@ -258,12 +602,6 @@ class Profile:
         self._properties['dr'].units = self['rbins'].units
         self._properties['dr'].sim = self.sim
 
-        self.binind = []
-        if len(self._x) > 0:
-            self.partbin = np.digitize(self._x, self['bin_edges'])
-        else:
-            self.partbin = np.array([])
-
         assert self.ndim in [2, 3]
         if self.ndim == 2:
             self._binsize = np.pi * (self['bin_edges'][1:] ** 2 -
@@ -272,17 +610,38 @@ class Profile:
             self._binsize = 4. / 3. * np.pi * (self['bin_edges'][1:] ** 3 -
                                                self['bin_edges'][:-1] ** 3)
 
-        # sort the partbin array
-        from bisect import bisect
-        sortind = self.partbin.argsort()
-        sort_pind = self.partbin[sortind]
+        self._setup_bin_index()
+
+    def _setup_bin_index(self):
+        """Work out which particles belong in which bin.
 
-        # create the bin index arrays
-        prev_index = bisect(sort_pind, 0)
-        for i in range(self.nbins):
-            new_index = bisect(sort_pind, i + 1)
-            self.binind.append(np.sort(sortind[prev_index:new_index]))
-            prev_index = new_index
+        The particles in each bin are stored in CSR layout: ``_bin_order`` lists the indices of all particles
+        that fall in a bin, ordered by bin (and in ascending order within each bin), and the particles in bin i
+        are ``_bin_order[_bin_offsets[i]:_bin_offsets[i+1]]``. Unless the profile is compact, the bin number
+        of every particle (as returned by np.digitize, so that bin i corresponds to partbin==i+1) is also kept
+        in ``partbin``."""
+
+        if len(self._x) > 0:
+            partbin = np.digitize(self._x, self['bin_edges'])
+        else:
+            partbin = np.array([], dtype=np.intp)
+
+        counts = np.bincount(partbin, minlength=self.nbins + 2)
+        self._bin_offsets = np.concatenate(([0], np.cumsum(counts[1:self.nbins + 1])))
+
+        if len(partbin) < np.iinfo(np.int32).max:
+            index_type = np.int32
+        else:
+            index_type = np.int64
+
+        # a stable sort keeps the particles in each bin in ascending order
+        self._bin_order = np.argsort(partbin, kind='stable')[counts[0]:counts[0] + self._bin_offsets[-1]].astype(index_type)
+        self.binind = _BinIndexList(self._bin_order, self._bin_offsets)
+
+        if self._compact:
+            self.partbin = None
+        else:
+            self.partbin = partbin
 
     def __len__(self):
         """Returns the number of bins used in this profile object"""
@@ -340,39 +699,187 @@ class Profile:
         else:
             raise KeyError(name + " is not a valid profile")
 
-    def _auto_profile(self, name, dispersion=False, rms=False, median=False):
+    def _parse_auto_profile_name(self, name):
+        """Return (array name, _auto_profile keyword) if *name* can be generated by _auto_profile, or None.
+
+        The keyword is None for a plain weighted mean, otherwise 'dispersion', 'rms' or 'median'."""
+
+        def is_array(array_name):
+            return array_name in list(self.sim.keys()) or array_name in self.sim.all_keys()
+
+        if is_array(name):
+            return name, None
+        for suffix, kind in (("_disp", 'dispersion'), ("_rms", 'rms'), ("_med", 'median')):
+            if name.endswith(suffix) and is_array(name[:-len(suffix)]):
+                return name[:-len(suffix)], kind
+        return None
+
+    def compute(self, names, chunk_size=None):
+        """Compute several profiles at once, returning them as a list in the order requested.
+
+        Profiles that are automatically derived from particle arrays (means, and their ``_disp`` and
+        ``_rms`` variants) are calculated together: the particles are sorted by bin once, and the
+        requested arrays are gathered into a single contiguous block in that order, which is then
+        reduced for every quantity in one pass. The block is built *chunk_size* particles at a time
+        so that the memory overhead is bounded; by default the chunk size is taken from the
+        ``chunk-size`` option in the ``[profile]`` section of the configuration.
+
+        Any other profiles (including ``_med`` profiles and derivable profiles such as ``density``)
+        are computed in the normal way. All results are cached exactly as if they had been requested
+        individually.
+
+        **Example:**
+
+        >>> p = pynbody.analysis.profile.Profile(s)
+        >>> temp, temp_disp, metals = p.compute(['temp', 'temp_disp', 'metals'])
+
+        """
+
+        if chunk_size is None:
+            chunk_size = config_parser.getint('profile', 'chunk-size')
+
+        batched = []
+        for name in names:
+            if name in self._properties or name in self._profiles or name.split(",")[0] in self._profile_registry:
+                continue
+            parsed = self._parse_auto_profile_name(name)
+            if parsed is not None and parsed[1] in (None, 'dispersion', 'rms') and name not in batched \
+                    and not self._load_from_cache(name):
+                batched.append(name)
+
+        if len(batched) > 0:
+            self._batched_auto_profiles(batched, chunk_size)
+            for name in batched:
+                self._store_in_cache(name)
+
+        return [self[name] for name in names]
+
+    def _batched_auto_profiles(self, names, chunk_size):
+        requests = [self._parse_auto_profile_name(name) for name in names]
+        array_names = list(dict.fromkeys(array_name for array_name, _ in requests))
+        need_squares = {array_name for array_name, kind in requests if kind is not None}
+        squared_names = [array_name for array_name in array_names if array_name in need_squares]
+
+        # force derivation of arrays if necessary:
+        for array_name in array_names:
+            self.sim[array_name]
+
+        with self.sim.immediate_mode:
+            arrays = [self.sim[array_name].view(np.ndarray) for array_name in array_names]
+            mass_array = self.sim[self._weight_by].view(np.ndarray)
+
+        order = self._bin_order
+
+        sums = np.zeros((len(array_names), self.nbins))
+        sq_sums = np.zeros((len(squared_names), self.nbins))
+        squared_rows = [array_names.index(array_name) for array_name in squared_names]
+
+        block = np.empty((len(array_names), min(chunk_size, len(order))))
+
+        for chunk_start in range(0, len(order), chunk_size):
+            chunk_order = order[chunk_start:chunk_start + chunk_size]
+            chunk_len = len(chunk_order)
+            chunk_bin = self._sorted_bin_number(chunk_start, chunk_start + chunk_len)
+
+            chunk_block = block[:, :chunk_len]
+            for row, ar in enumerate(arrays):
+                chunk_block[row] = ar[chunk_order]
+            chunk_mass = mass_array[chunk_order]
+
+            segment_starts = np.concatenate(([0], np.flatnonzero(np.diff(chunk_bin)) + 1))
+            segment_bins = chunk_bin[segment_starts]
+
+            weighted = chunk_block * chunk_mass
+            sums[:, segment_bins] += np.add.reduceat(weighted, segment_starts, axis=1)
+            if len(squared_rows) > 0:
+                sq_sums[:, segment_bins] += np.add.reduceat(weighted[squared_rows] * chunk_block[squared_rows],
+                                                            segment_starts, axis=1)
+
+        weights = self['weight_fn'].view(np.ndarray)
+
+        for name, (array_name, kind) in zip(names, requests):
+            with np.errstate(divide='ignore', invalid='ignore'):
+                mean = sums[array_names.index(array_name)] / weights
+                if kind is not None:
+                    sq_mean = sq_sums[squared_names.index(array_name)] / weights
+                if kind == 'dispersion':
+                    result = sq_mean - mean ** 2
+                    # sq_mean<mean_sq occasionally from numerical roundoff
+                    result[result < 0] = 0
+                    result = np.sqrt(result)
+                elif kind == 'rms':
+                    result = np.sqrt(sq_mean)
+                else:
+                    result = mean
+
+            result = result.view(array.SimArray)
+            result.units = self.sim[array_name].units
+            result.sim = self.sim
+            self._profiles[name] = result
+
+    def _bin_sum(self, values):
+        """Sum the per-particle *values* within each bin, for all bins in a single pass"""
+        if self.partbin is not None:
+            return np.bincount(self.partbin, weights=values, minlength=self.nbins + 2)[1:self.nbins + 1]
+
+        # compact profile: reduce over the particles in bin order instead
         result = np.zeros(self.nbins)
+        if len(self._bin_order) > 0:
+            nonempty = np.diff(self._bin_offsets) > 0
+            result[nonempty] = np.add.reduceat(values[self._bin_order], self._bin_offsets[:-1][nonempty])
+        return result
+
+    def _sorted_bin_number(self, start=0, stop=None):
+        """Return the (zero-based) bin of each particle in _bin_order[start:stop]"""
+        if stop is None:
+            stop = len(self._bin_order)
+        return np.searchsorted(self._bin_offsets, np.arange(start, stop), side='right') - 1
+
+    def _sort_within_bins(self, values):
+        """Return the indices of the binned particles, ordered by bin and then by *values* within each bin.
+
+        All bins are handled with a single lexsort; the particles of bin i occupy positions
+        _bin_offsets[i]:_bin_offsets[i+1] of the returned array."""
+        return self._bin_order[np.lexsort((values[self._bin_order], self._sorted_bin_number()))]
+
+    def _bin_median(self, values):
+        """Return the (unweighted) median of the per-particle *values* within each bin.
+
+        The returned value for a bin of n particles is the element at position floor(n/2) of its
+        sorted values, or NaN if the bin is empty."""
+        sorted_values = values[self._sort_within_bins(values)]
+        n = np.diff(self._bin_offsets)
 
+        result = np.empty(self.nbins)
+        result.fill(np.nan)
+        nonempty = n > 0
+        result[nonempty] = sorted_values[self._bin_offsets[:-1][nonempty] + n[nonempty] // 2]
+        return result
+
+    def _auto_profile(self, name, dispersion=False, rms=False, median=False):
         # force derivation of array if necessary:
         self.sim[name]
 
-        for i in range(self.nbins):
-            subs = self.sim[self.binind[i]]
-            name_array = subs[name].view(np.ndarray)
-            mass_array = subs[self._weight_by].view(np.ndarray)
+        with self.sim.immediate_mode:
+            name_array = self.sim[name].view(np.ndarray)
+            mass_array = self.sim[self._weight_by].view(np.ndarray)
 
-            if dispersion:
-                sq_mean = (name_array ** 2 * mass_array).sum() / \
-                    self['weight_fn'][i]
-                mean_sq = (
-                    (name_array * mass_array).sum() / self['weight_fn'][i]) ** 2
-                try:
-                    result[i] = math.sqrt(sq_mean - mean_sq)
-                except ValueError:
-                    # sq_mean<mean_sq occasionally from numerical roundoff
-                    result[i] = 0
+        weights = self['weight_fn'].view(np.ndarray)
 
+        with np.errstate(divide='ignore', invalid='ignore'):
+            if dispersion:
+                sq_mean = self._bin_sum(name_array ** 2 * mass_array) / weights
+                mean_sq = (self._bin_sum(name_array * mass_array) / weights) ** 2
+                result = sq_mean - mean_sq
+                # sq_mean<mean_sq occasionally from numerical roundoff
+                result[result < 0] = 0
+                result = np.sqrt(result)
             elif rms:
-                result[i] = np.sqrt(
-                    (name_array ** 2 * mass_array).sum() / self['weight_fn'][i])
+                result = np.sqrt(self._bin_sum(name_array ** 2 * mass_array) / weights)
             elif median:
-                if len(subs) == 0:
-                    result[i] = np.nan
-                else:
-                    sorted_name = sorted(name_array)
-                    result[i] = sorted_name[int(np.floor(0.5 * len(subs)))]
+                result = self._bin_median(name_array)
             else:
-                result[i] = (name_array * mass_array).sum() / self['weight_fn'][i]
+                result = self._bin_sum(name_array * mass_array) / weights
 
         result = result.view(array.SimArray)
         result.units = self.sim[name].units
@@ -383,6 +890,10 @@ class Profile:
         """Return the profile of a given kind"""
         if name in self._properties:
             return self._properties[name]
+        elif name not in self._profiles and not self._load_from_cache(name):
+            result = self._get_profile(name)
+            self._store_in_cache(name)
+            return result
         else:
             return self._get_profile(name)
 
@@ -523,8 +1034,22 @@ class Profile:
                     open(filename, 'wb'))   # Open file in binary mode to allow python 3.X writing
 
     @staticmethod
-    def profile_property(fn):
+    def profile_property(fn=None, cache_inputs=None):
+        """Register fn as a profile property, calculated on request from the profile object.
+
+        *cache_inputs* (None): if the property is a function only of the binning and of the positions,
+         velocities, masses and weights of the particles, pass an empty tuple; if it also depends on other
+         particle arrays, pass their names. The property can then be stored in a :class:`ProfileCache`.
+         Properties with unknown inputs are never cached.
+
+        Can be used as a plain decorator, or called with *cache_inputs* to make one."""
+        if fn is None:
+            return lambda fn: Profile.profile_property(fn, cache_inputs)
         Profile._profile_registry[fn.__name__] = fn
+        if cache_inputs is None:
+            Profile._profile_cache_inputs.pop(fn.__name__, None)
+        else:
+            Profile._profile_cache_inputs[fn.__name__] = tuple(cache_inputs)
         return fn
 
 
@@ -535,26 +1060,23 @@ def weight_fn(self, weight_by=None):
     """
     if weight_by is None:
         weight_by = self._weight_by
-    mass = array.SimArray(np.zeros(self.nbins), self.sim[weight_by].units)
-
     with self.sim.immediate_mode:
         pmass = self.sim[weight_by].view(np.ndarray)
 
-    for i in range(self.nbins):
-        mass[i] = (pmass[self.binind[i]]).sum()
+    mass = self._bin_sum(pmass).view(array.SimArray)
 
     mass.sim = self.sim
     mass.units = self.sim[weight_by].units
 
     return mass
 
-@Profile.profile_property
+@Profile.profile_property(cache_inputs=())
 def mass(self):
     return weight_fn(self, 'mass')
 
 
 
-@Profile.profile_property
+@Profile.profile_property(cache_inputs=())
 def density(self):
     """
     Generate a radial density profile for the current type of profile
@@ -612,7 +1134,7 @@ def pattern_frequency(pro):
     """Estimate the pattern speed from the m=2 Fourier mode"""
     return pro['fourier']['dphi_dt'][2,:]/2
 
-@Profile.profile_property
+@Profile.profile_property(cache_inputs=())
 def mass_enc(self):
     """
     Generate the enclosed mass profile
@@ -620,7 +1142,7 @@ def mass_enc(self):
     return self['mass'].cumsum()
 
 
-@Profile.profile_property
+@Profile.profile_property(cache_inputs=())
 def density_enc(self):
     """
     Generate the mean enclosed density profile
@@ -628,14 +1150,14 @@ def density_enc(self):
     return self['mass_enc'] / ((4. * math.pi / 3) * self['rbins'] ** 3)
 
 
-@Profile.profile_property
+@Profile.profile_property(cache_inputs=())
 def dyntime(self):
     """The dynamical time of the bin, sqrt(R^3/2GM)."""
     dyntime = (self['rbins'] ** 3 / (2 * units.G * self['mass_enc'])) ** (1, 2)
     return dyntime
 
 
-@Profile.profile_property
+@Profile.profile_property(cache_inputs=())
 def g_spherical(self):
     """The naive gravitational acceleration assuming spherical
     symmetry = GM_enc/r^2"""
@@ -643,7 +1165,7 @@ def g_spherical(self):
     return (units.G * self['mass_enc'] / self['rbins'] ** 2)
 
 
-@Profile.profile_property
+@Profile.profile_property(cache_inputs=())
 def rotation_curve_spherical(self):
     """
     The naive rotation curve assuming spherical symmetry: vc = sqrt(G M_enc/r)
@@ -961,14 +1483,24 @@ class QuantileProfile(Profile):
      i.e. density is in units of mass/pc^2. If ndim=3 a volume
      profile is made, i.e. density is in units of mass/pc^3.
 
+    *approximate* (default = False): if True, estimate the quantiles
+     from a bounded-size mergeable sketch for each bin rather than
+     sorting every bin, which limits memory use for very large bins
+
+    *sketch_size* (default = 1000): the number of centroids kept per
+     bin in approximate mode; the rank error is of order 1/sketch_size
+
     """
 
-    def __init__(self, sim, q=(0.16, 0.50, 0.84), weights=None, load_from_file = False, ndim = 3, type = 'lin', **kwargs):
+    def __init__(self, sim, q=(0.16, 0.50, 0.84), weights=None, load_from_file = False, ndim = 3, type = 'lin',
+                 approximate=False, sketch_size=1000, **kwargs):
 
         # create a snapshot that only includes the section of disk we're
         # interested in
         self.quantiles = q
         self.qweights = weights
+        self._approximate = approximate
+        self._sketch_size = sketch_size
 
         Profile.__init__(
             self, sim, load_from_file=load_from_file, ndim=ndim, type=type, **kwargs)
@@ -987,48 +1519,272 @@ class QuantileProfile(Profile):
         else:
             raise KeyError(name + " is not a valid QuantileProfile")
 
+    def _generate_cache_key_base(self):
+        h = hashlib.new('md5')
+        h.update(Profile._generate_cache_key_base(self).encode())
+        h.update(repr((tuple(self.quantiles), self._approximate, self._sketch_size)).encode())
+        if self.qweights is not None:
+            h.update(np.ascontiguousarray(self.qweights))
+        return h.hexdigest()
+
+    def _bin_quantiles(self, values, weights=None):
+        """Return the requested quantiles of the per-particle *values* in every bin, as an (nbins, nquantiles) array.
+
+        Without weights, quantiles are linearly interpolated between the sorted values in each bin. With
+        weights, the value whose cumulative weight fraction is closest to the quantile is found, and a
+        correction proportional to the remaining weight fraction is applied towards its neighbour."""
+
+        q = np.asarray(self.quantiles, dtype=np.float64)
+        ind = self._sort_within_bins(values)
+        sorted_values = values[ind]
+
+        result = np.empty((self.nbins, len(q)))
+        result.fill(np.nan)
+
+        n = np.diff(self._bin_offsets)
+        nonempty = n > 0
+        start = self._bin_offsets[:-1][nonempty][:, np.newaxis]
+        end = self._bin_offsets[1:][nonempty][:, np.newaxis]
+
+        if weights is None:
+            topind = end - start - 1
+            position = q * topind
+            ilow = np.floor(position).astype(np.int64)
+            inc = position - ilow
+            lowval = sorted_values[start + ilow]
+            hival = sorted_values[start + np.minimum(ilow + 1, topind)]
+            result[nonempty] = lowval + inc * (hival - lowval)
+        else:
+            bin_number = self._sorted_bin_number()
+            cumw = np.cumsum(weights[ind], dtype=np.float64)
+            cumw_before = np.concatenate(([0], cumw))[self._bin_offsets]
+            bin_weight = np.diff(cumw_before)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                cumw = (cumw - cumw_before[:-1][bin_number]) / bin_weight[bin_number]
+
+            # locate the particle in each bin whose cumulative weight fraction is closest to q, searching
+            # all bins at once by offsetting the fractions by the bin number
+            bins = np.arange(self.nbins)[nonempty][:, np.newaxis]
+            above = np.searchsorted(bin_number + np.where(np.isnan(cumw), 1, cumw), bins + q, side='left')
+            above = np.clip(above, start, end - 1)
+            below = np.maximum(above - 1, start)
+            use_below = (above > start) & (np.abs(cumw[below] - q) <= np.abs(cumw[above] - q))
+            imin = np.where(use_below, below, above)
+
+            inc = q - cumw[imin]
+            lowval = sorted_values[imin]
+            nextval = np.where(inc > 0, sorted_values[np.minimum(imin + 1, end - 1)],
+                               sorted_values[np.maximum(imin - 1, start)])
+            result[nonempty] = lowval + inc * (nextval - lowval)
+            result[bin_weight == 0] = np.nan
+
+        return result
+
+    def _bin_quantiles_approximate(self, values, weights=None):
+        """Estimate the requested quantiles in every bin using a bounded-size quantile sketch per bin"""
+        chunk_size = config_parser.getint('profile', 'chunk-size')
+        result = np.empty((self.nbins, len(self.quantiles)))
+        for i, ind in enumerate(self.binind):
+            sketch = _QuantileSketch(self._sketch_size)
+            for chunk_start in range(0, len(ind), chunk_size):
+                chunk = ind[chunk_start:chunk_start + chunk_size]
+                sketch.add(values[chunk], None if weights is None else weights[chunk])
+            result[i] = sketch.quantile(self.quantiles)
+        return result
+
     def _auto_profile(self, name, dispersion=False, rms=False, median=False):
-        result = np.zeros((self.nbins, len(self.quantiles)))
-        for i in range(self.nbins):
-            subs = self.sim[self.binind[i]]
-            with self.sim.immediate_mode:
-                name_array = subs[name].view(np.ndarray)
-                sorted_array = sorted(name_array)
-                topind = len(name_array) - 1
-                if self.qweights is not None:
-                    sorted_weights = self.qweights[np.argsort(name_array)]
-
-            for iq, q in enumerate(self.quantiles):
-                #import pdb; pdb.set_trace()
-                if len(name_array) > 0:
-                    if self.qweights is None:
-                        ilow = int(np.floor(q * topind))
-                        inc = q * topind - ilow
-                        lowval = sorted_array[ilow]
-                        hival = sorted_array[ilow + 1]
-                        result[i, iq] = lowval + inc * (hival - lowval)
-                    else:
-                        cumw = np.cumsum(
-                            sorted_weights) / np.sum(sorted_weights)
-                        imin = min(
-                            np.arange(len(sorted_array)), key=lambda x: abs(cumw[x] - q))
-                        inc = q - cumw[imin]
-                        lowval = sorted_array[imin]
-                        if inc > 0:
-                            nextval = sorted_array[imin + 1]
-                        else:
-                            if imin == 0:
-                                nextval = lowval
-                            else:
-                                nextval = sorted_array[imin - 1]
-
-                        result[i, iq] = lowval + inc * (nextval - lowval)
-                        #if (result[i,iq] < 1e-6) : import pdb; pdb.set_trace()
-                else:
-                    result[i, iq] = np.nan
-                    self['rbins'][i] = np.nan
+        with self.sim.immediate_mode:
+            name_array = self.sim[name].view(np.ndarray)
+        weights = None if self.qweights is None else np.asarray(self.qweights)
+
+        if self._approximate:
+            result = self._bin_quantiles_approximate(name_array, weights)
+        else:
+            result = self._bin_quantiles(name_array, weights)
+
+        self['rbins'][np.diff(self._bin_offsets) == 0] = np.nan
 
         result = result.view(array.SimArray)
         result.units = self.sim[name].units
         result.sim = self.sim
         return result
+
+
+class StreamingProfile(Profile):
+
+    """
+
+    Creates a profile by accumulating over a sequence of blocks of particles,
+    without ever holding all the particles in memory at once.
+
+    Only the running per-bin sums needed for the requested profiles are stored, so
+    that means, dispersions and rms values come out the same as for an in-memory
+    :class:`Profile` of the same particles. Medians, if requested, are estimated from
+    a bounded-size mergeable sketch for each bin and are therefore approximate.
+
+    **Input**:
+
+    *blocks*: an iterable of SimSnap objects, for example slices of a snapshot or the
+     partial loads yielded by :func:`iterate_chunks`. It is consumed exactly once, during
+     construction.
+
+    *quantities*: the names of the arrays to profile. For each array, the mass-weighted
+     mean and the ``_disp`` and ``_rms`` profiles are then available.
+
+    **Optional Keywords**:
+
+    *ndim*, *type*, *calc_x*, *weight_by*, *rmin*, *rmax*, *nbins*, *bins*: as for
+     :class:`Profile`, except that the binning range cannot be inferred from the
+     particles, so either *bins* or both *rmin* and *rmax* must be given, and
+     *type* = 'equaln' is not available.
+
+    *medians* (default = False): if True, also generate ``_med`` profiles of each
+     quantity
+
+    *sketch_size* (default = 1000): the number of centroids kept per bin when
+     estimating medians. Bins with fewer particles than this have exact medians, using the
+     same convention as :class:`Profile` (the element at position floor(n/2) of the n sorted
+     values).
+
+    **Example:**
+
+    >>> p = pynbody.analysis.profile.StreamingProfile(
+    ...       pynbody.analysis.profile.iterate_chunks("snapshot"), ['temp'],
+    ...       ndim=3, type='log', rmin='0.1 kpc', rmax='100 kpc')
+    >>> p['temp_disp']
+
+    """
+
+    def __init__(self, blocks, quantities, ndim=2, type='lin', calc_x=None, weight_by='mass',
+                 medians=False, sketch_size=1000, **kwargs):
+
+        if calc_x is None:
+            calc_x = self._calculate_x
+
+        if 'bins' not in kwargs and not (('rmin' in kwargs or 'min' in kwargs) and
+                                         ('rmax' in kwargs or 'max' in kwargs)):
+            raise ValueError("A StreamingProfile requires either bins, or both rmin and rmax, to be specified")
+        if type == 'equaln':
+            raise ValueError("A StreamingProfile cannot use equaln binning")
+
+        self.sim = None
+        self.type = type
+        self.ndim = ndim
+        self._weight_by = weight_by
+        self._compact = True
+        self._cache = None
+        self._families = set()
+
+        blocks = iter(blocks)
+        first_block = next(blocks, None)
+        if first_block is None:
+            raise ValueError("No particle blocks were provided")
+
+        x = calc_x(first_block)
+        self._setup_bin_edges(x, first_block, kwargs)
+        self._setup_bins()
+
+        n = np.zeros(self.nbins, dtype=np.int64)
+        mass = np.zeros(self.nbins)
+        weight = np.zeros(self.nbins)
+        sums = np.zeros((len(quantities), self.nbins))
+        sq_sums = np.zeros((len(quantities), self.nbins))
+        if medians:
+            sketches = [[_QuantileSketch(sketch_size) for i in range(self.nbins)] for q in quantities]
+
+        block_units = None
+
+        def bin_sum(partbin, values=None):
+            return np.bincount(partbin, weights=values, minlength=self.nbins + 2)[1:self.nbins + 1]
+
+        for block in itertools.chain([first_block], blocks):
+            partbin = np.digitize(calc_x(block), self['bin_edges'])
+
+            with block.immediate_mode:
+                w = block[weight_by].view(np.ndarray)
+                m = block['mass'].view(np.ndarray)
+                if block_units is None:
+                    block_units = {'mass': block['mass'].units, 'weight_fn': block[weight_by].units}
+                    block_units.update({q: block[q].units for q in quantities})
+                block_arrays = [block[q].view(np.ndarray) for q in quantities]
+
+            self._families.update(block.families())
+
+            n += bin_sum(partbin).astype(np.int64)
+            mass += bin_sum(partbin, m)
+            weight += bin_sum(partbin, w)
+            for i, values in enumerate(block_arrays):
+                sums[i] += bin_sum(partbin, values * w)
+                sq_sums[i] += bin_sum(partbin, values ** 2 * w)
+
+            if medians:
+                order = np.argsort(partbin, kind='stable')
+                boundaries = np.searchsorted(partbin[order], np.arange(1, self.nbins + 2))
+                for i, values in enumerate(block_arrays):
+                    sorted_values = values[order]
+                    for j in range(self.nbins):
+                        if boundaries[j + 1] > boundaries[j]:
+                            sketches[i][j].add(sorted_values[boundaries[j]:boundaries[j + 1]])
+
+        self._profiles = {'n': n}
+        self._profiles['mass'] = array.SimArray(mass, block_units['mass'])
+        self._profiles['weight_fn'] = array.SimArray(weight, block_units['weight_fn'])
+
+        for i, q in enumerate(quantities):
+            with np.errstate(divide='ignore', invalid='ignore'):
+                mean = sums[i] / weight
+                sq_mean = sq_sums[i] / weight
+                disp = sq_mean - mean ** 2
+                # sq_mean<mean_sq occasionally from numerical roundoff
+                disp[disp < 0] = 0
+                self._profiles[q] = array.SimArray(mean, block_units[q])
+                self._profiles[q + '_disp'] = array.SimArray(np.sqrt(disp), block_units[q])
+                self._profiles[q + '_rms'] = array.SimArray(np.sqrt(sq_mean), block_units[q])
+            if medians:
+                self._profiles[q + '_med'] = array.SimArray([sk.median() for sk in sketches[i]],
+                                                            block_units[q])
+
+    def _setup_bin_index(self):
+        # particles are not retained, so there is no record of which particle is in which bin
+        self.binind = None
+        self.partbin = None
+
+    def _get_profile(self, name):
+        """Return the profile of a given kind"""
+        if name in self._profiles:
+            return self._profiles[name]
+        try:
+            return Profile._get_profile(self, name)
+        except AttributeError:
+            raise KeyError(name + " was not accumulated by this StreamingProfile, and cannot be derived from "
+                                  "the profiles that were")
+
+    def families(self):
+        """Returns the families of particles used"""
+        return sorted(self._families)
+
+    def write(self):
+        raise RuntimeError("A StreamingProfile cannot be written to disk")
+
+
+def iterate_chunks(sim, chunk_size=None, **kwargs):
+    """Yield successive blocks of particles from a snapshot, suitable for a :class:`StreamingProfile`
+
+    If *sim* is a SimSnap, the blocks are slices of it. If *sim* is a filename, each block is a
+    partial load of *chunk_size* consecutive particles from the file, so that only one block is ever
+    held in memory; any additional keyword arguments are passed to :func:`pynbody.load`. Partial
+    loading is only available for formats that support the *take* keyword.
+
+    By default the chunk size is taken from the ``chunk-size`` option in the ``[profile]`` section
+    of the configuration."""
+
+    if chunk_size is None:
+        chunk_size = config_parser.getint('profile', 'chunk-size')
+
+    if isinstance(sim, str):
+        npart = len(pynbody.load(sim, **kwargs))
+        for start in range(0, npart, chunk_size):
+            yield pynbody.load(sim, take=np.arange(start, min(start + chunk_size, npart)), **kwargs)
+    else:
+        for start in range(0, len(sim), chunk_size):
+            yield sim[start:start + chunk_size]
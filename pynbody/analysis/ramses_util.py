@@ -207,10 +207,9 @@ def convert_to_tipsy_fullbox(output, write_param=True):
     s['eps'] = s.g['smooth'].min()
     s['eps'].units = s['pos'].units
 
-    # try to load the potential array -- if it's not there, make it zeroes
-    try:
-        s['phi']
-    except KeyError:
+    # use the potential array from the output if there is one, otherwise make it zeroes (rather than
+    # letting the derived phi array calculate the potential of the whole snapshot)
+    if 'phi' not in s.keys() and 'phi' not in s.loadable_keys():
         s['phi'] = 0.0
 
     del(s.g['metal'])
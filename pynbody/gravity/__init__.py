@@ -1 +1,82 @@
+"""
+
+gravity
+=======
+
+Gravitational potential and acceleration calculations. The phi and accg derived arrays give the potential and
+acceleration of each particle due to all particles in the simulation, and are used whenever a snapshot does
+not store a potential. They are always calculated for the whole ancestor snapshot, even if requested for a
+subsnap such as a halo, which may be expensive; a warning is logged when this happens. See :mod:`pynbody.gravity.calc` for
+other routines, and :mod:`pynbody.gravity.multipole` for a potential that can be fitted once and then
+evaluated, or saved, independently of the particles.
+
+"""
+
+import logging
+import time
+import numpy as np
+
+from .. import snapshot, config_parser
+from ..util import get_eps
 from . import calc
+
+logger = logging.getLogger('pynbody.gravity')
+
+
+def _solver_for(n):
+    solver = config_parser.get('gravity', 'solver')
+    if solver != 'auto':
+        return solver
+    if n <= config_parser.getint('gravity', 'direct-max-particles'):
+        return 'direct'
+    elif n <= config_parser.getint('gravity', 'tree-max-particles'):
+        return 'tree'
+    else:
+        return 'treepm'
+
+
+def _gravity_field(sim):
+    """Return the potential and acceleration of each particle in sim, due to all particles in its ancestor.
+
+    The field of the whole ancestor is calculated once and kept until the positions, masses or softening
+    lengths change, so that phi and accg for the simulation and its subsnaps all come from one calculation."""
+    f = sim.ancestor
+
+    # access the inputs even if the field is already known, so that the derived arrays are recorded
+    # as depending on them
+    pos, mass, eps = f['pos'], f['mass'], get_eps(f)
+
+    field = getattr(f, '_gravity_field', None)
+    if field is None:
+        solver = _solver_for(len(f))
+        logger.warning("Calculating gravity for all %d particles of the snapshot using the %s solver, since "
+                       "phi or accg is not stored" % (len(f), solver))
+        start = time.time()
+        if solver == 'direct':
+            field = calc.direct(f, pos.view(np.ndarray), eps)
+        elif solver == 'tree':
+            field = calc.treecalc(f, None, eps)
+        elif solver == 'treepm':
+            field = calc.treepm(f, pos.view(np.ndarray), eps,
+                                ngrid=config_parser.getint('gravity', 'pm-ngrid'))
+        else:
+            raise ValueError("Unknown gravity solver %r" % solver)
+        logger.info("Gravity calculated in %5.3g s" % (time.time() - start))
+        f._gravity_field = field
+
+    if sim is f:
+        return field
+    index = sim.get_index_list(f)
+    return field[0][index], field[1][index]
+
+
+@snapshot.SimSnap.derived_quantity
+def phi(self):
+    """Gravitational potential, calculated with the solver given by the [gravity] section of the config"""
+    return _gravity_field(self)[0]
+
+
+@snapshot.SimSnap.derived_quantity
+def accg(self):
+    """Gravitational acceleration, calculated with the solver given by the [gravity] section of the config"""
+    return _gravity_field(self)[1]
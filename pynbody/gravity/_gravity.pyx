@@ -1,6 +1,7 @@
 #cython: embedsignature=True
 
 cimport cython
+from libc.stdlib cimport malloc, realloc, free
 from pynbody import units, array, config, openmp
 from pynbody.util import get_eps
 import numpy as np
@@ -14,19 +15,61 @@ ctypedef fused DTYPE_t:
 cdef extern from "math.h" nogil:
       double sqrt(double)
       float sqrt(float)
+      double floor(double)
+      double erf(double)
+      double exp(double)
 
 
-@cython.cdivision(True)
-@cython.boundscheck(False)
-def direct(f, np.ndarray[DTYPE_t, ndim=2] ipos, eps=None, int num_threads = 0):
+cdef extern from "direct_kernel.h" nogil:
+    void direct_tile_float(const float *x, const float *y, const float *z, const float *m, const float *eps2,
+                           long n_sources, const float *points, long n_points, float *phi, float *acc)
+    void direct_tile_double(const double *x, const double *y, const double *z, const double *m,
+                            const double *eps2, long n_sources, const double *points, long n_points,
+                            double *phi, double *acc)
 
+DEF _DIRECT_POINT_TILE = 64
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef void _direct_sum(DTYPE_t[:,::1] sources, DTYPE_t[:,::1] points, DTYPE_t[::1] phi, DTYPE_t[:,::1] acc,
+                      int num_threads):
     from cython.parallel cimport prange
 
-    global config
+    cdef Py_ssize_t n_sources = sources.shape[1], n_points = points.shape[0]
+    cdef Py_ssize_t n_tiles = (n_points + _DIRECT_POINT_TILE - 1)//_DIRECT_POINT_TILE, tile, start, length
+
+    for tile in prange(n_tiles, nogil=True, schedule='dynamic', num_threads=num_threads):
+        start = tile*_DIRECT_POINT_TILE
+        length = min(_DIRECT_POINT_TILE, n_points - start)
+        if DTYPE_t is np.float32_t:
+            direct_tile_float(&sources[0,0], &sources[1,0], &sources[2,0], &sources[3,0], &sources[4,0],
+                              n_sources, &points[start,0], length, &phi[start], &acc[start,0])
+        else:
+            direct_tile_double(&sources[0,0], &sources[1,0], &sources[2,0], &sources[3,0], &sources[4,0],
+                               n_sources, &points[start,0], length, &phi[start], &acc[start,0])
+
+
+def direct(f, ipos, eps=None, int num_threads = 0, accumulate=None):
+    """Calculate the potential and acceleration at positions ipos by direct summation over the particles in f.
 
+    The sum is blocked so that each group of particles is reused from cache by many points, and is spread
+    over threads by point. It is efficient for many thousands of points.
+
+    **Optional Keywords:**
+
+    *eps* (None): softening, defaulting to the softening of the particles in f (see pynbody.util.get_eps)
+
+    *num_threads* (0): number of threads, defaulting to the number_of_threads configuration option
+
+    *accumulate* (None): floating point type used for the calculation, np.float32 or np.float64 (the default).
+     Single precision is about twice as fast, but loses accuracy when summing over many particles.
+
+    Returns pot, accel with the dtype of ipos"""
+
+    global config
 
     if num_threads == 0 :
-        num_threads = np.int(config["number_of_threads"])
+        num_threads = int(config["number_of_threads"])
 
     if num_threads < 0:
         num_threads = openmp.get_cpus()
@@ -39,38 +82,616 @@ def direct(f, np.ndarray[DTYPE_t, ndim=2] ipos, eps=None, int num_threads = 0):
     if eps is None:
         eps = get_eps(f)
 
-    cdef unsigned int nips = len(ipos)
-    cdef np.ndarray[DTYPE_t, ndim=2] m_by_r2 = np.zeros((nips,3), dtype = ipos.dtype)
-    cdef np.ndarray[DTYPE_t, ndim=1] m_by_r = np.zeros(nips, dtype = ipos.dtype)
-    cdef np.ndarray[DTYPE_t, ndim=2] pos = f['pos'].view(np.ndarray)
-    cdef np.ndarray[DTYPE_t, ndim=1] mass = f['mass'].view(np.ndarray)
-    cdef unsigned int n = len(mass)
-    cdef np.ndarray[DTYPE_t, ndim=1] epssq = eps * eps
-
-    cdef unsigned int pi, i
-    cdef double dx, dy, dz, mass_i, epssq_i, drsoft, drsoft3
-
-    for pi in prange(nips, nogil=True, schedule='static'):
-        for i in range(n):
-            mass_i = mass[i]
-            epssq_i = epssq[i]
-            dx = ipos[pi,0] - pos[i,0]
-            dy = ipos[pi,1] - pos[i,1]
-            dz = ipos[pi,2] - pos[i,2]
-            drsoft = 1.0/sqrt(dx*dx + dy*dy + dz*dz + epssq_i)
-            drsoft3 = drsoft*drsoft*drsoft
-            m_by_r[pi] += mass_i * drsoft
-            m_by_r2[pi,0] += mass_i*dx * drsoft3
-            m_by_r2[pi,1] += mass_i*dy * drsoft3
-            m_by_r2[pi,2] += mass_i*dz * drsoft3
-
-
-    m_by_r = m_by_r.view(array.SimArray)
-    m_by_r2 = m_by_r2.view(array.SimArray)
+    dtype = np.dtype(np.float64 if accumulate is None else accumulate)
+    if dtype not in (np.float32, np.float64):
+        raise ValueError("Direct summation can only accumulate in float32 or float64")
+
+    ipos = np.asarray(ipos)
+    pos = f['pos'].view(np.ndarray)
+    cdef Py_ssize_t n = len(pos), nips = len(ipos)
+
+    # the particles as separate contiguous x, y, z, mass and squared softening arrays
+    sources = np.empty((5, n), dtype=dtype)
+    sources[:3] = pos.T
+    sources[3] = f['mass'].view(np.ndarray)
+    sources[4] = np.broadcast_to(np.asarray(eps, dtype=dtype), (n,)) ** 2
+
+    points = np.ascontiguousarray(ipos, dtype=dtype).reshape((nips, 3))
+    m_by_r = np.zeros(nips, dtype=dtype)
+    m_by_r2 = np.zeros((nips, 3), dtype=dtype)
+
+    if nips>0 and n>0:
+        if dtype == np.float32:
+            _direct_sum[np.float32_t](sources, points, m_by_r, m_by_r2, num_threads)
+        else:
+            _direct_sum[np.float64_t](sources, points, m_by_r, m_by_r2, num_threads)
+
+    m_by_r = m_by_r.astype(ipos.dtype, copy=False).view(array.SimArray)
+    m_by_r2 = m_by_r2.astype(ipos.dtype, copy=False).view(array.SimArray)
     m_by_r.units = f['mass'].units/f['pos'].units
     m_by_r2.units = f['mass'].units/f['pos'].units**2
 
     m_by_r*=units.G
     m_by_r2*=units.G
 
-    return -m_by_r, -m_by_r2
+    return m_by_r, m_by_r2
+
+
+# Tree gravity. The tree is a binary tree whose cells are made by repeatedly halving a cube (see
+# build_tree). Node 0 is the root; each node owns a contiguous range of particles stored in tree order and
+# its children are given by left and right (-1 for leaves). Children always have larger indices than their
+# parents. Nodes carry monopole and quadrupole moments.
+
+DEF _TREE_STACK_SIZE = 256
+
+cdef inline void _append(Py_ssize_t **buffer, Py_ssize_t *n, Py_ssize_t *capacity, Py_ssize_t value) nogil:
+    if n[0]==capacity[0]:
+        capacity[0] *= 2
+        buffer[0] = <Py_ssize_t*>realloc(buffer[0], capacity[0]*sizeof(Py_ssize_t))
+    buffer[0][n[0]] = value
+    n[0] += 1
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def build_tree(np.ndarray[np.uint64_t, ndim=1] keys, int leafsize):
+    """Build the tree topology from sorted Morton keys.
+
+    Each node is split at the highest key bit that differs between its particles, so that its children
+    are halves of the node's cell. Nodes whose particles all share one key are split by count instead.
+
+    Returns lower, upper (the first and last particle of each node), left and right (the children of each
+    node, or -1 for leaves)."""
+
+    cdef Py_ssize_t n = len(keys)
+    cdef Py_ssize_t capacity = 16, n_nodes = 1
+    cdef Py_ssize_t *node_range = <Py_ssize_t*>malloc(4*capacity*sizeof(Py_ssize_t))
+    cdef Py_ssize_t stack[_TREE_STACK_SIZE]
+    cdef int bit_stack[_TREE_STACK_SIZE]
+    cdef int sp = 1, bit
+    cdef Py_ssize_t node, lo, hi, mid, a, b, child
+    cdef np.uint64_t mask
+
+    if n==0:
+        raise ValueError("Cannot build a tree with no particles")
+    if leafsize<1:
+        raise ValueError("The leaf size must be at least one")
+
+    with nogil:
+        node_range[0] = 0
+        node_range[1] = n-1
+        node_range[2] = -1
+        node_range[3] = -1
+        stack[0] = 0
+        bit_stack[0] = 63
+
+        while sp>0:
+            sp -= 1
+            node = stack[sp]
+            bit = bit_stack[sp]
+            lo = node_range[4*node]
+            hi = node_range[4*node+1]
+            if hi-lo<leafsize:
+                continue
+
+            while bit>=0:
+                mask = (<np.uint64_t>1)<<bit
+                if (keys[lo]&mask)!=(keys[hi]&mask):
+                    break
+                bit -= 1
+
+            if bit>=0:
+                # the keys share all higher bits, so find the first with this bit set by bisection
+                a = lo
+                b = hi
+                while b-a>1:
+                    mid = (a+b)//2
+                    if keys[mid]&mask:
+                        b = mid
+                    else:
+                        a = mid
+                mid = b
+            else:
+                mid = (lo+hi+1)//2
+
+            if n_nodes+2>capacity:
+                capacity *= 2
+                node_range = <Py_ssize_t*>realloc(node_range, 4*capacity*sizeof(Py_ssize_t))
+
+            for child in range(2):
+                node_range[4*(n_nodes+child)] = lo if child==0 else mid
+                node_range[4*(n_nodes+child)+1] = mid-1 if child==0 else hi
+                node_range[4*(n_nodes+child)+2] = -1
+                node_range[4*(n_nodes+child)+3] = -1
+                node_range[4*node+2+child] = n_nodes+child
+                stack[sp] = n_nodes+child
+                bit_stack[sp] = bit-1 if bit>=0 else -1
+                sp += 1
+            n_nodes += 2
+
+    result = np.empty((n_nodes, 4), dtype=np.intp)
+    for node in range(n_nodes):
+        for child in range(4):
+            result[node, child] = node_range[4*node+child]
+    free(node_range)
+
+    return (np.ascontiguousarray(result[:,0]), np.ascontiguousarray(result[:,1]),
+            np.ascontiguousarray(result[:,2]), np.ascontiguousarray(result[:,3]))
+
+
+@cython.cdivision(True)
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def tree_moments(np.ndarray[np.intp_t, ndim=1] lower, np.ndarray[np.intp_t, ndim=1] upper,
+                 np.ndarray[np.intp_t, ndim=1] left, np.ndarray[np.intp_t, ndim=1] right,
+                 np.ndarray[np.float64_t, ndim=2, mode='c'] pos, np.ndarray[np.float64_t, ndim=1] mass,
+                 np.ndarray[np.float64_t, ndim=1] eps2, double theta):
+    """Calculate the moments of each tree node from particles in tree order.
+
+    Returns the centre of mass (n_nodes x 3), mass, quadrupole (n_nodes x 7: the traceless quadrupole about
+    the centre of mass in the order xx, yy, zz, xy, xz, yz, followed by the trace of the second moment, which
+    is needed for the softened expansion), mass-weighted squared softening and the squared distance from the
+    centre of mass within which the node must be opened."""
+
+    cdef Py_ssize_t n_nodes = len(lower)
+    cdef np.ndarray[np.float64_t, ndim=2] node_com = np.zeros((n_nodes, 3))
+    cdef np.ndarray[np.float64_t, ndim=1] node_mass = np.zeros(n_nodes)
+    cdef np.ndarray[np.float64_t, ndim=2] node_quad = np.zeros((n_nodes, 7))
+    cdef np.ndarray[np.float64_t, ndim=1] node_eps2 = np.zeros(n_nodes)
+    cdef np.ndarray[np.float64_t, ndim=1] node_open2 = np.zeros(n_nodes)
+    cdef np.ndarray[np.float64_t, ndim=1] node_bmax = np.zeros(n_nodes)
+    cdef np.ndarray[np.float64_t, ndim=1] node_epsmax = np.zeros(n_nodes)
+    cdef np.ndarray[np.float64_t, ndim=1] node_epsmin = np.full(n_nodes, np.inf)
+    cdef np.ndarray[np.float64_t, ndim=2] node_min = np.full((n_nodes, 3), np.inf)
+    cdef np.ndarray[np.float64_t, ndim=2] node_max = np.full((n_nodes, 3), -np.inf)
+
+    cdef Py_ssize_t node, child, i, k
+    cdef double m, m_tot, d2, b, trace, r_open
+    cdef double d[3]
+
+    with nogil:
+        for node in range(n_nodes-1, -1, -1):
+            if left[node]>=0:
+                m_tot = node_mass[left[node]] + node_mass[right[node]]
+                for k in range(3):
+                    if m_tot>0:
+                        node_com[node,k] = (node_mass[left[node]]*node_com[left[node],k] +
+                                            node_mass[right[node]]*node_com[right[node],k])/m_tot
+                    else:
+                        node_com[node,k] = 0.5*(node_com[left[node],k] + node_com[right[node],k])
+                for i in range(2):
+                    child = left[node] if i==0 else right[node]
+                    m = node_mass[child]
+                    d2 = 0
+                    for k in range(3):
+                        d[k] = node_com[child,k] - node_com[node,k]
+                        d2 += d[k]*d[k]
+                    # second moments about the node centre of mass (parallel axis theorem)
+                    node_quad[node,0] += node_quad[child,0] + m*d[0]*d[0]
+                    node_quad[node,1] += node_quad[child,1] + m*d[1]*d[1]
+                    node_quad[node,2] += node_quad[child,2] + m*d[2]*d[2]
+                    node_quad[node,3] += node_quad[child,3] + m*d[0]*d[1]
+                    node_quad[node,4] += node_quad[child,4] + m*d[0]*d[2]
+                    node_quad[node,5] += node_quad[child,5] + m*d[1]*d[2]
+                    node_eps2[node] += node_eps2[child]
+                    b = sqrt(d2) + node_bmax[child]
+                    if b>node_bmax[node]:
+                        node_bmax[node] = b
+                    if node_epsmax[child]>node_epsmax[node]:
+                        node_epsmax[node] = node_epsmax[child]
+                    if node_epsmin[child]<node_epsmin[node]:
+                        node_epsmin[node] = node_epsmin[child]
+                    for k in range(3):
+                        if node_min[child,k]<node_min[node,k]:
+                            node_min[node,k] = node_min[child,k]
+                        if node_max[child,k]>node_max[node,k]:
+                            node_max[node,k] = node_max[child,k]
+            else:
+                m_tot = 0
+                for i in range(lower[node], upper[node]+1):
+                    m_tot += mass[i]
+                for k in range(3):
+                    node_com[node,k] = 0
+                    for i in range(lower[node], upper[node]+1):
+                        if m_tot>0:
+                            node_com[node,k] += mass[i]*pos[i,k]
+                        else:
+                            node_com[node,k] += pos[i,k]
+                    if m_tot>0:
+                        node_com[node,k] /= m_tot
+                    else:
+                        node_com[node,k] /= (upper[node]-lower[node]+1)
+                for i in range(lower[node], upper[node]+1):
+                    m = mass[i]
+                    d2 = 0
+                    for k in range(3):
+                        d[k] = pos[i,k] - node_com[node,k]
+                        d2 += d[k]*d[k]
+                    node_quad[node,0] += m*d[0]*d[0]
+                    node_quad[node,1] += m*d[1]*d[1]
+                    node_quad[node,2] += m*d[2]*d[2]
+                    node_quad[node,3] += m*d[0]*d[1]
+                    node_quad[node,4] += m*d[0]*d[2]
+                    node_quad[node,5] += m*d[1]*d[2]
+                    node_eps2[node] += m*eps2[i]
+                    if sqrt(d2)>node_bmax[node]:
+                        node_bmax[node] = sqrt(d2)
+                    if sqrt(eps2[i])>node_epsmax[node]:
+                        node_epsmax[node] = sqrt(eps2[i])
+                    if sqrt(eps2[i])<node_epsmin[node]:
+                        node_epsmin[node] = sqrt(eps2[i])
+                    for k in range(3):
+                        if pos[i,k]<node_min[node,k]:
+                            node_min[node,k] = pos[i,k]
+                        if pos[i,k]>node_max[node,k]:
+                            node_max[node,k] = pos[i,k]
+
+            node_mass[node] = m_tot
+
+            if left[node]>=0:
+                # the bound from the children can be loose; the distance to the furthest corner of the
+                # bounding box is sometimes tighter
+                d2 = 0
+                for k in range(3):
+                    b = max(node_com[node,k]-node_min[node,k], node_max[node,k]-node_com[node,k])
+                    d2 += b*b
+                if sqrt(d2)<node_bmax[node]:
+                    node_bmax[node] = sqrt(d2)
+
+        # Second pass (top-down order is irrelevant) to turn sums into final moments. This cannot be
+        # merged with the loop above because parents need their children's raw second moments.
+        for node in range(n_nodes):
+            if node_mass[node]>0:
+                node_eps2[node] /= node_mass[node]
+            trace = node_quad[node,0] + node_quad[node,1] + node_quad[node,2]
+            for k in range(6):
+                node_quad[node,k] *= 3
+            for k in range(3):
+                node_quad[node,k] -= trace
+            node_quad[node,6] = trace
+            # Barnes-Hut criterion. The expansion of the Plummer-softened potential is accurate within the
+            # softening length if all particles in the node share the same softening; otherwise, never accept
+            # a node if the softened region of any of its particles could reach the point.
+            r_open = node_bmax[node]/theta
+            if node_epsmax[node] > node_epsmin[node]*(1+1e-6) and node_bmax[node] + 2*node_epsmax[node] > r_open:
+                r_open = node_bmax[node] + 2*node_epsmax[node]
+            node_open2[node] = r_open*r_open
+
+    return node_com, node_mass, node_quad, node_eps2, node_open2
+
+
+@cython.cdivision(True)
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef void _tree_walk_group(double *ipos, Py_ssize_t n_points, double *centre, double radius,
+                           np.intp_t *lower, np.intp_t *upper, np.intp_t *left, np.intp_t *right,
+                           double *pos, double *mass, double *eps2, double *node_com, double *node_mass,
+                           double *node_quad, double *node_eps2, double *node_open2,
+                           double *phi_out, double *acc_out) nogil:
+    # Walk the tree once for a group of points lying within radius of centre, building a list of
+    # nodes far enough from every point to use their multipole expansion, and a list of leaves
+    # whose particles must be summed directly. Then apply both lists to each point.
+    cdef int stack[_TREE_STACK_SIZE]
+    cdef int sp = 1
+    cdef Py_ssize_t node, i, j, k, cell_capacity = 256, leaf_capacity = 256
+    cdef Py_ssize_t *cells = <Py_ssize_t*>malloc(cell_capacity*sizeof(Py_ssize_t))
+    cdef Py_ssize_t *leaves = <Py_ssize_t*>malloc(leaf_capacity*sizeof(Py_ssize_t))
+    cdef Py_ssize_t n_cells = 0, n_leaves = 0
+    cdef double x, y, z, dx, dy, dz, d, inv_r, inv_r2, inv_r3, inv_r5, m, qx, qy, qz, dqd, e2
+    cdef double *q
+    cdef double phi, ax, ay, az
+
+    stack[0] = 0
+    while sp>0:
+        sp -= 1
+        node = stack[sp]
+        dx = centre[0] - node_com[3*node]
+        dy = centre[1] - node_com[3*node+1]
+        dz = centre[2] - node_com[3*node+2]
+        d = sqrt(dx*dx + dy*dy + dz*dz) - radius
+        if d>0 and d*d>node_open2[node]:
+            _append(&cells, &n_cells, &cell_capacity, node)
+        elif left[node]>=0:
+            stack[sp] = left[node]
+            stack[sp+1] = right[node]
+            sp += 2
+        else:
+            _append(&leaves, &n_leaves, &leaf_capacity, node)
+
+    for j in range(n_points):
+        x = ipos[3*j]
+        y = ipos[3*j+1]
+        z = ipos[3*j+2]
+        phi = 0
+        ax = 0
+        ay = 0
+        az = 0
+
+        for k in range(n_cells):
+            node = cells[k]
+            dx = x - node_com[3*node]
+            dy = y - node_com[3*node+1]
+            dz = z - node_com[3*node+2]
+            e2 = node_eps2[node]
+            m = node_mass[node]
+            inv_r2 = 1.0/(dx*dx + dy*dy + dz*dz + e2)
+            inv_r = sqrt(inv_r2)
+            inv_r3 = inv_r*inv_r2
+            inv_r5 = inv_r3*inv_r2
+            phi -= m*inv_r
+            ax -= m*dx*inv_r3
+            ay -= m*dy*inv_r3
+            az -= m*dz*inv_r3
+
+            # quadrupole term of the Plummer-softened potential
+            q = &node_quad[7*node]
+            qx = q[0]*dx + q[3]*dy + q[4]*dz
+            qy = q[3]*dx + q[1]*dy + q[5]*dz
+            qz = q[4]*dx + q[5]*dy + q[2]*dz
+            dqd = dx*qx + dy*qy + dz*qz - q[6]*e2
+            phi -= 0.5*dqd*inv_r5
+            ax += (qx - 2.5*dqd*dx*inv_r2)*inv_r5
+            ay += (qy - 2.5*dqd*dy*inv_r2)*inv_r5
+            az += (qz - 2.5*dqd*dz*inv_r2)*inv_r5
+
+        for k in range(n_leaves):
+            node = leaves[k]
+            for i in range(lower[node], upper[node]+1):
+                dx = x - pos[3*i]
+                dy = y - pos[3*i+1]
+                dz = z - pos[3*i+2]
+                inv_r = 1.0/sqrt(dx*dx + dy*dy + dz*dz + eps2[i])
+                inv_r3 = inv_r*inv_r*inv_r
+                phi -= mass[i]*inv_r
+                ax -= mass[i]*dx*inv_r3
+                ay -= mass[i]*dy*inv_r3
+                az -= mass[i]*dz*inv_r3
+
+        phi_out[j] = phi
+        acc_out[3*j] = ax
+        acc_out[3*j+1] = ay
+        acc_out[3*j+2] = az
+
+    free(cells)
+    free(leaves)
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def tree_walk(np.ndarray[np.intp_t, ndim=1, mode='c'] lower, np.ndarray[np.intp_t, ndim=1, mode='c'] upper,
+              np.ndarray[np.intp_t, ndim=1, mode='c'] left, np.ndarray[np.intp_t, ndim=1, mode='c'] right,
+              np.ndarray[np.float64_t, ndim=2, mode='c'] pos, np.ndarray[np.float64_t, ndim=1, mode='c'] mass,
+              np.ndarray[np.float64_t, ndim=1, mode='c'] eps2,
+              np.ndarray[np.float64_t, ndim=2, mode='c'] node_com,
+              np.ndarray[np.float64_t, ndim=1, mode='c'] node_mass,
+              np.ndarray[np.float64_t, ndim=2, mode='c'] node_quad,
+              np.ndarray[np.float64_t, ndim=1, mode='c'] node_eps2,
+              np.ndarray[np.float64_t, ndim=1, mode='c'] node_open2,
+              np.ndarray[np.float64_t, ndim=2, mode='c'] ipos,
+              np.ndarray[np.intp_t, ndim=1, mode='c'] group_boundaries,
+              np.ndarray[np.float64_t, ndim=2, mode='c'] group_centre,
+              np.ndarray[np.float64_t, ndim=1, mode='c'] group_radius,
+              int num_threads=1):
+    """Walk the tree to find the potential and acceleration (with G=1) at each of the points ipos.
+
+    The points are processed in groups; group i consists of ipos[group_boundaries[i]:group_boundaries[i+1]],
+    all of which must lie within group_radius[i] of group_centre[i]. Compact groups of a few tens of points
+    give the best performance."""
+
+    from cython.parallel cimport prange
+
+    cdef Py_ssize_t nips = len(ipos), n_groups = len(group_radius), gi, start
+    cdef np.ndarray[np.float64_t, ndim=1] phi = np.empty(nips)
+    cdef np.ndarray[np.float64_t, ndim=2] acc = np.empty((nips, 3))
+
+    if nips==0:
+        return phi, acc
+
+    if len(group_boundaries)!=n_groups+1 or group_boundaries[0]!=0 or group_boundaries[n_groups]!=nips:
+        raise ValueError("Group boundaries do not match the number of points")
+
+    for gi in prange(n_groups, nogil=True, schedule='dynamic', num_threads=num_threads):
+        start = group_boundaries[gi]
+        _tree_walk_group(&ipos[start,0], group_boundaries[gi+1]-start, &group_centre[gi,0], group_radius[gi],
+                         &lower[0], &upper[0], &left[0], &right[0], &pos[0,0], &mass[0], &eps2[0], &node_com[0,0],
+                         &node_mass[0], &node_quad[0,0], &node_eps2[0], &node_open2[0],
+                         &phi[start], &acc[start,0])
+
+    return phi, acc
+
+
+# Particle-mesh assignment and interpolation. Cell i of the mesh spans [x0 + i dx, x0 + (i+1) dx) along each
+# axis; order 1, 2 and 3 are the nearest grid point, cloud in cell and triangular shaped cloud schemes.
+
+@cython.cdivision(True)
+cdef inline int _mesh_stencil(double u, int order, int *index, double *weight) nogil:
+    cdef int i
+    cdef double d
+    if order==1:
+        index[0] = <int>floor(u)
+        weight[0] = 1.0
+        return 1
+    u -= 0.5
+    if order==2:
+        i = <int>floor(u)
+        d = u - i
+        index[0] = i
+        index[1] = i+1
+        weight[0] = 1.0-d
+        weight[1] = d
+        return 2
+    i = <int>floor(u+0.5)
+    d = u - i
+    index[0] = i-1
+    index[1] = i
+    index[2] = i+1
+    weight[0] = 0.5*(0.5-d)*(0.5-d)
+    weight[1] = 0.75-d*d
+    weight[2] = 0.5*(0.5+d)*(0.5+d)
+    return 3
+
+
+@cython.cdivision(True)
+cdef inline void _mesh_wrap(int *index, int n_index, int n_mesh, bint periodic) nogil:
+    # map the stencil onto the mesh; cells off the edge of a non-periodic mesh are flagged with -1
+    cdef int i
+    for i in range(n_index):
+        if periodic:
+            index[i] = index[i]%n_mesh
+            if index[i]<0:
+                index[i] += n_mesh
+        elif index[i]<0 or index[i]>=n_mesh:
+            index[i] = -1
+
+
+@cython.cdivision(True)
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef double _mesh_interpolate_one(const double *mesh, const double *point, const double *x0, double dx,
+                                  int order, bint periodic, int n_mesh) nogil:
+    cdef int index[3][3]
+    cdef double weight[3][3]
+    cdef int n_index, i, j, k, d
+    cdef double value = 0
+
+    for d in range(3):
+        n_index = _mesh_stencil((point[d]-x0[d])/dx, order, index[d], weight[d])
+        _mesh_wrap(index[d], n_index, n_mesh, periodic)
+
+    for i in range(n_index):
+        if index[0][i]<0:
+            continue
+        for j in range(n_index):
+            if index[1][j]<0:
+                continue
+            for k in range(n_index):
+                if index[2][k]<0:
+                    continue
+                value += mesh[(<Py_ssize_t>index[0][i]*n_mesh + index[1][j])*n_mesh + index[2][k]] * \
+                         weight[0][i]*weight[1][j]*weight[2][k]
+    return value
+
+
+@cython.cdivision(True)
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def mesh_assign(const np.float64_t[:,::1] pos, const np.float64_t[::1] mass, np.float64_t[:,:,::1] mesh,
+                const np.float64_t[::1] x0, double dx, int order, bint periodic):
+    """Add the mass of each particle to the mesh using the given assignment scheme (1=NGP, 2=CIC, 3=TSC).
+
+    Returns the number of particles lying outside a non-periodic mesh, which are ignored."""
+    cdef Py_ssize_t n = len(mass), pi
+    cdef int n_mesh = mesh.shape[0], n_index, i, j, k, d
+    cdef int index[3][3]
+    cdef double weight[3][3]
+    cdef double u
+    cdef Py_ssize_t n_outside = 0
+    cdef bint outside
+
+    with nogil:
+        for pi in range(n):
+            outside = False
+            for d in range(3):
+                u = (pos[pi,d]-x0[d])/dx
+                if not periodic and (u<0 or u>=n_mesh):
+                    outside = True
+                n_index = _mesh_stencil(u, order, index[d], weight[d])
+                _mesh_wrap(index[d], n_index, n_mesh, periodic)
+            if outside:
+                n_outside += 1
+                continue
+            for i in range(n_index):
+                if index[0][i]<0:
+                    continue
+                for j in range(n_index):
+                    if index[1][j]<0:
+                        continue
+                    for k in range(n_index):
+                        if index[2][k]<0:
+                            continue
+                        mesh[index[0][i], index[1][j], index[2][k]] += mass[pi]*weight[0][i]*weight[1][j]*weight[2][k]
+
+    return n_outside
+
+
+@cython.cdivision(True)
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def mesh_interpolate(const np.float64_t[:,:,::1] mesh, const np.float64_t[:,::1] ipos,
+                     const np.float64_t[::1] x0, double dx, int order, bint periodic, int num_threads=1):
+    """Interpolate the mesh to each of the points ipos using the given assignment scheme (1=NGP, 2=CIC, 3=TSC).
+
+    Cells off the edge of a non-periodic mesh are taken to be zero."""
+    from cython.parallel cimport prange
+
+    cdef Py_ssize_t n = len(ipos), pi
+    cdef np.ndarray[np.float64_t, ndim=1] result = np.zeros(n)
+    cdef np.float64_t[::1] result_view = result
+    cdef int n_mesh = mesh.shape[0]
+
+    if n==0:
+        return result
+
+    for pi in prange(n, nogil=True, schedule='static', num_threads=num_threads):
+        result_view[pi] = _mesh_interpolate_one(&mesh[0,0,0], &ipos[pi,0], &x0[0], dx, order, periodic, n_mesh)
+
+    return result
+
+
+@cython.cdivision(True)
+cdef inline double _nearest_image(double d, double period) nogil:
+    if period>0:
+        return d - period*floor(d/period + 0.5)
+    return d
+
+
+@cython.cdivision(True)
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def short_range_sum(const np.float64_t[:,::1] ipos, const np.float64_t[:,::1] pos, const np.float64_t[::1] mass,
+                    const np.float64_t[::1] eps2, const np.intp_t[::1] offsets, const np.intp_t[::1] indices,
+                    double split_scale, double period, int num_threads=1):
+    """Sum the short-range part of the potential and acceleration (with G=1) at each of the points ipos.
+
+    The particles around point i are indices[offsets[i]:offsets[i+1]]. The short-range kernel is the
+    Plummer-softened Newtonian kernel minus the long-range part erf(r/(2 split_scale))/r calculated by a PM
+    solver. If period is positive, the nearest periodic image of each particle is used."""
+    from cython.parallel cimport prange
+
+    cdef Py_ssize_t n = len(ipos), pi, i, j
+    cdef np.ndarray[np.float64_t, ndim=1] phi = np.zeros(n)
+    cdef np.ndarray[np.float64_t, ndim=2] acc = np.zeros((n, 3))
+    cdef np.float64_t[::1] phi_view = phi
+    cdef np.float64_t[:,::1] acc_view = acc
+    # scalars assigned inside the prange are private to each thread; a C array would be shared
+    cdef double dx, dy, dz, r, r2, inv_rsoft, inv_rsoft3, phi_long, force_long, x, f
+    cdef double sqrt_pi = sqrt(np.pi)
+
+    if n==0:
+        return phi, acc
+
+    for pi in prange(n, nogil=True, schedule='dynamic', num_threads=num_threads):
+        for i in range(offsets[pi], offsets[pi+1]):
+            j = indices[i]
+            dx = _nearest_image(ipos[pi,0] - pos[j,0], period)
+            dy = _nearest_image(ipos[pi,1] - pos[j,1], period)
+            dz = _nearest_image(ipos[pi,2] - pos[j,2], period)
+            r2 = dx*dx + dy*dy + dz*dz
+            r = sqrt(r2)
+            inv_rsoft = 1.0/sqrt(r2 + eps2[j])
+            inv_rsoft3 = inv_rsoft*inv_rsoft*inv_rsoft
+            x = r/(2*split_scale)
+            if x<1e-3:
+                # series expansion of the long-range kernel near the origin
+                phi_long = (1 - x*x/3)/(split_scale*sqrt_pi)
+                force_long = 1.0/(6*split_scale*split_scale*split_scale*sqrt_pi)
+            else:
+                phi_long = erf(x)/r
+                force_long = (erf(x) - 2*x*exp(-x*x)/sqrt_pi)/(r*r2)
+            phi_view[pi] -= mass[j]*(inv_rsoft - phi_long)
+            f = mass[j]*(inv_rsoft3 - force_long)
+            acc_view[pi,0] -= dx*f
+            acc_view[pi,1] -= dy*f
+            acc_view[pi,2] -= dz*f
+
+    return phi, acc
@@ -3,8 +3,10 @@ from .. import array
 from .. import config
 from ..util import get_eps, eps_as_simarray
 
-import math
 from . import tree
+from . import pm as pm_module
+from . import multipole as multipole_module
+from . import _gravity
 import numpy as np
 
 import warnings
@@ -18,64 +20,198 @@ def all_direct(f, eps=None):
     f['acc'] = acc
 
 
-def all_pm(f, eps=None, ngrid=10):
-    phi, acc = pm(f, f['pos'].view(np.ndarray), eps, ngrid=ngrid)
+def all_tree(f, eps=None, theta=None):
+    phi, acc = treecalc(f, None, eps, theta)
     f['phi'] = phi
     f['acc'] = acc
 
 
-def pm(f, ipos, eps=None, ngrid=10, x0=-1, x1=1):
-    dx = float(x1 - x0) / ngrid
-    grid, edges = np.histogramdd(f['pos'],
-                                 bins=ngrid,
-                                 range=[(x0, x1), (x0, x1), (x0, x1)],
-                                 normed=False,
-                                 weights=f['mass'])
-    grid /= dx ** 3
-    recip_rho_grid = np.fft.rfftn(grid)
+def all_pm(f, eps=None, ngrid=64, **kwargs):
+    phi, acc = pm(f, f['pos'].view(np.ndarray), eps, ngrid=ngrid, **kwargs)
+    f['phi'] = phi
+    f['acc'] = acc
 
-    freqs = np.fft.fftfreq(ngrid, d=dx)
 
-    kvecs = np.zeros((ngrid, ngrid, ngrid / 2 + 1, 3))
-    kvecs[:, :,:, 0] = freqs.reshape((1, ngrid, 1, 1))
-    kvecs[:, :,:, 1] = freqs.reshape((1, 1, ngrid, 1))
-    kvecs[:, :,:, 2] = abs(freqs[:ngrid/2+1].reshape((1, 1, 1, ngrid/2+1)))
+def all_treepm(f, eps=None, ngrid=64, **kwargs):
+    phi, acc = treepm(f, f['pos'].view(np.ndarray), eps, ngrid=ngrid, **kwargs)
+    f['phi'] = phi
+    f['acc'] = acc
 
-    k = (kvecs ** 2).sum(axis=3)
-    assert k.shape == recip_rho_grid.shape
 
-    recip_phi_grid = 4 * math.pi * recip_rho_grid / k ** 2
-    recip_phi_grid[np.where(k == 0)] = 0
+def _eps_in_pos_units(f, eps):
+    if eps is None:
+        eps = get_eps(f)
+    if hasattr(eps, 'units'):
+        eps = eps.in_units(f['pos'].units)
+    return np.asarray(eps, dtype=np.float64)
+
+
+def _pm_mesh(f, ipos, ngrid, x0, x1, periodic):
+    """Return the lower corner and size of the PM mesh, defaulting to the simulation box if periodic or
+    otherwise to a cube enclosing all particles and evaluation points"""
+    if periodic:
+        if x0 is None and x1 is None:
+            boxsize = f.properties.get('boxsize', None)
+            if boxsize is None:
+                raise ValueError("Periodic boundaries require a boxsize, either in the snapshot properties "
+                                 "or given by x0 and x1")
+            if units.is_unit_like(boxsize):
+                boxsize = float(boxsize.in_units(f['pos'].units))
+            return 0.0, float(boxsize)
+    if x0 is None or x1 is None:
+        pos = f['pos'].view(np.ndarray)
+        lo = np.minimum(pos.min(axis=0), ipos.min(axis=0)) if x0 is None else np.broadcast_to(x0, (3,))
+        hi = np.maximum(pos.max(axis=0), ipos.max(axis=0)) if x1 is None else np.broadcast_to(x1, (3,))
+        # leave two empty cells at each side, so that assigned mass never spills off the mesh
+        dx = max((hi - lo).max(), 1e-30) / (ngrid - 4)
+        return (lo - 2 * dx if x0 is None else lo), dx * ngrid
+    return x0, float(np.max(np.asarray(x1) - np.asarray(x0)))
 
-    phi_grid = np.fft.irfftn(recip_phi_grid, grid.shape)
-    grad_phi_grid = np.concatenate((np.fft.irfftn(-1.j*kvecs[:, :,:, 0]*recip_phi_grid, grid.shape)[:,:,:, np.newaxis],
-                                    np.fft.irfftn(-1.j*kvecs[:, :,:, 1]*recip_phi_grid, grid.shape)[:,:,:, np.newaxis],
-                                    np.fft.irfftn(-1.j*kvecs[:, :,:, 2]*recip_phi_grid, grid.shape)[:,:,:, np.newaxis]),
-                                   axis=3)
 
-    ipos_I = np.array((ipos - x0) / dx, dtype=int)
+def pm(f, ipos, eps=None, ngrid=64, x0=None, x1=None, periodic=False, assignment='cic', deconvolve=True):
+    """Calculate the potential and acceleration at positions ipos using a particle-mesh solver.
 
-    phi = np.array([phi_grid[x, y, z] for x, y, z in ipos_I])
-    grad_phi = np.array([grad_phi_grid[x, y, z, :] for x, y, z in ipos_I])
+    **Optional Keywords:**
 
-    phi = phi.view(array.SimArray)
-    phi.units = units.G * f['mass'].units / f['pos'].units
+    *eps* (None): Plummer softening, defaulting to the softening of the particles in f (see
+     pynbody.util.get_eps). If there are several softening lengths, the mean is used. The mesh cannot
+     resolve the field below half a cell, so this is the smallest effective softening.
 
-    grad_phi = grad_phi.view(array.SimArray)
-    grad_phi.units = units.G * f['mass'].units / f['pos'].units ** 2
+    *ngrid* (64): number of mesh cells along each side
 
-    return phi, -grad_phi
+    *x0*, *x1* (None): the lower and upper corners of the mesh. If periodic, these default to the box
+     specified by the boxsize property of the simulation; otherwise to a cube just large enough to hold
+     all particles and all points.
 
-def treecalc(f, rs, eps=None):
-    gtree = tree.GravTree(
-        f['pos'].view(np.ndarray), f['mass'].view(np.ndarray), eps=f['eps'], rs=rs)
-    a, p = gtree.calc(rs, eps=eps)
-    return p, a
+    *periodic* (False): if True, use periodic boundaries; otherwise, isolated boundaries
 
+    *assignment* ('cic'): mass assignment scheme, one of 'ngp', 'cic' or 'tsc'
 
-def midplane_rot_curve(f, rxy_points, eps=None, mode=config['gravity_calculation_mode']):
+    *deconvolve* (True): if True, correct for the smoothing of the mass assignment scheme
+
+    Returns pot, accel in the same form as direct"""
+    ipos = np.asarray(ipos, dtype=np.float64).reshape((-1, 3))
+    mesh_x0, boxsize = _pm_mesh(f, ipos, ngrid, x0, x1, periodic)
+    grid = pm_module.PMGrid(f['pos'].view(np.ndarray), f['mass'].view(np.ndarray), ngrid, x0=mesh_x0,
+                            boxsize=boxsize, periodic=periodic, assignment=assignment, deconvolve=deconvolve,
+                            eps=float(np.mean(_eps_in_pos_units(f, eps))))
+    accel, phi = grid.calc(ipos)
+    return _tree_units(f, phi, accel)
+
+
+def treepm(f, ipos, eps=None, ngrid=64, x0=None, x1=None, periodic=False, assignment='cic', split_scale=None,
+           cutoff=4.5):
+    """Calculate the potential and acceleration at positions ipos using the TreePM method.
+
+    The field is split into a long-range part, calculated with a particle-mesh solver, and a short-range
+    part, summed directly over the particles near each point (found using a KD-tree).
+
+    **Optional Keywords:**
+
+    *eps* (None): Plummer softening, defaulting to the softening of the particles in f (see
+     pynbody.util.get_eps). Unlike pm, individual softening lengths are respected.
+
+    *ngrid*, *x0*, *x1*, *periodic*, *assignment*: mesh options; see pm
+
+    *split_scale* (None): length scale of the split between the long and short range force, defaulting to
+     1.25 mesh cells
+
+    *cutoff* (4.5): particles further away than this multiple of the split scale are neglected in the
+     short-range sum
+
+    Returns pot, accel in the same form as direct"""
+    from ..sph import kdtree
+
+    ipos = np.ascontiguousarray(ipos, dtype=np.float64).reshape((-1, 3))
+    pos = np.ascontiguousarray(f['pos'].view(np.ndarray), dtype=np.float64)
+    mass = np.ascontiguousarray(f['mass'].view(np.ndarray), dtype=np.float64)
+    eps2 = np.ascontiguousarray(np.broadcast_to(_eps_in_pos_units(f, eps) ** 2, mass.shape))
+
+    mesh_x0, boxsize = _pm_mesh(f, ipos, ngrid, x0, x1, periodic)
+    if split_scale is None:
+        split_scale = 1.25 * boxsize / ngrid
+
+    grid = pm_module.PMGrid(pos, mass, ngrid, x0=mesh_x0, boxsize=boxsize, periodic=periodic,
+                            assignment=assignment, split_scale=split_scale)
+    accel, phi = grid.calc(ipos)
+
+    num_threads = int(config['number_of_threads'])
+    period = boxsize if periodic else -1.0
+    neighbour_tree = kdtree.KDTree(pos, mass, boxsize=period)
+    # limit the memory used by the neighbour lists
+    chunk = 65536
+    for start in range(0, len(ipos), chunk):
+        points = ipos[start:start + chunk]
+        offsets, indices, _ = neighbour_tree.particles_in_balls(points, cutoff * split_scale)
+        phi_short, accel_short = _gravity.short_range_sum(points, pos, mass, eps2, offsets.astype(np.intp),
+                                                          indices.astype(np.intp), split_scale, period,
+                                                          num_threads)
+        phi[start:start + chunk] += phi_short
+        accel[start:start + chunk] += accel_short
+
+    return _tree_units(f, phi, accel)
+
+
+def multipole(f, ipos, eps=None, lmax=8, mmax=None, **kwargs):
+    """Calculate the potential and acceleration at positions ipos from a multipole expansion about the origin.
+
+    Softening is ignored. To evaluate the same expansion repeatedly, or to save it to disk, use
+    pynbody.gravity.multipole.MultipolePotential directly.
+
+    **Optional Keywords:**
+
+    *lmax* (8), *mmax* (None): maximum orders of the expansion; other keywords are also passed to
+     pynbody.gravity.multipole.MultipolePotential
+
+    Returns pot, accel in the same form as direct"""
+    expansion = multipole_module.MultipolePotential(f, lmax=lmax, mmax=mmax, **kwargs)
+    accel, phi = expansion.calc(ipos)
+    return _tree_units(f, phi, accel)
 
-    direct_omp = None
+
+def _tree_for(f, eps=None, theta=None):
+    return tree.GravTree(f['pos'].view(np.ndarray), f['mass'].view(np.ndarray),
+                         _eps_in_pos_units(f, eps), theta=theta)
+
+
+def _tree_units(f, pot, accel):
+    pot = pot.view(array.SimArray)
+    pot.units = units.G * f['mass'].units / f['pos'].units
+    accel = accel.view(array.SimArray)
+    accel.units = units.G * f['mass'].units / f['pos'].units ** 2
+    return pot, accel
+
+
+def treecalc(f, rs, eps=None, theta=None):
+    """Calculate the potential and acceleration at positions rs using a Barnes-Hut tree.
+
+    If rs is None, the potential and acceleration are calculated for each particle in f.
+
+    **Optional Keywords:**
+
+    *eps* (None): softening, defaulting to the softening of the particles in f (see pynbody.util.get_eps)
+
+    *theta* (None): opening angle; see pynbody.gravity.tree.GravTree
+
+    Returns pot, accel in the same form as direct"""
+    gtree = _tree_for(f, eps, theta)
+    a, p = gtree.calc(rs)
+    return _tree_units(f, p, a)
+
+
+def _midplane_points(rxy_points, n_azimuth, dtype):
+    """Return n_azimuth points equally spaced in angle in the xy plane at each radius"""
+    angles = 2 * np.pi * np.arange(n_azimuth) / n_azimuth
+    directions = np.stack((np.cos(angles), np.sin(angles), np.zeros(n_azimuth)), axis=1)
+    radii = np.asarray(rxy_points, dtype=np.float64).reshape(-1)
+    return (radii[:, np.newaxis, np.newaxis] * directions).reshape((-1, 3)).astype(dtype)
+
+
+def midplane_rot_curve(f, rxy_points, eps=None, mode=config['gravity_calculation_mode'], n_azimuth=4):
+    """Calculate the circular velocity in the xy plane at the radii rxy_points.
+
+    The radial acceleration is averaged over n_azimuth points equally spaced in angle at each radius (four by
+    default, like Tipsy); all points are evaluated with a single call to the gravity solver given by mode."""
 
     if mode == 'direct_omp':
         mode = 'direct'  # deprecated
@@ -87,48 +223,32 @@ def midplane_rot_curve(f, rxy_points, eps=None, mode=config['gravity_calculation
     elif isinstance(eps, (str, units.UnitBase)):
         eps = eps_as_simarray(f, eps)
 
-    # u_out = (units.G * f['mass'].units / f['pos'].units)**(1,2)
-
-    # Do four samples like Tipsy does
-    rs = [pos for r in rxy_points for pos in [
-        (r, 0, 0), (0, r, 0), (-r, 0, 0), (0, -r, 0)]]
-
     try:
         fn = {'direct': direct,
               'tree': treecalc,
+              'pm': pm,
+              'treepm': treepm,
+              'multipole': multipole,
               }[mode]
     except KeyError:
         fn = mode
 
-    pot, accel = fn(f, np.array(rs, dtype=f['pos'].dtype), eps=eps)
+    points = _midplane_points(rxy_points, n_azimuth, f['pos'].dtype)
+    pot, accel = fn(f, points, eps=eps)
 
     u_out = (accel.units * f['pos'].units) ** (1, 2)
 
-    # accel = array.SimArray(m_by_r2,units.G * f['mass'].units / (f['pos'].units**2) )
-
-    vels = []
-
-    i = 0
-    for r in rxy_points:
-        r_acc_r = []
-        for pos in [(r, 0, 0), (0, r, 0), (-r, 0, 0), (0, -r, 0)]:
-            r_acc_r.append(np.dot(-accel[i, :], pos))
-            i = i + 1
-
-        vel2 = np.mean(r_acc_r)
-        if vel2 > 0:
-            vel = math.sqrt(vel2)
-        else:
-            vel = 0
-
-        vels.append(vel)
+    r_acc_r = -(accel.view(np.ndarray) * points).sum(axis=1).reshape((-1, n_azimuth))
+    vel2 = r_acc_r.mean(axis=1)
 
-    x = array.SimArray(vels, units=u_out)
+    x = array.SimArray(np.sqrt(np.maximum(vel2, 0)), units=u_out)
     x.sim = f.ancestor
     return x
 
 
-def midplane_potential(f, rxy_points, eps=None, mode=config['gravity_calculation_mode']):
+def midplane_potential(f, rxy_points, eps=None, mode=config['gravity_calculation_mode'], n_azimuth=4):
+    """Calculate the potential in the xy plane at the radii rxy_points, averaged over n_azimuth points equally
+    spaced in angle at each radius (four by default, like Tipsy)."""
     direct_omp = None
 
     if mode == 'direct_omp':
@@ -147,31 +267,17 @@ def midplane_potential(f, rxy_points, eps=None, mode=config['gravity_calculation
     try:
         fn = {'direct': direct,
               'direct_omp': direct_omp,
-              'tree': tree,
+              'tree': treecalc,
+              'pm': pm,
+              'treepm': treepm,
+              'multipole': multipole,
               }[mode]
     except KeyError:
         fn = mode
 
-    # Do four samples like Tipsy does
-    rs = [pos for r in rxy_points for pos in [
-        (r, 0, 0), (0, r, 0), (-r, 0, 0), (0, -r, 0)]]
-
-    m_by_r, m_by_r2 = fn(f, np.array(rs, dtype=f['pos'].dtype), eps=eps)
-
-    potential = units.G * m_by_r * f['mass'].units / f['pos'].units
-
-    pots = []
-
-    i = 0
-    for r in rxy_points:
-        # Do four samples like Tipsy does
-        pot = []
-        for pos in [(r, 0, 0), (0, r, 0), (-r, 0, 0), (0, -r, 0)]:
-            pot.append(potential[i])
-            i = i + 1
-
-        pots.append(np.mean(pot))
+    points = _midplane_points(rxy_points, n_azimuth, f['pos'].dtype)
+    potential, accel = fn(f, points, eps=eps)
 
-    x = array.SimArray(pots, units=u_out)
+    x = array.SimArray(potential.view(np.ndarray).reshape((-1, n_azimuth)).mean(axis=1), units=u_out)
     x.sim = f.ancestor
     return x
@@ -0,0 +1,49 @@
+#ifndef DIRECT_KERNEL_INCLUDED
+#define DIRECT_KERNEL_INCLUDED
+
+#include <math.h>
+
+/*
+** Blocked direct summation of the Plummer-softened potential and acceleration (with G=1).
+**
+** The sources are stored as separate x, y, z, mass and squared softening arrays so that the inner loop
+** over sources reads contiguous memory and can be vectorized. Sources are processed in blocks small enough
+** to stay in cache while every point in a tile of probe points is summed over them. Results are added
+** to phi and acc (n_points x 3), which must be initialised by the caller.
+*/
+
+#define DIRECT_SOURCE_BLOCK 2048
+
+#define DEFINE_DIRECT_TILE(NAME, FLOAT, SQRT)                                                        \
+static void NAME(const FLOAT *x, const FLOAT *y, const FLOAT *z, const FLOAT *m, const FLOAT *eps2,  \
+                 long n_sources, const FLOAT *points, long n_points, FLOAT *phi, FLOAT *acc)        \
+{                                                                                                   \
+    long block, block_end, i, j;                                                                    \
+    for (block = 0; block < n_sources; block += DIRECT_SOURCE_BLOCK) {                             \
+        block_end = block + DIRECT_SOURCE_BLOCK < n_sources ? block + DIRECT_SOURCE_BLOCK : n_sources; \
+        for (i = 0; i < n_points; i++) {                                                            \
+            const FLOAT px = points[3*i], py = points[3*i+1], pz = points[3*i+2];                   \
+            FLOAT sum_phi = 0, sum_ax = 0, sum_ay = 0, sum_az = 0;                                  \
+            _Pragma("omp simd reduction(+:sum_phi,sum_ax,sum_ay,sum_az)")                          \
+            for (j = block; j < block_end; j++) {                                                   \
+                const FLOAT dx = px - x[j], dy = py - y[j], dz = pz - z[j];                         \
+                const FLOAT inv_r = (FLOAT)1 / SQRT(dx*dx + dy*dy + dz*dz + eps2[j]);                 \
+                const FLOAT m_inv_r = m[j] * inv_r;                                                 \
+                const FLOAT m_inv_r3 = m_inv_r * inv_r * inv_r;                                     \
+                sum_phi += m_inv_r;                                                                 \
+                sum_ax += dx * m_inv_r3;                                                            \
+                sum_ay += dy * m_inv_r3;                                                            \
+                sum_az += dz * m_inv_r3;                                                            \
+            }                                                                                       \
+            phi[i] -= sum_phi;                                                                      \
+            acc[3*i] -= sum_ax;                                                                     \
+            acc[3*i+1] -= sum_ay;                                                                   \
+            acc[3*i+2] -= sum_az;                                                                   \
+        }                                                                                           \
+    }                                                                                               \
+}
+
+DEFINE_DIRECT_TILE(direct_tile_float, float, sqrtf)
+DEFINE_DIRECT_TILE(direct_tile_double, double, sqrt)
+
+#endif
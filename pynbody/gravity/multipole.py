@@ -0,0 +1,294 @@
+"""Multipole expansion of the gravitational potential. The expansion is fitted once to a set of particles and
+can then be evaluated anywhere, or saved to disk and reloaded, without reference to the particles."""
+
+import numpy as np
+import logging
+from time import process_time
+
+from .. import units, array
+
+logger = logging.getLogger('pynbody.gravity.multipole')
+
+
+def _unit_to_state(unit):
+    """Return a scale factor and a string that together represent unit. str(unit) alone rounds the scale
+    factor to three significant figures."""
+    if isinstance(unit, units.CompositeUnit):
+        return float(unit._scale), str(units.CompositeUnit(1, unit._bases, unit._powers))
+    return 1.0, str(unit)
+
+
+def _unit_from_state(scale, unit_string):
+    if unit_string == str(units.NoUnit()):
+        return units.NoUnit()
+    unit = units.Unit(unit_string)
+    return unit if scale == 1 else scale * unit
+
+
+def _harmonic_indices(lmax, mmax):
+    """Return l, m and whether the azimuthal factor is sin(m phi) (rather than cos) for each real spherical
+    harmonic up to the given order"""
+    l, m, sine = [], [], []
+    for l_this in range(lmax + 1):
+        for m_this in range(min(l_this, mmax) + 1):
+            l.append(l_this)
+            m.append(m_this)
+            sine.append(False)
+            if m_this > 0:
+                l.append(l_this)
+                m.append(m_this)
+                sine.append(True)
+    return np.array(l), np.array(m), np.array(sine)
+
+
+def _spherical_coordinates(points):
+    r = np.sqrt((points ** 2).sum(axis=1))
+    safe_r = np.where(r > 0, r, 1.0)
+    cos_theta = np.where(r > 0, points[:, 2] / safe_r, 1.0)
+    # stay clear of the poles, where the angular derivatives below are singular
+    sin_theta = np.maximum(np.sqrt(points[:, 0] ** 2 + points[:, 1] ** 2) / safe_r, 1e-8)
+    cos_theta = np.copysign(np.sqrt(1 - sin_theta ** 2), cos_theta)
+    azimuth = np.arctan2(points[:, 1], points[:, 0])
+    return r, cos_theta, sin_theta, azimuth
+
+
+def _real_harmonics(cos_theta, sin_theta, azimuth, lmax, mmax, derivatives=False):
+    """Return the real orthonormal spherical harmonics as an (n_points, n_harmonics) array, ordered as by
+    _harmonic_indices. If derivatives is True, also return their derivatives with respect to theta and
+    azimuth."""
+
+    # normalised associated Legendre functions, from the standard stable recurrences
+    legendre = {(0, 0): np.full_like(cos_theta, np.sqrt(1 / (4 * np.pi)))}
+    for m in range(mmax + 1):
+        if m > 0:
+            legendre[m, m] = np.sqrt((2 * m + 1) / (2 * m)) * sin_theta * legendre[m - 1, m - 1]
+        if m + 1 <= lmax:
+            legendre[m + 1, m] = np.sqrt(2 * m + 3) * cos_theta * legendre[m, m]
+        for l in range(m + 2, lmax + 1):
+            a = np.sqrt((4 * l ** 2 - 1) / (l ** 2 - m ** 2))
+            b = np.sqrt(((l - 1) ** 2 - m ** 2) / (4 * (l - 1) ** 2 - 1))
+            legendre[l, m] = a * (cos_theta * legendre[l - 1, m] - b * legendre[l - 2, m])
+
+    ls, ms, sines = _harmonic_indices(lmax, mmax)
+    harmonics = np.empty((len(cos_theta), len(ls)))
+    if derivatives:
+        d_theta = np.empty_like(harmonics)
+        d_azimuth = np.empty_like(harmonics)
+
+    for h, (l, m, sine) in enumerate(zip(ls, ms, sines)):
+        if m == 0:
+            trig, d_trig = 1.0, 0.0
+        elif sine:
+            trig, d_trig = np.sqrt(2) * np.sin(m * azimuth), np.sqrt(2) * m * np.cos(m * azimuth)
+        else:
+            trig, d_trig = np.sqrt(2) * np.cos(m * azimuth), -np.sqrt(2) * m * np.sin(m * azimuth)
+
+        harmonics[:, h] = legendre[l, m] * trig
+        if derivatives:
+            d_legendre = l * cos_theta * legendre[l, m]
+            if l > m:
+                d_legendre -= np.sqrt((2 * l + 1) / (2 * l - 1) * (l ** 2 - m ** 2)) * legendre[l - 1, m]
+            d_theta[:, h] = d_legendre / sin_theta * trig
+            d_azimuth[:, h] = legendre[l, m] * d_trig
+
+    if derivatives:
+        return harmonics, d_theta, d_azimuth
+    return harmonics
+
+
+class MultipolePotential:
+
+    _FORMAT_VERSION = 1
+
+    def __init__(self, f, lmax=8, mmax=None, n_radial=100, r_min=None, r_max=None, chunk_size=100000):
+        """Fit a multipole expansion to the gravitational potential of the particles in f, about the origin.
+
+        The potential is expanded in real spherical harmonics up to order lmax. The radial dependence of each
+        term is calculated exactly on a logarithmically-spaced grid of radii and interpolated between them.
+        Softening is ignored.
+
+        **Optional Keywords:**
+
+        *lmax* (8): maximum order of the spherical harmonics
+
+        *mmax* (None): maximum azimuthal order, defaulting to lmax. Use 0 for an axisymmetric potential.
+
+        *n_radial* (100): number of points in the radial grid
+
+        *r_min*, *r_max* (None): radial extent of the grid, defaulting to the radii of the innermost and
+         outermost particles. The expansion is exact inside r_min and outside r_max only if there are no
+         particles there.
+
+        *chunk_size* (100000): number of particles processed at a time
+        """
+        mmax = lmax if mmax is None else mmax
+        if lmax < 0 or not 0 <= mmax <= lmax:
+            raise ValueError("The orders must satisfy 0 <= mmax <= lmax")
+
+        start = process_time()
+        pos = f['pos']
+        mass = f['mass']
+        r = np.sqrt((pos.view(np.ndarray) ** 2).sum(axis=1))
+        if r_min is None:
+            r_min = r[r > 0].min() if (r > 0).any() else 1.0
+        if r_max is None:
+            # just beyond the outermost particle, which would otherwise count as being outside r_max
+            r_max = r.max() * (1 + 1e-10)
+        r_max = max(r_max, r_min * (1 + 1e-6))
+
+        self.lmax = lmax
+        self.mmax = mmax
+        self.pos_units = pos.units
+        self.mass_units = mass.units
+        self._radii = np.geomspace(r_min, r_max, n_radial)
+
+        ls, _, _ = _harmonic_indices(lmax, mmax)
+        inner = np.zeros((n_radial + 1, len(ls)))
+        outer = np.zeros((n_radial + 1, len(ls)))
+
+        for chunk_start in range(0, len(r), chunk_size):
+            chunk = slice(chunk_start, chunk_start + chunk_size)
+            r_chunk, cos_theta, sin_theta, azimuth = _spherical_coordinates(pos[chunk].view(np.ndarray))
+            m_harmonics = mass[chunk].view(np.ndarray)[:, np.newaxis] * \
+                _real_harmonics(cos_theta, sin_theta, azimuth, lmax, mmax)
+            # particles in bin b lie between radii[b-1] and radii[b]
+            bins = np.searchsorted(self._radii, r_chunk, side='right')
+            safe_r = np.where(r_chunk > 0, r_chunk, 1.0)[:, np.newaxis]
+            inner_weights = m_harmonics * r_chunk[:, np.newaxis] ** ls
+            outer_weights = m_harmonics * safe_r ** (-ls - 1.0)
+            for h in range(len(ls)):
+                inner[:, h] += np.bincount(bins, weights=inner_weights[:, h], minlength=n_radial + 1)
+                outer[:, h] += np.bincount(bins, weights=outer_weights[:, h], minlength=n_radial + 1)
+
+        # moments of the mass inside and outside each grid radius
+        q_inner = np.cumsum(inner, axis=0)
+        q_outer = np.cumsum(outer[::-1], axis=0)[::-1]
+        # beyond the grid, keep the moments of its first and last nodes
+        self._q_centre = (q_inner[0], q_outer[1])
+        self._q_edge = (q_inner[-2], q_outer[-1])
+
+        self._phi_nodes, self._dphi_nodes = self._radial_terms(self._radii, q_inner[:-1], q_outer[1:])
+        logger.info("Multipole expansion with lmax=%d of %d particles done in %5.3g s" %
+                    (lmax, len(r), process_time() - start))
+
+    def _radial_terms(self, r, q_inner, q_outer):
+        """Return the radial functions multiplying each harmonic, and their derivatives with respect to ln r,
+        given the moments of the mass inside and outside radius r"""
+        ls, _, _ = _harmonic_indices(self.lmax, self.mmax)
+        r = r[:, np.newaxis]
+        prefactor = -4 * np.pi / (2 * ls + 1)
+        inside_term = q_inner * r ** (-ls - 1.0)
+        outside_term = q_outer * r ** ls
+        return prefactor * (inside_term + outside_term), prefactor * (-(ls + 1) * inside_term + ls * outside_term)
+
+    def _radial_functions(self, r):
+        n_points, n_harmonics = len(r), self._phi_nodes.shape[1]
+        phi = np.empty((n_points, n_harmonics))
+        dphi = np.empty((n_points, n_harmonics))
+        x_nodes = np.log(self._radii)
+
+        inside = r < self._radii[0]
+        outside = r > self._radii[-1]
+        on_grid = ~(inside | outside)
+
+        # cubic Hermite interpolation in ln r, using the exact derivatives at the nodes
+        x = np.log(r[on_grid])
+        k = np.clip(np.searchsorted(x_nodes, x) - 1, 0, len(x_nodes) - 2)
+        h = (x_nodes[k + 1] - x_nodes[k])[:, np.newaxis]
+        t = ((x - x_nodes[k])[:, np.newaxis]) / h
+        p0, p1 = self._phi_nodes[k], self._phi_nodes[k + 1]
+        d0, d1 = self._dphi_nodes[k] * h, self._dphi_nodes[k + 1] * h
+        phi[on_grid] = (2 * t ** 3 - 3 * t ** 2 + 1) * p0 + (t ** 3 - 2 * t ** 2 + t) * d0 + \
+                       (3 * t ** 2 - 2 * t ** 3) * p1 + (t ** 3 - t ** 2) * d1
+        dphi[on_grid] = ((6 * t ** 2 - 6 * t) * p0 + (3 * t ** 2 - 4 * t + 1) * d0 +
+                         (6 * t - 6 * t ** 2) * p1 + (3 * t ** 2 - 2 * t) * d1) / h
+
+        for region, (q_inner, q_outer) in ((inside, self._q_centre), (outside, self._q_edge)):
+            if region.any():
+                r_region = np.maximum(r[region], 1e-12 * self._radii[0])
+                phi[region], dphi[region] = self._radial_terms(r_region, q_inner, q_outer)
+
+        return phi, dphi
+
+    def _points(self, points):
+        if units.has_units(points) and points.units != self.pos_units:
+            points = points.in_units(self.pos_units)
+        return np.asarray(points, dtype=np.float64).reshape((-1, 3))
+
+    def calc(self, points, chunk_size=100000):
+        """Calculate the acceleration and potential, with G=1, at the specified positions.
+
+        Returns accel (Nx3), pot (N)"""
+        points = self._points(points)
+        pot = np.empty(len(points))
+        accel = np.empty((len(points), 3))
+
+        for start in range(0, len(points), chunk_size):
+            chunk = slice(start, start + chunk_size)
+            r, cos_theta, sin_theta, azimuth = _spherical_coordinates(points[chunk])
+            harmonics, d_theta, d_azimuth = _real_harmonics(cos_theta, sin_theta, azimuth,
+                                                            self.lmax, self.mmax, derivatives=True)
+            phi, dphi_dlnr = self._radial_functions(r)
+            safe_r = np.maximum(r, 1e-12 * self._radii[0])
+
+            pot[chunk] = (phi * harmonics).sum(axis=1)
+            a_r = -(dphi_dlnr * harmonics).sum(axis=1) / safe_r
+            a_theta = -(phi * d_theta).sum(axis=1) / safe_r
+            a_azimuth = -(phi * d_azimuth).sum(axis=1) / (safe_r * sin_theta)
+
+            cos_azimuth, sin_azimuth = np.cos(azimuth), np.sin(azimuth)
+            accel[chunk, 0] = (a_r * sin_theta + a_theta * cos_theta) * cos_azimuth - a_azimuth * sin_azimuth
+            accel[chunk, 1] = (a_r * sin_theta + a_theta * cos_theta) * sin_azimuth + a_azimuth * cos_azimuth
+            accel[chunk, 2] = a_r * cos_theta - a_theta * sin_theta
+
+        return accel, pot
+
+    def phi(self, points):
+        """Return the gravitational potential at the specified positions"""
+        _, pot = self.calc(points)
+        return array.SimArray(pot, units.G * self.mass_units / self.pos_units)
+
+    def accel(self, points):
+        """Return the gravitational acceleration at the specified positions"""
+        accel, _ = self.calc(points)
+        return array.SimArray(accel, units.G * self.mass_units / self.pos_units ** 2)
+
+    def v_circ(self, rxy_points, n_azimuth=16):
+        """Return the circular velocity in the xy plane, from the radial acceleration averaged over n_azimuth
+        points equally spaced in angle at each radius"""
+        from .calc import _midplane_points
+
+        if units.has_units(rxy_points) and rxy_points.units != self.pos_units:
+            rxy_points = rxy_points.in_units(self.pos_units)
+        points = _midplane_points(rxy_points, n_azimuth, np.float64)
+        accel, _ = self.calc(points)
+        vel2 = -(accel * points).sum(axis=1).reshape((-1, n_azimuth)).mean(axis=1)
+        return array.SimArray(np.sqrt(np.maximum(vel2, 0)), (units.G * self.mass_units / self.pos_units) ** (1, 2))
+
+    def save(self, filename):
+        """Write the expansion to disk so that it can be reloaded with :meth:`load`"""
+        pos_scale, pos_units = _unit_to_state(self.pos_units)
+        mass_scale, mass_units = _unit_to_state(self.mass_units)
+        np.savez(filename, version=self._FORMAT_VERSION, lmax=self.lmax, mmax=self.mmax,
+                 pos_units=pos_units, pos_units_scale=pos_scale, mass_units=mass_units,
+                 mass_units_scale=mass_scale, radii=self._radii,
+                 phi_nodes=self._phi_nodes, dphi_nodes=self._dphi_nodes,
+                 q_centre=np.array(self._q_centre), q_edge=np.array(self._q_edge))
+
+    @classmethod
+    def load(cls, filename):
+        """Load an expansion written by :meth:`save`"""
+        with np.load(filename) as data:
+            if int(data['version']) != cls._FORMAT_VERSION:
+                raise ValueError("Unsupported multipole expansion format version %d" % int(data['version']))
+            self = cls.__new__(cls)
+            self.lmax = int(data['lmax'])
+            self.mmax = int(data['mmax'])
+            self.pos_units = _unit_from_state(float(data['pos_units_scale']), str(data['pos_units']))
+            self.mass_units = _unit_from_state(float(data['mass_units_scale']), str(data['mass_units']))
+            self._radii = data['radii']
+            self._phi_nodes = data['phi_nodes']
+            self._dphi_nodes = data['dphi_nodes']
+            self._q_centre = tuple(data['q_centre'])
+            self._q_edge = tuple(data['q_edge'])
+        return self
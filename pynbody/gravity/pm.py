@@ -0,0 +1,204 @@
+"""Particle-mesh gravity. Mass is assigned to a cubic mesh, Poisson's equation is solved with FFTs and the
+resulting field is interpolated back to arbitrary points."""
+
+import numpy as np
+import logging
+import math
+from time import process_time
+
+from .. import config
+from . import _gravity
+
+logger = logging.getLogger('pynbody.gravity.pm')
+
+_assignment_orders = {'ngp': 1, 'cic': 2, 'tsc': 3}
+
+
+class PMGrid:
+
+    def __init__(self, pos, mass, ngrid, x0=None, boxsize=None, periodic=False, assignment='cic',
+                 deconvolve=True, eps=0.0, split_scale=None, num_threads=None):
+        """Solve for the gravitational field of a set of particles on a mesh.
+
+        **Input:**
+
+        *pos*: Nx3 array of particle positions
+
+        *mass*: array of particle masses
+
+        *ngrid*: number of mesh cells along each side
+
+        **Optional Keywords:**
+
+        *x0* (None): lower corner of the mesh, either one value or one per axis. For isolated boundaries this
+         defaults to just below the lowest particle position; it is irrelevant for periodic boundaries.
+
+        *boxsize* (None): side length of the mesh. Required for periodic boundaries. For isolated boundaries this
+         defaults to enclosing all particles with two empty cells either side. Particles outside an explicitly
+         specified isolated mesh are ignored.
+
+        *periodic* (False): if True, the mesh is treated as a periodic box; otherwise it is zero-padded to
+         twice its size so that there are no periodic images.
+
+        *assignment* ('cic'): mass assignment and interpolation scheme, one of 'ngp' (nearest grid point),
+         'cic' (cloud in cell) or 'tsc' (triangular shaped cloud).
+
+        *deconvolve* (True): if True, divide out the smoothing of the assignment and interpolation scheme in
+         Fourier space.
+
+        *eps* (0.0): Plummer softening length for isolated boundaries. The mesh cannot resolve the field on
+         scales smaller than half a cell, so the softening is never taken to be smaller than this.
+
+        *split_scale* (None): if specified, only calculate the long-range part of the field, with the
+         Newtonian kernel multiplied by erf(r/(2 split_scale)). The remainder can then be computed by summing
+         over nearby particles (see pynbody.gravity.calc.treepm). Softening is ignored in this case.
+
+        *num_threads* (None): number of threads for the FFTs and interpolation, defaulting to the
+         number_of_threads configuration option.
+        """
+
+        if assignment not in _assignment_orders:
+            raise ValueError("Unknown mass assignment scheme %r; use one of %s" %
+                             (assignment, ", ".join(_assignment_orders)))
+        if num_threads is None:
+            num_threads = config['number_of_threads']
+
+        pos = np.ascontiguousarray(pos, dtype=np.float64)
+        mass = np.ascontiguousarray(mass, dtype=np.float64)
+        ngrid = int(ngrid)
+
+        if periodic:
+            if boxsize is None:
+                raise ValueError("A boxsize must be specified for a periodic mesh")
+            x0 = np.zeros(3) if x0 is None else x0
+        elif boxsize is None:
+            lo = pos.min(axis=0) if x0 is None else np.broadcast_to(x0, (3,))
+            extent = max((pos.max(axis=0) - lo).max(), 1e-10 * np.abs(lo).max(), 1e-30)
+            # leave two empty cells at each side, so that assigned mass never spills off the mesh
+            dx = extent / (ngrid - 4)
+            boxsize = dx * ngrid
+            if x0 is None:
+                x0 = lo - 2 * dx
+        elif x0 is None:
+            x0 = 0.5 * (pos.min(axis=0) + pos.max(axis=0)) - 0.5 * boxsize
+
+        self.ngrid = ngrid
+        self.x0 = np.array(np.broadcast_to(x0, (3,)), dtype=np.float64)
+        self.boxsize = float(boxsize)
+        self.dx = self.boxsize / ngrid
+        self.periodic = bool(periodic)
+        self.order = _assignment_orders[assignment]
+        self.num_threads = int(num_threads)
+
+        start = process_time()
+        mesh = np.zeros((ngrid, ngrid, ngrid))
+        n_outside = _gravity.mesh_assign(pos, mass, mesh, self.x0, self.dx, self.order, self.periodic)
+        if n_outside:
+            logger.warning("%d particles lie outside the PM mesh and have been ignored" % n_outside)
+
+        if self.periodic:
+            fields = self._solve_periodic(mesh, deconvolve, split_scale)
+        else:
+            fields = self._solve_isolated(mesh, deconvolve, max(eps, 0.5 * self.dx), split_scale)
+        self._phi, self._acc = fields[0], fields[1:]
+        end = process_time()
+        logger.info('PM solve on %d^3 mesh done in %5.3g s' % (ngrid, end - start))
+
+    def _window(self, shape):
+        """Return the Fourier transform of the assignment kernel on an rfftn grid of the given shape"""
+        window = 1.0
+        for axis, n in enumerate(shape):
+            k = np.fft.rfftfreq(n) if axis == len(shape) - 1 else np.fft.fftfreq(n)
+            # np.sinc(x) = sin(pi x)/(pi x), and k is in cycles per cell
+            window = window * np.sinc(k).reshape([-1 if a == axis else 1 for a in range(3)])
+        return window ** self.order
+
+    def _wavenumbers(self, n):
+        k = 2 * np.pi * np.fft.fftfreq(n, d=self.dx)
+        k_last = 2 * np.pi * np.fft.rfftfreq(n, d=self.dx)
+        return k.reshape(-1, 1, 1), k.reshape(1, -1, 1), k_last.reshape(1, 1, -1)
+
+    def _solve_periodic(self, mesh, deconvolve, split_scale):
+        import scipy.fft
+        n = self.ngrid
+        rho_k = scipy.fft.rfftn(mesh / self.dx ** 3, workers=self.num_threads)
+        kx, ky, kz = self._wavenumbers(n)
+        k2 = kx ** 2 + ky ** 2 + kz ** 2
+        k2[0, 0, 0] = 1.0
+
+        green = -4 * np.pi / k2
+        green[0, 0, 0] = 0.0
+        if split_scale is not None:
+            green *= np.exp(-k2 * split_scale ** 2)
+        if deconvolve:
+            green /= self._window(mesh.shape) ** 2
+
+        phi_k = rho_k * green
+        del rho_k, green
+
+        fields = [scipy.fft.irfftn(phi_k, mesh.shape, workers=self.num_threads)]
+        for k in kx, ky, kz:
+            # the Nyquist modes have no well-defined derivative
+            k = np.where(np.abs(k) * self.dx >= np.pi * (1 - 1e-10), 0.0, k)
+            fields.append(scipy.fft.irfftn(-1j * k * phi_k, mesh.shape, workers=self.num_threads))
+        return fields
+
+    def _solve_isolated(self, mesh, deconvolve, eps, split_scale):
+        # Hockney & Eastwood: convolve with the real-space kernel on a mesh of twice the size, so that
+        # the periodic images are too far away to contribute
+        import scipy.fft
+        import scipy.special
+        n = self.ngrid
+        padded_shape = (2 * n,) * 3
+        mass_k = scipy.fft.rfftn(mesh, padded_shape, workers=self.num_threads)
+        if deconvolve:
+            mass_k /= self._window(padded_shape) ** 2
+
+        offset = self.dx * np.where(np.arange(2 * n) < n, np.arange(2 * n), np.arange(2 * n) - 2 * n)
+        dx, dy, dz = offset.reshape(-1, 1, 1), offset.reshape(1, -1, 1), offset.reshape(1, 1, -1)
+        r2 = dx ** 2 + dy ** 2 + dz ** 2
+
+        if split_scale is None:
+            inv_r = 1.0 / np.sqrt(r2 + eps ** 2)
+            kernel = -inv_r
+            force_kernel = -inv_r ** 3
+        else:
+            r = np.sqrt(r2)
+            r[0, 0, 0] = 1.0
+            erf_term = scipy.special.erf(r / (2 * split_scale))
+            kernel = -erf_term / r
+            kernel[0, 0, 0] = -1.0 / (split_scale * math.sqrt(math.pi))
+            force_kernel = -(erf_term - r / (split_scale * math.sqrt(math.pi)) *
+                             np.exp(-r2 / (4 * split_scale ** 2))) / r ** 3
+            force_kernel[0, 0, 0] = 0.0
+            del r, erf_term
+        del r2
+
+        fields = []
+        for kern in kernel, force_kernel * dx, force_kernel * dy, force_kernel * dz:
+            kern_k = scipy.fft.rfftn(kern, workers=self.num_threads)
+            fields.append(np.ascontiguousarray(
+                scipy.fft.irfftn(mass_k * kern_k, padded_shape, workers=self.num_threads)[:n, :n, :n]))
+        return fields
+
+    def calc(self, vec_pos, num_threads=None):
+        """Interpolate the acceleration and potential, with G=1, to the specified positions.
+
+        Returns accel (Nx3), pot (N)"""
+        if num_threads is None:
+            num_threads = self.num_threads
+        ipos = np.ascontiguousarray(vec_pos, dtype=np.float64).reshape((-1, 3))
+
+        if not self.periodic:
+            rel = (ipos - self.x0) / self.dx
+            if len(ipos) and (rel.min() < 0 or rel.max() > self.ngrid):
+                raise ValueError("Some points lie outside the PM mesh")
+
+        pot = _gravity.mesh_interpolate(self._phi, ipos, self.x0, self.dx, self.order, self.periodic,
+                                        int(num_threads))
+        accel = np.empty((len(ipos), 3))
+        for k in range(3):
+            accel[:, k] = _gravity.mesh_interpolate(self._acc[k], ipos, self.x0, self.dx, self.order,
+                                                    self.periodic, int(num_threads))
+        return accel, pot
+
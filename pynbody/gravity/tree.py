@@ -1,48 +1,147 @@
-"""Gravity Tree. Builds tree based on pkdgrav2"""
-
-try:
-    from .. import pkdgrav
-except ImportError:
-    # pkdgrav2 never works at the moment, and the warning below
-    # confuses/annoys people
-    pass
-    #import warnings
-    #warnings.warn("Unable to import PKDGrav gravity solver. Most likely this means either that your installation is broken, or that you are running python inside the pynbody distribution directory, in which case python cannot see the installed version. However, it also doesn't matter unless you want to use the tree gravity solver.",RuntimeWarning)
-
-from .. import config
+"""Gravity tree. Barnes-Hut tree code with quadrupole moments"""
+
 import numpy as np
+import logging
 from time import process_time
 
+from .. import config, config_parser
+from . import _gravity
+
+logger = logging.getLogger('pynbody.gravity.tree')
 
 
 class GravTree:
 
-    def __init__(self, pos, mass, rs, eps=None, leafsize=16):
+    def __init__(self, pos, mass, eps, leafsize=16, theta=None):
+        """Build a tree for calculating the gravitational field of a set of particles.
+
+        **Input:**
+
+        *pos*: Nx3 array of particle positions
+
+        *mass*: array of particle masses
+
+        *eps*: softening length, either one value or one per particle, in the same units as *pos*.
+         Plummer softening is used.
+
+        **Optional Keywords:**
+
+        *leafsize* (16): maximum number of particles in the leaves of the tree
+
+        *theta* (None): opening angle; nodes are opened if they subtend more than this angle. Smaller values
+         are more accurate. If None, the tree-opening-angle option in the [gravity] section of the config is used.
+        """
+
+        if theta is None:
+            theta = config_parser.getfloat('gravity', 'tree-opening-angle')
+        if theta <= 0:
+            raise ValueError("The opening angle must be positive")
+
+        pos = np.ascontiguousarray(pos, dtype=np.float64)
+        mass = np.ascontiguousarray(mass, dtype=np.float64)
+        eps = np.broadcast_to(np.asarray(eps, dtype=np.float64), mass.shape)
 
         start = process_time()
-        self.tree = pkdgrav.pkdPythonInitialize(
-            pos, mass, eps, rs, int(leafsize))
+        self._order, self._nodes = _build(pos, leafsize)
+        self._pos = np.ascontiguousarray(pos[self._order])
+        self._groups = _leaf_groups(self._pos, *self._nodes)
+        self._mass = np.ascontiguousarray(mass[self._order])
+        self._eps2 = np.ascontiguousarray(eps[self._order] ** 2)
+        self._moments = _gravity.tree_moments(*self._nodes, self._pos, self._mass, self._eps2, float(theta))
         end = process_time()
-        if config['verbose']:
-            print('Tree build done in %5.3g s' % (end - start))
+        logger.info('Gravity tree build done in %5.3g s' % (end - start))
 
+        self.theta = theta
         self.derived = True
         self.flags = {'WRITEABLE': False}
 
-    def calc(self, vec_pos, eps=None):
-        accel = np.zeros((len(vec_pos), 3))
-        pot = np.zeros(len(vec_pos))
-        if config['verbose']:
-            print('Calculating Gravity')
+    def calc(self, vec_pos=None, num_threads=None):
+        """Calculate the acceleration and potential, with G=1, at the specified positions.
+
+        If *vec_pos* is None, the field is calculated at the position of each particle in the tree,
+        including each particle's own softened contribution (as for pynbody.gravity.direct).
+
+        Returns accel (Nx3), pot (N)
+        """
+        if num_threads is None:
+            num_threads = config['number_of_threads']
 
+        if vec_pos is None:
+            order, ipos, groups = self._order, self._pos, self._groups
+        else:
+            ipos = np.ascontiguousarray(vec_pos, dtype=np.float64).reshape((-1, 3))
+            if len(ipos) == 0:
+                return np.zeros((0, 3)), np.zeros(0)
+            # group nearby points together so that they can share a tree walk
+            order, nodes = _build(ipos, 16)
+            ipos = np.ascontiguousarray(ipos[order])
+            groups = _leaf_groups(ipos, *nodes)
+
+        logger.info('Calculating tree gravity at %d points' % len(ipos))
         start = process_time()
-        pkdgrav.pkdPythonDoGravity(self.tree, accel, pot, theta=0.55)
+        pot_sorted, accel_sorted = _gravity.tree_walk(*self._nodes, self._pos, self._mass, self._eps2, *self._moments, ipos, *groups,
+                                                      num_threads=int(num_threads))
         end = process_time()
-        if config['verbose']:
-            print('Gravity calculated in %5.3g s' % (end - start))
+        logger.info('Gravity calculated in %5.3g s' % (end - start))
+
+        pot = np.empty_like(pot_sorted)
+        accel = np.empty_like(accel_sorted)
+        pot[order] = pot_sorted
+        accel[order] = accel_sorted
 
         return accel, pot
 
-    def __del__(self):
-        if hasattr(self, 'tree'):
-            pkdgrav.free(self.tree)
+
+def _spread_bits(x):
+    """Spread the lowest 21 bits of x so that they occupy every third bit of a 64-bit integer"""
+    x = x & np.uint64(0x1fffff)
+    for shift, mask in ((32, 0x1f00000000ffff), (16, 0x1f0000ff0000ff), (8, 0x100f00f00f00f00f),
+                        (4, 0x10c30c30c30c30c3), (2, 0x1249249249249249)):
+        x = (x | (x << np.uint64(shift))) & np.uint64(mask)
+    return x
+
+
+def _morton_keys(pos):
+    """Return the Morton (Z-order) key of each position within the bounding cube of all positions"""
+    lo = pos.min(axis=0)
+    size = (pos.max(axis=0) - lo).max()
+    if size == 0:
+        size = 1.0
+    cells = ((pos - lo) * ((2 ** 21 - 1) / size)).astype(np.uint64)
+    return _spread_bits(cells[:, 0]) | (_spread_bits(cells[:, 1]) << np.uint64(1)) | \
+        (_spread_bits(cells[:, 2]) << np.uint64(2))
+
+
+def _build(pos, leafsize):
+    """Return the tree order of the particles and the (lower, upper, left, right) node arrays.
+
+    Unlike the median splits of the SPH KD-tree, cells are split in space; a few distant particles then
+    occupy their own cells rather than inflating the size of nodes throughout the tree."""
+    keys = _morton_keys(pos)
+    order = np.argsort(keys, kind='stable')
+    return order, _gravity.build_tree(np.ascontiguousarray(keys[order]), int(leafsize))
+
+
+def _leaf_groups(pos, lower, upper, left, right, max_radius_factor=4.0):
+    """Return the boundaries, centres and radii of groups of points corresponding to the leaves of a tree.
+
+    Leaves much larger than is typical (e.g. in the sparse outskirts of a halo) make poor groups, because
+    the tree walk has to open every node near any of their points. Such leaves are split into single points."""
+    leaves = np.where(left < 0)[0]
+    starts = np.sort(lower[leaves])
+    lengths = np.diff(np.append(starts, len(pos)))
+    centre = 0.5 * (np.minimum.reduceat(pos, starts, axis=0) + np.maximum.reduceat(pos, starts, axis=0))
+    offset = pos - np.repeat(centre, lengths, axis=0)
+    radius = np.maximum.reduceat(np.sqrt((offset ** 2).sum(axis=1)), starts)
+
+    loose = radius > max_radius_factor * np.median(radius)
+    if loose.any():
+        loose_points = np.repeat(loose, lengths)
+        group_start = np.zeros(len(pos), dtype=bool)
+        group_start[starts] = True
+        group_start |= loose_points
+        starts = np.where(group_start)[0]
+        centre = np.where(loose_points[starts, np.newaxis], pos[starts], np.repeat(centre, lengths, axis=0)[starts])
+        radius = np.where(loose_points[starts], 0.0, np.repeat(radius, lengths)[starts])
+
+    return np.append(starts, len(pos)), np.ascontiguousarray(centre), np.ascontiguousarray(radius)
@@ -92,7 +92,7 @@ class SimSnap(ContainerWithPhysicalUnitsOption):
     _decorator_registry = {}
 
     _loadable_keys_registry = {}
-    _persistent = ["kdtree", "_immediate_cache", "_kdtree_derived_smoothing"]
+    _persistent = ["kdtree", "_stale_kdtree", "_immediate_cache", "_kdtree_derived_smoothing", "_gravity_field"]
 
     # The following will be objects common to a SimSnap and all its SubSnaps
     _inherited = ["_immediate_cache_lock",
@@ -1474,7 +1474,17 @@ class SimSnap(ContainerWithPhysicalUnitsOption):
         if name=='pos':
             for v in self.ancestor._persistent_objects.values():
                 if 'kdtree' in v:
-                    del v['kdtree']
+                    # keep the old tree so that sph.build_tree can refresh it rather than start again
+                    v['_stale_kdtree'] = v.pop('kdtree')
+        if name in ('pos', 'mass', 'eps'):
+            for v in self.ancestor._persistent_objects.values():
+                v.pop('_gravity_field', None)
+            self.ancestor._drop_gravity_arrays()
+        for v in self.ancestor._persistent_objects.values():
+            for tree_name in 'kdtree', '_stale_kdtree':
+                if hasattr(v.get(tree_name), 'smooth_array_changed'):
+                    # the tree may hold per-node maxima of this array, used to cull particles for rendering
+                    v[tree_name].smooth_array_changed(name)
 
         if not self.auto_propagate_off:
             for d_ar in self._dependency_tracker.get_dependents(name):
@@ -1483,6 +1493,22 @@ class SimSnap(ContainerWithPhysicalUnitsOption):
                         del self[d_ar]
                         self._dirty(d_ar)
 
+    def _drop_gravity_arrays(self):
+        """Delete the derived phi and accg arrays of this snapshot and all its families. These depend on
+        every particle, so changing any one family invalidates them all, which the dependency tracker
+        cannot see."""
+        for name in 'phi', 'accg':
+            deleted = False
+            if name in self._arrays and name in self._derived_array_names:
+                del self[name]
+                deleted = True
+            for fam in list(self._family_arrays.get(name, {})):
+                if name in self._family_derived_array_names[fam]:
+                    self._del_family_array(name, fam)
+                    deleted = True
+            if deleted:
+                self._dirty(name)
+
     def is_derived_array(self, name, fam=None):
         """Returns True if the array or family array of given name is
         auto-derived (and therefore read-only)."""
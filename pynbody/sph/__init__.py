@@ -41,6 +41,9 @@ def _get_threaded_image():
 
 _threaded_image = _get_threaded_image()
 _approximate_image = config_parser.getboolean('sph', 'approximate-fast-images')
+_tree_cull_image = config_parser.getboolean('sph', 'tree-cull-images')
+_tree_cache = config_parser.getboolean('sph', 'cache-kdtree')
+_tree_refresh_tolerance = config_parser.getfloat('sph', 'tree-refresh-tolerance')
 
 def _exception_catcher(call_fn, exception_list, *args):
     try:
@@ -95,10 +98,86 @@ def build_tree(sim):
                 boxsize = float(boxsize.in_units(sim['pos'].units))
         else:
             boxsize = -1.0 # represents infinite box
+        leafsize = config['sph']['tree-leafsize']
+
+        if _refresh_stale_tree(sim, leafsize, boxsize):
+            return
+
+        cache_filename, source_mtime = _tree_cache_filename(sim)
+        if cache_filename is not None and os.path.exists(cache_filename):
+            try:
+                sim.kdtree = kdtree.KDTree.load(cache_filename, sim['pos'], sim['mass'],
+                                                leafsize=leafsize, boxsize=boxsize,
+                                                source_mtime=source_mtime)
+                logger.info("Loaded tree from %s" % cache_filename)
+                return
+            except (OSError, ValueError) as e:
+                logger.info("Ignoring KDTree cache %s (%s)" % (cache_filename, e))
+
         sim.kdtree = kdtree.KDTree(sim['pos'], sim['mass'],
-                        leafsize=config['sph']['tree-leafsize'],
+                        leafsize=leafsize,
                         boxsize=boxsize)
 
+        if cache_filename is not None:
+            try:
+                sim.kdtree.save(cache_filename, source_mtime)
+            except OSError as e:
+                logger.warning("Unable to write KDTree cache %s (%s)" % (cache_filename, e))
+
+
+def _refresh_stale_tree(sim, leafsize, boxsize):
+    """Try to bring a tree that was invalidated by changes to the positions up to date, returning True on success.
+
+    See KDTree.refresh; the tree is rebuilt instead if it would degrade by more than the tree-refresh-tolerance
+    config option, which can be set to zero to disable refreshing."""
+    stale = getattr(sim, '_stale_kdtree', None)
+    if stale is None:
+        return False
+    del sim._stale_kdtree
+
+    if _tree_refresh_tolerance <= 0 or stale.leafsize != leafsize:
+        return False
+
+    try:
+        acceptable = stale.refresh(sim['pos'], sim['mass'], _tree_refresh_tolerance)
+    except (ValueError, TypeError) as e:
+        logger.info("Unable to refresh tree (%s)" % e)
+        return False
+
+    if not acceptable:
+        logger.info("Particles have moved too far to refresh the tree")
+        return False
+
+    stale.boxsize = boxsize
+    sim.kdtree = stale
+    logger.info("Refreshed existing tree for new positions")
+    return True
+
+
+def _tree_cache_filename(sim):
+    """Return the name of the on-disk KDTree cache for sim and the modification time of the snapshot file.
+
+    Trees are cached only if cache-kdtree is switched on in the [sph] section of the config, and only for
+    whole snapshots or single families of snapshots that exist on disk. Returns (None, None) otherwise."""
+    if not _tree_cache:
+        return None, None
+
+    ancestor = sim.ancestor
+    if sim is ancestor:
+        suffix = ".kdtree"
+    elif isinstance(sim, snapshot.FamilySubSnap) and sim.base is ancestor:
+        suffix = ".%s.kdtree" % sim._unifamily.name
+    else:
+        return None, None
+
+    filename = str(getattr(ancestor, 'filename', ''))
+    try:
+        source_mtime = os.path.getmtime(filename)
+    except OSError:
+        return None, None
+
+    return filename.rstrip(os.sep) + suffix, source_mtime
+
 
 def _tree_decomposition(obj):
     return [obj[i::_get_threaded_smooth()] for i in range(_get_threaded_smooth())]
@@ -466,9 +545,16 @@ def render_image(snap, qty='rho', x2=100, nx=500, y2=None, ny=None, x1=None,
     Render an SPH image using a typical (mass/rho)-weighted 'scatter'
     scheme.
 
+    If the snapshot already has a KD-tree (for instance because its smoothing
+    lengths were derived), the tree is used to pass only the particles that can
+    touch the image to the renderer, unless tree-cull-images is switched off in
+    the [sph] section of the configuration.
+
     **Keyword arguments:**
 
-    *qty* ('rho'): The name of the array within the simulation to render
+    *qty* ('rho'): The name of the array within the simulation to render, or a
+     list of names. Given a list, all the quantities are rendered in a single
+     pass over the particles and an array of shape (len(qty), ny, nx) is returned.
 
     *x2* (100.0): The x-coordinate of the right edge of the image
 
@@ -485,7 +571,10 @@ def render_image(snap, qty='rho', x2=100, nx=500, y2=None, ny=None, x1=None,
 
     *z_plane* (0.0): The z-coordinate of the plane of the image
 
-    *out_units* (no conversion): The units to convert the output image into
+    *out_units* (no conversion): The units to convert the output image into. If
+     several quantities are rendered, this may be a list with one entry per
+     quantity; the returned array only carries units if they are the same for
+     all quantities.
 
     *xy_units*: The units for the x and y axes
 
@@ -517,7 +606,8 @@ def render_image(snap, qty='rho', x2=100, nx=500, y2=None, ny=None, x1=None,
 
      *threaded*: if False (or None), render on a single core. Otherwise,
       the number of threads to use (defaults to a value specified in your
-      configuration files).
+      configuration files). The image is split into tiles which are shared
+      between the threads; the result is identical to a single-core render.
     """
 
     if denoise is None:
@@ -536,53 +626,232 @@ def render_image(snap, qty='rho', x2=100, nx=500, y2=None, ny=None, x1=None,
     if threaded is None:
         threaded = _get_threaded_image()
 
-    if threaded:
-        im = _threaded_render_image(base_renderer, snap, qty, x2, nx, y2, ny, x1, y1, z_plane,
-                                    out_units, xy_units, kernel, z_camera, smooth,
-                                    smooth_in_pixels, True,
-                                    num_threads=threaded)
-    else:
-        im = base_renderer(snap, qty, x2, nx, y2, ny, x1, y1, z_plane,
-                           out_units, xy_units, kernel, z_camera, smooth,
-                           smooth_in_pixels, False)
+    qty_list, out_units_list, multiple = _image_quantity_list(qty, out_units)
 
     if denoise:
-        # call self to render a 'flat field'
+        # render a 'flat field' in the same pass as the requested quantities
         snap['__denoise_one'] = 1
-        im2 = render_image(snap, '__denoise_one', x2, nx, y2, ny, x1, y1, z_plane, None,
-                           xy_units, kernel, z_camera, smooth, smooth_in_pixels,
-                           force_quiet, approximate_fast, threaded, False)
-        del snap.ancestor['__denoise_one']
-        im2 = im / im2
-        im2.units = im.units
-        return im2
+        render_qty = qty_list + ['__denoise_one']
+        render_units = out_units_list + [None]
+    else:
+        render_qty, render_units = qty, out_units
+
+    try:
+        if threaded and (z_camera is None or z_camera == 0.0):
+            # split the image into tiles, each rendered by one thread
+            im = base_renderer(snap, render_qty, x2, nx, y2, ny, x1, y1, z_plane,
+                               render_units, xy_units, kernel, z_camera, smooth,
+                               smooth_in_pixels, True, num_threads=threaded)
+        elif threaded:
+            # perspective images have a frame that varies with depth, so can't be tiled
+            im = _threaded_render_image(base_renderer, snap, render_qty, x2, nx, y2, ny, x1, y1, z_plane,
+                                        render_units, xy_units, kernel, z_camera, smooth,
+                                        smooth_in_pixels, True,
+                                        num_threads=threaded)
+        else:
+            im = base_renderer(snap, render_qty, x2, nx, y2, ny, x1, y1, z_plane,
+                               render_units, xy_units, kernel, z_camera, smooth,
+                               smooth_in_pixels, False)
+    finally:
+        if denoise:
+            del snap.ancestor['__denoise_one']
+
+    if denoise:
+        x_units = snap['x'].units if xy_units is None else units.Unit(xy_units)
+        sm_units = snap[smooth].units if smooth_in_pixels else x_units
+        _, im_units = _image_conversions(snap, qty_list, out_units_list, x_units, sm_units, kernel)
+        im = (im[:-1] / im[-1]).view(array.SimArray)
+        if not multiple:
+            im = im[0]
+        if all(u == im_units[0] for u in im_units):
+            im.units = im_units[0]
+        im.sim = snap
+
+    return im
+
+
+def _image_quantity_list(qty, out_units):
+    """Normalise the qty and out_units arguments of render_image to lists.
 
+    Returns (qty_list, out_units_list, multiple), where multiple is False if a single quantity name was given."""
+    if isinstance(qty, str):
+        return [qty], [out_units], False
+    qty_list = list(qty)
+    if out_units is None or isinstance(out_units, str) or units.is_unit_like(out_units):
+        out_units_list = [out_units] * len(qty_list)
     else:
-        return im
+        out_units_list = list(out_units)
+        if len(out_units_list) != len(qty_list):
+            raise ValueError("out_units must have one entry for each quantity rendered")
+    return qty_list, out_units_list, True
+
+
+def _image_conversions(snap, qty_list, out_units_list, x_units, sm_units, kernel):
+    """Work out the factor by which to multiply the raw rendered image of each quantity, and the resulting units.
+
+    The weighting works such that there is a factor of (M_u/rho_u)h_u^3
+    where M-u, rho_u and h_u are mass, density and smoothing units
+    respectively. This is dimensionless, but may not be 1 if the units
+    have been changed since load-time."""
+    mass_units = snap['mass'].units
+    rho_units = snap['rho'].units
+    conv_ratios, result_units = [], []
+    for qty_s, out_units_s in zip(qty_list, out_units_list):
+        if out_units_s is None:
+            conv_ratios.append((mass_units / rho_units).ratio(x_units ** 3, **snap.conversion_context()))
+            result_units.append(snap[qty_s].units * x_units ** (3 - kernel.h_power))
+        else:
+            conv_ratios.append((snap[qty_s].units * mass_units / (rho_units * sm_units ** kernel.h_power)).ratio(
+                out_units_s, **snap.conversion_context()))
+            result_units.append(out_units_s)
+    return conv_ratios, result_units
+
+
+def render_frames(snap, rotations=None, qty='rho', x2=100, nx=500, y2=None, ny=None, x1=None, y1=None,
+                  z_plane=0.0, z_camera=None, out_units=None, xy_units=None, kernel=Kernel(),
+                  smooth='smooth', threaded=None, out_file=None):
+    """
+
+    Render a sequence of SPH images of the same particles seen from different
+    orientations, e.g. the frames of a rotation movie.
+
+    The particle arrays are fetched, converted to the image units and cast to
+    float32 once. Each frame then only requires the particles to be rotated and
+    rendered, and frames are shared between threads.
+
+    **Keyword arguments:**
+
+    *rotations*: a sequence of 3x3 rotation matrices, one per frame; each is
+      applied to the particle positions (about the origin) before rendering the
+      frame. If None, every frame is rendered without rotation, which is useful
+      when only *z_camera* changes from frame to frame.
+
+    *qty* ('rho'): The name of the array within the simulation to render
+
+    *x2*, *nx*, *y2*, *ny*, *x1*, *y1*, *z_plane*, *out_units*, *xy_units*,
+      *kernel*, *smooth*: as for :func:`render_image`
+
+    *z_camera*: None for orthographic frames, a single camera position used for
+      all frames, or a sequence of camera positions with one per frame
+
+    *threaded*: if False (or None), render on a single core. Otherwise, the
+      number of threads to use (defaults to a value specified in your
+      configuration files)
+
+    *out_file*: if not None, the name of a .npy file to which the frames are
+      written as they are completed; the returned array is then a memory map
+      onto the file
+
+    **Returns:** an array of shape (n_frames, ny, nx)
+
+    Periodic wrapping, denoising and approximate rendering are not applied.
+
+    """
+
+    if y2 is None:
+        if ny is not None:
+            y2 = x2 * float(ny) / nx
+        else:
+            y2 = x2
+    if ny is None:
+        ny = nx
+    if x1 is None:
+        x1 = -x2
+    if y1 is None:
+        y1 = -y2
+    x1, x2, y1, y2, z_plane = (float(q) for q in (x1, x2, y1, y2, z_plane))
+    nx, ny = int(nx + .5), int(ny + .5)
+
+    if rotations is not None:
+        rotations = np.asarray(rotations, dtype=np.float32).reshape((-1, 3, 3))
+    if z_camera is None or np.ndim(z_camera) == 0:
+        n_frames = 1 if rotations is None else len(rotations)
+        z_camera = np.repeat(float(z_camera or 0.0), n_frames)
+    else:
+        z_camera = np.asarray(z_camera, dtype=np.float64)
+        n_frames = len(z_camera)
+    if rotations is not None and len(rotations) != n_frames:
+        raise ValueError("Number of rotations (%d) does not match number of camera positions (%d)" %
+                         (len(rotations), n_frames))
+
+    if xy_units is None:
+        xy_units = snap['x'].units
+
+    # prepare the particle data once for all frames
+    pos = snap['pos'].in_units(xy_units)
+    sm = snap[smooth].in_units(xy_units)
+    qty_ar = snap[qty]
+    mass = snap['mass']
+    rho = snap['rho']
+
+    if out_units is not None:
+        conv_ratio = (qty_ar.units * mass.units / (rho.units * sm.units ** kernel.h_power)).ratio(out_units,
+                                                                                               **snap.conversion_context())
+        result_units = out_units
+    else:
+        conv_ratio = (mass.units / rho.units).ratio(pos.units ** 3, **snap.conversion_context())
+        result_units = qty_ar.units * pos.units ** (3 - kernel.h_power)
+
+    pos, sm, qty_ar, mass, rho = (np.ascontiguousarray(q, dtype=np.float32) for q in (pos, sm, qty_ar, mass, rho))
+
+    if out_file is not None:
+        result = np.lib.format.open_memmap(out_file, mode='w+', dtype=np.float32, shape=(n_frames, ny, nx))
+    else:
+        result = np.empty((n_frames, ny, nx), dtype=np.float32)
+
+    if threaded is None:
+        threaded = _get_threaded_image()
+    num_threads = min(max(int(threaded or 1), 1), n_frames)
+
+    frame_queue = iter(range(n_frames))
+    queue_lock = threading.Lock()
+
+    def render_frames_thread(thread_index):
+        while True:
+            with queue_lock:
+                frame = next(frame_queue, None)
+            if frame is None:
+                return
+            if rotations is None:
+                frame_pos = pos
+            else:
+                frame_pos = np.dot(pos, rotations[frame].T)
+            im = _render.render_image(nx, ny, frame_pos[:, 0], frame_pos[:, 1], frame_pos[:, 2], sm,
+                                      x1, x2, y1, y2, z_camera[frame], z_plane, qty_ar, mass, rho,
+                                      0.0, 100000.0, kernel)
+            im *= conv_ratio
+            result[frame] = im
+
+    logger.info("Rendering %d frames" % n_frames)
+    start = time.time()
+    if num_threads > 1:
+        _thread_map(render_frames_thread, range(num_threads))
+    else:
+        render_frames_thread(0)
+    logger.info("Frames done in %5.3g s" % (time.time() - start))
+
+    if out_file is not None:
+        result.flush()
+
+    result = result.view(array.SimArray)
+    result.units = result_units
+    result.sim = snap
+    return result
 
 
 def _render_image(snap, qty, x2, nx, y2, ny, x1,
                   y1, z_plane, out_units, xy_units, kernel, z_camera,
                   smooth, smooth_in_pixels,  force_quiet,
                   smooth_range=None, res_downgrade=None, snap_slice=None,
-                  __threaded=False):
-    """The single-threaded image rendering core function. External calls
-    should be made to the render_image function."""
+                  num_threads=None, __threaded=False):
+    """The image rendering core function. If num_threads is given, the image is
+    rendered in tiles by that many threads. External calls should be made to the
+    render_image function."""
 
     global config
 
     verbose = config["verbose"] and not force_quiet
 
-    snap_proxy = {}
-
-    # cache the arrays and take a slice of them if we've been asked to
-    for arname in 'x', 'y', 'z', 'pos', smooth, qty, 'rho', 'mass':
-        snap_proxy[arname] = snap[arname]
-        if snap_slice is not None:
-            snap_proxy[arname] = snap_proxy[arname][snap_slice]
-
-
-
     in_time = time.time()
 
     if y2 is None:
@@ -628,9 +897,26 @@ def _render_image(snap, qty, x2, nx, y2, ny, x1,
     nx = int(nx + .5)
     ny = int(ny + .5)
 
-    result = np.zeros((ny, nx), dtype=np.float32)
+    if z_camera is None or z_camera == 0.0:
+        visible = _visible_particles(snap, x1, x2, y1, y2, z1, xy_units, kernel, smooth, smooth_in_pixels)
+    else:
+        visible = None
+
+    if visible is not None and snap_slice is not None:
+        visible = visible[snap_slice]
+        snap_slice = None
 
-    n_part = len(snap)
+    qty_list, out_units_list, multiple = _image_quantity_list(qty, out_units)
+
+    snap_proxy = {}
+
+    # cache the arrays and take a slice of them if we've been asked to
+    for arname in ['x', 'y', 'z', 'pos', smooth, 'rho', 'mass'] + qty_list:
+        snap_proxy[arname] = snap[arname]
+        if visible is not None:
+            snap_proxy[arname] = snap_proxy[arname][visible]
+        elif snap_slice is not None:
+            snap_proxy[arname] = snap_proxy[arname][snap_slice]
 
     if xy_units is None:
         xy_units = snap_proxy['x'].units
@@ -644,47 +930,218 @@ def _render_image(snap, qty, x2, nx, y2, ny, x1,
     if sm.units != x.units and not smooth_in_pixels:
         sm = sm.in_units(x.units)
 
-    qty_s = qty
-    qty = snap_proxy[qty]
     mass = snap_proxy['mass']
     rho = snap_proxy['rho']
 
-    if out_units is not None:
-        # Calculate the ratio now so we don't waste time calculating
-        # the image only to throw a UnitsException later
-        conv_ratio = (qty.units * mass.units / (rho.units * sm.units ** kernel.h_power)).ratio(out_units,
-                                                                                               **snap.conversion_context())
+    # Calculate the ratios now so we don't waste time calculating
+    # the image only to throw a UnitsException later
+    conv_ratios, result_units = _image_conversions(snap, qty_list, out_units_list, x.units, sm.units, kernel)
+
+    if multiple:
+        qty = np.array([snap_proxy[qty_s].view(np.ndarray) for qty_s in qty_list])
+    else:
+        qty = snap_proxy[qty]
 
     if z_camera is None:
         z_camera = 0.0
 
-    result = _render.render_image(nx, ny, x, y, z, sm, x1, x2, y1, y2, z_camera, 0.0, qty, mass, rho,
-                                  smooth_lo, smooth_hi, kernel,
-                                  _calculate_wrapping_repeat_array(snap, x1, x2, xy_units),
-                                  _calculate_wrapping_repeat_array(snap, y1, y2, xy_units))
+    if num_threads and num_threads > 1 and z_camera == 0.0:
+        result = _render_image_tiled(nx, ny, x, y, z, sm, x1, x2, y1, y2, qty, mass, rho,
+                                     smooth_lo, smooth_hi, kernel,
+                                     _calculate_wrapping_repeat_array(snap, x1, x2, xy_units),
+                                     _calculate_wrapping_repeat_array(snap, y1, y2, xy_units),
+                                     num_threads, z_plane=z1)
+    else:
+        renderer = _render.render_image_multi if multiple else _render.render_image
+        result = renderer(nx, ny, x, y, z, sm, x1, x2, y1, y2, z_camera, z1, qty, mass, rho,
+                          smooth_lo, smooth_hi, kernel,
+                          _calculate_wrapping_repeat_array(snap, x1, x2, xy_units),
+                          _calculate_wrapping_repeat_array(snap, y1, y2, xy_units))
 
     result = result.view(array.SimArray)
 
-    # The weighting works such that there is a factor of (M_u/rho_u)h_u^3
-    # where M-u, rho_u and h_u are mass, density and smoothing units
-    # respectively. This is dimensionless, but may not be 1 if the units
-    # have been changed since load-time.
-    if out_units is None:
-        result *= (snap_proxy['mass'].units / (snap_proxy['rho'].units)).ratio(
-            snap_proxy['x'].units ** 3, **snap_proxy['x'].conversion_context())
-
-        # The following will be the units of outputs after the above conversion
-        # is applied
-        result.units = snap_proxy[qty_s].units * \
-            snap_proxy['x'].units ** (3 - kernel.h_power)
+    if multiple:
+        for result_i, conv_ratio in zip(result, conv_ratios):
+            result_i *= conv_ratio
+        if all(u == result_units[0] for u in result_units):
+            result.units = result_units[0]
     else:
-        result *= conv_ratio
-        result.units = out_units
+        result *= conv_ratios[0]
+        result.units = result_units[0]
 
     result.sim = snap
     return result
 
 
+_image_tile_size = 64
+
+
+def _assign_particles_to_tiles(nx, ny, x, y, sm, x1, x2, y1, y2, max_d, wrap_offsets_x, wrap_offsets_y,
+                               tile_size):
+    """Work out which tiles of an image each particle contributes to, following the same rules as
+    _render.render_image so that a tiled render gives the same result as rendering the whole frame.
+
+    Returns (particle, offset_x, offset_y, tile) arrays with one entry for each time a particle
+    (or one of its periodic images) contributes to a tile, ordered by tile and then in the order that
+    the whole-frame renderer would visit the particles."""
+    dx = (x2 - x1) / nx
+    dy = (y2 - y1) / ny
+    ntiles_x = (nx + tile_size - 1) // tile_size
+    single_pixel = (max_d * sm / dx < 1) & (max_d * sm / dy < 1)
+
+    particles, tiles, offset_index = [], [], []
+    offsets = [(ox, oy) for ox in wrap_offsets_x for oy in wrap_offsets_y]
+
+    for i, (ox, oy) in enumerate(offsets):
+        # wrap offsets are single precision within the renderer
+        x_i = x + float(np.float32(ox))
+        y_i = y + float(np.float32(oy))
+        in_frame = (x_i > x1 - 2 * sm) & (x_i < x2 + 2 * sm) & (y_i > y1 - 2 * sm) & (y_i < y2 + 2 * sm)
+
+        # particles rendered into a single pixel belong to the tile holding that pixel
+        sp = np.where(in_frame & single_pixel)[0]
+        x_pos = ((x_i[sp] - x1) / dx).astype(np.intp)
+        y_pos = ((y_i[sp] - y1) / dy).astype(np.intp)
+        ok = (x_pos >= 0) & (x_pos < nx) & (y_pos >= 0) & (y_pos < ny)
+        sp, x_pos, y_pos = sp[ok], x_pos[ok], y_pos[ok]
+        particles.append(sp)
+        tiles.append((y_pos // tile_size) * ntiles_x + x_pos // tile_size)
+
+        # other particles belong to every tile overlapping their range of pixels
+        mp = np.where(in_frame & ~single_pixel)[0]
+        reach = max_d * sm[mp]
+        x_start = np.clip(np.floor((x_i[mp] - reach - x1) / dx), 0, nx).astype(np.intp)
+        x_stop = np.clip(np.floor((x_i[mp] + reach - x1) / dx), 0, nx).astype(np.intp)
+        y_start = np.clip(np.floor((y_i[mp] - reach - y1) / dy), 0, ny).astype(np.intp)
+        y_stop = np.clip(np.floor((y_i[mp] + reach - y1) / dy), 0, ny).astype(np.intp)
+        ok = (x_stop > x_start) & (y_stop > y_start)
+        mp, x_start, x_stop, y_start, y_stop = mp[ok], x_start[ok], x_stop[ok], y_start[ok], y_stop[ok]
+        tx_lo, tx_hi = x_start // tile_size, (x_stop - 1) // tile_size
+        ty_lo, ty_hi = y_start // tile_size, (y_stop - 1) // tile_size
+        width = tx_hi - tx_lo + 1
+        count = width * (ty_hi - ty_lo + 1)
+        entry = np.repeat(np.arange(len(mp)), count)
+        within = np.arange(count.sum()) - np.repeat(np.cumsum(count) - count, count)
+        particles.append(mp[entry])
+        tiles.append((ty_lo[entry] + within // width[entry]) * ntiles_x + tx_lo[entry] + within % width[entry])
+
+        offset_index.append(np.full(len(sp) + len(entry), i))
+
+    particles = np.concatenate(particles)
+    tiles = np.concatenate(tiles)
+    offset_index = np.concatenate(offset_index)
+
+    # the whole-frame renderer loops over offsets, then particles
+    order = np.lexsort((particles, offset_index, tiles))
+    offsets = np.array(offsets, dtype=np.float32).reshape(-1, 2)
+    return particles[order], offsets[offset_index[order], 0], offsets[offset_index[order], 1], tiles[order]
+
+
+def _render_image_tiled(nx, ny, x, y, z, sm, x1, x2, y1, y2, qty, mass, rho, smooth_lo, smooth_hi, kernel,
+                        wrap_offsets_x, wrap_offsets_y, num_threads, tile_size=None, z_plane=0.0):
+    """Render an image by splitting it into square tiles, and distributing the tiles between threads.
+
+    Each tile is rendered by a single thread with only the particles that touch it, and written
+    directly into the output image, so that no thread needs a buffer for the full frame. Each
+    pixel receives its contributions in the same order as in a single-threaded render, so the
+    output does not depend on the number of threads or on how they are scheduled."""
+
+    if tile_size is None:
+        tile_size = _image_tile_size
+
+    x, y, z, sm = (np.asarray(q, dtype=np.float64) for q in (x, y, z, sm))
+    qty, mass, rho = (np.asarray(q) for q in (qty, mass, rho))
+
+    particles, offset_x, offset_y, tiles = _assign_particles_to_tiles(
+        nx, ny, x, y, sm, x1, x2, y1, y2, float(kernel.max_d), wrap_offsets_x, wrap_offsets_y, tile_size)
+
+    ntiles_x = (nx + tile_size - 1) // tile_size
+    ntiles_y = (ny + tile_size - 1) // tile_size
+    boundaries = np.searchsorted(tiles, np.arange(ntiles_x * ntiles_y + 1))
+
+    multiple = qty.ndim == 2
+    if multiple:
+        result = np.zeros((len(qty), ny, nx), dtype=np.float32)
+        renderer = _render.render_image_multi
+    else:
+        result = np.zeros((ny, nx), dtype=np.float32)
+        renderer = _render.render_image
+
+    # hand out the most expensive tiles first, to balance the load between threads
+    tile_queue = iter(np.argsort(-np.diff(boundaries), kind='stable'))
+    queue_lock = threading.Lock()
+
+    def render_tiles(thread_index):
+        while True:
+            with queue_lock:
+                tile = next(tile_queue, None)
+            if tile is None:
+                return
+            start, stop = boundaries[tile], boundaries[tile + 1]
+            if start == stop:
+                continue
+            tx, ty = tile % ntiles_x, tile // ntiles_x
+            px0, py0 = tx * tile_size, ty * tile_size
+            tnx, tny = min(tile_size, nx - px0), min(tile_size, ny - py0)
+            p = particles[start:stop]
+            # the tile is rendered with the pixel geometry of the whole frame
+            result[..., py0:py0 + tny, px0:px0 + tnx] = renderer(
+                nx, ny, x[p] + offset_x[start:stop], y[p] + offset_y[start:stop], z[p], sm[p],
+                x1, x2, y1, y2, 0.0, z_plane, qty[..., p], mass[p], rho[p], smooth_lo, smooth_hi, kernel,
+                x_tile_start=px0, x_tile_stop=px0 + tnx, y_tile_start=py0, y_tile_stop=py0 + tny)
+
+    _thread_map(render_tiles, range(num_threads))
+    return result
+
+
+def _visible_particles(snap, x1, x2, y1, y2, z_plane, xy_units, kernel, smooth, smooth_in_pixels):
+    """Use the snapshot's KD-tree, if one has been built, to find the particles whose smoothing region
+    meets the given frame. Returns None if all particles should be passed to the renderer."""
+
+    if not _tree_cull_image or smooth_in_pixels or not hasattr(snap, 'kdtree'):
+        return None
+
+    tree = snap.kdtree
+    tree_units = tree._pos.units
+    sm = snap[smooth]
+
+    if xy_units is None:
+        xy_units = snap['x'].units
+    if isinstance(xy_units, str):
+        xy_units = units.Unit(xy_units)
+
+    try:
+        to_tree = xy_units.ratio(tree_units, **snap.conversion_context())
+        sm_to_tree = sm.units.ratio(tree_units, **snap.conversion_context())
+    except (units.UnitsException, AttributeError):
+        # can't relate the frame or smoothing lengths to the tree, so don't cull
+        return None
+
+    # particles are rendered out to 2h in the image plane, and max_d*h from the plane for 3D kernels
+    h_factor = max(2.0, float(kernel.max_d)) * sm_to_tree
+    if kernel.h_power >= 3:
+        z_lo = z_hi = z_plane * to_tree
+    else:
+        z_lo, z_hi = -np.inf, np.inf
+
+    offsets_x = _calculate_wrapping_repeat_array(snap, x1, x2, xy_units)
+    offsets_y = _calculate_wrapping_repeat_array(snap, y1, y2, xy_units)
+    if len(offsets_x) * len(offsets_y) > 9:
+        # the image spans many periodic images, so most particles are visible anyway
+        return None
+
+    found = [tree.particles_in_box(((x1 - ox) * to_tree, (y1 - oy) * to_tree, z_lo),
+                                   ((x2 - ox) * to_tree, (y2 - oy) * to_tree, z_hi), sm, h_factor)
+             for ox in offsets_x for oy in offsets_y]
+
+    if len(found) == 1:
+        visible = np.sort(found[0])
+    else:
+        visible = np.unique(np.concatenate(found))
+
+    return visible
+
+
 def _calculate_wrapping_repeat_array(snap, x1, x2, xy_units):
     if 'boxsize' in snap.properties:
         boxsize = snap.properties['boxsize'].in_units(xy_units, **snap.conversion_context())
@@ -701,7 +1158,7 @@ def _calculate_wrapping_repeat_array(snap, x1, x2, xy_units):
 
 def to_3d_grid(snap, qty='rho', nx=None, ny=None, nz=None, x2=None, out_units=None,
                xy_units=None, kernel=Kernel(), smooth='smooth', approximate_fast=_approximate_image,
-               threaded=None, snap_slice=None, denoise=None):
+               threaded=None, snap_slice=None, denoise=None, out_file=None, slab_pixels=None):
     """
 
     Project SPH onto a grid using a typical (mass/rho)-weighted 'scatter'
@@ -731,6 +1188,27 @@ def to_3d_grid(snap, qty='rho', nx=None, ny=None, nz=None, x2=None, out_units=No
       can be useful to reduce noise especially when rendering AMR grids which
       often introduce problematic edge effects.
 
+    *out_file*: if not None, the name of a .npy file to which the grid is written.
+      The grid is then computed one slab of x-pixels at a time, using only the
+      particles whose kernels reach each slab, and the returned array is a memory
+      map onto the file. Peak memory use is therefore about one slab plus the
+      particles it contains, rather than the whole grid.
+
+    *slab_pixels*: the number of x-pixels in each slab when gridding slab by slab
+      (default: enough for roughly 256MB per slab). Passing this without an
+      *out_file* grids slab by slab into an array in memory.
+
+    *approximate_fast*: if True, grid particles with large smoothing lengths at
+      reduced resolution and interpolate (default from your configuration files)
+
+    *threaded*: if False, grid on a single core. Otherwise, the number of threads
+      to use (if None, the default specified in your configuration files). The grid
+      is then computed slab by slab, with the slabs shared between the threads, so
+      that no thread needs a grid of its own. Without *approximate_fast*, the result
+      is identical to a single-core render. With *approximate_fast*, the reduced
+      resolution grids are made and interpolated separately for each slab, so the
+      result differs slightly from a single-core render near the slab edges.
+
     """
     global config
 
@@ -766,21 +1244,24 @@ def to_3d_grid(snap, qty='rho', nx=None, ny=None, nz=None, x2=None, out_units=No
     x1, x2, y1, y2, z1, z2 = (float(q) for q in (x1, x2, y1, y2, z1, z2))
     nx, ny, nz = (int(q) for q in (nx, ny, nz))
 
-    if approximate_fast:
-        renderer = _interpolated_renderer(
-            _to_3d_grid, int(np.floor(np.log2(nx / 20))))
-    else:
-        renderer = _to_3d_grid
-
     if threaded is None:
         threaded = _get_threaded_image()
 
-    if threaded:
-        im = _threaded_render_image(renderer, snap, qty, nx, ny, nz, x1, x2, y1, y2, z1, z2, out_units,
-                                    xy_units, kernel, smooth, num_threads=threaded)
+    if out_file is not None or slab_pixels is not None or threaded:
+        # disjoint slabs of the grid, each gridded by one thread from the particles that reach it
+        im = _to_3d_grid_slabs(snap, qty, nx, ny, nz, x1, x2, y1, y2, z1, z2, out_units,
+                               xy_units, kernel, smooth, denoise, out_file, slab_pixels, snap_slice,
+                               num_threads=threaded or 1, approximate_fast=approximate_fast)
+        logger.info("Render done at %.2f s" % (time.time() - in_time))
+        return im
+
+    if approximate_fast:
+        renderer = _interpolated_renderer(_to_3d_grid, _grid_levels(nx))
     else:
-        im = renderer(snap, qty, nx, ny, nz, x1, x2, y1, y2, z1, z2, out_units,
-                      xy_units, kernel, smooth, False)
+        renderer = _to_3d_grid
+
+    im = renderer(snap, qty, nx, ny, nz, x1, x2, y1, y2, z1, z2, out_units,
+                  xy_units, kernel, smooth, False, snap_slice=snap_slice)
 
     logger.info("Render done at %.2f s" % (time.time() - in_time))
 
@@ -798,10 +1279,191 @@ def to_3d_grid(snap, qty='rho', nx=None, ny=None, nz=None, x2=None, out_units=No
         return im
 
 
+def _grid_levels(nx):
+    """The number of resolution levels used by approximate_fast gridding of nx pixels"""
+    return max(int(np.floor(np.log2(nx / 20))), 1)
+
+
+def _assign_particles_to_slabs(x, reach, x1, x2, nx, slab_pixels, wrap_offsets):
+    """Work out which particles, with positions x and kernel extents reach, can contribute to each slab
+    of slab_pixels x-pixels.
+
+    Returns (particles, boundaries) such that the particles for slab i are particles[boundaries[i]:boundaries[i+1]],
+    in increasing order."""
+
+    dx = (x2 - x1) / nx
+    n_slabs = (nx + slab_pixels - 1) // slab_pixels
+    n_part = len(x)
+
+    keys = []
+    for offset in wrap_offsets:
+        # allow an extra pixel either side, since particles are assigned to pixels by truncation
+        pix_lo = np.floor((x + offset - reach - x1) / dx) - 1
+        pix_hi = np.floor((x + offset + reach - x1) / dx) + 1
+        overlaps = np.where((pix_hi >= 0) & (pix_lo < nx))[0]
+        slab_lo = np.clip(pix_lo[overlaps], 0, nx - 1).astype(np.int64) // slab_pixels
+        slab_hi = np.clip(pix_hi[overlaps], 0, nx - 1).astype(np.int64) // slab_pixels
+        counts = slab_hi - slab_lo + 1
+        first = np.repeat(np.cumsum(counts) - counts, counts)
+        slabs = np.repeat(slab_lo, counts) + np.arange(counts.sum()) - first
+        keys.append(slabs * n_part + np.repeat(overlaps, counts))
+
+    # unique removes any duplicates from different periodic images and sorts by slab, then by particle
+    keys = np.unique(np.concatenate(keys))
+    slabs, particles = np.divmod(keys, n_part)
+    boundaries = np.searchsorted(slabs, np.arange(n_slabs + 1))
+    return particles, boundaries
+
+
+def _to_3d_grid_slab_levels(snap, qty, nx, ny, nz, x1, x2, y1, y2, z1, z2, out_units,
+                            xy_units, kernel, smooth, particles, x_slab_start, x_slab_stop, levels):
+    """Grid the given slab of x-pixels using the approximate_fast scheme with the given number of levels.
+
+    Particles with large smoothing lengths are gridded onto coarse grids whose x-pixels are exactly
+    2, 4, ... times the full-resolution ones, extending one coarse pixel either side of the slab, and
+    these are then interpolated onto the slab. The particles passed in must reach the extended slab."""
+
+    x_slab = (x_slab_start, x_slab_stop)
+    im = _to_3d_grid(snap, qty, nx, ny, nz, x1, x2, y1, y2, z1, z2, out_units, xy_units, kernel, smooth,
+                     snap_slice=particles, smooth_range=(0, 2), x_slab=x_slab)
+
+    dx, dy, dz = (x2 - x1) / nx, (y2 - y1) / ny, (z2 - z1) / nz
+    slab_nx = x_slab_stop - x_slab_start
+    slab_x1 = x1 + x_slab_start * dx
+    for i in range(1, levels):
+        sub = 1 << i
+        coarse_nx = -(-slab_nx // sub) + 2
+        # shift the y and z boundaries as in _to_3d_grid
+        sy, sz = (d_i * float(sub - 1) / 2 for d_i in (dy, dz))
+        coarse = _to_3d_grid(snap, qty, coarse_nx, ny // sub, nz // sub,
+                             slab_x1 - sub * dx, slab_x1 + (coarse_nx - 1) * sub * dx,
+                             y1 - sy, y2 + sy, z1 - sz, z2 + sz, out_units, xy_units, kernel, smooth,
+                             snap_slice=particles,
+                             smooth_range=(1, 100000) if i == levels - 1 else (1, 2)).view(np.ndarray)
+        coarse = scipy.ndimage.zoom(coarse, (1, float(ny) / coarse.shape[1], float(nz) / coarse.shape[2]),
+                                    order=1)
+        # linear interpolation in x, from the coarse pixel centres to those of the slab
+        position = (np.arange(slab_nx) + 0.5) / sub + 0.5
+        index = position.astype(np.intp)
+        weight = (position - index)[:, np.newaxis, np.newaxis]
+        im += (1 - weight) * coarse[index] + weight * coarse[index + 1]
+    return im
+
+
+def _to_3d_grid_slab(snap, qty, nx, ny, nz, x1, x2, y1, y2, z1, z2, out_units,
+                     xy_units, kernel, smooth, denoise, particles, x_slab_start, x_slab_stop, levels=1):
+    """Grid the given slab of x-pixels, using only the specified particles.
+
+    With levels>1, the slab is gridded with the approximate_fast scheme (see _to_3d_grid_slab_levels)."""
+
+    if levels > 1:
+        def renderer(qty, out_units):
+            return _to_3d_grid_slab_levels(snap, qty, nx, ny, nz, x1, x2, y1, y2, z1, z2, out_units, xy_units,
+                                           kernel, smooth, particles, x_slab_start, x_slab_stop, levels)
+    else:
+        def renderer(qty, out_units):
+            return _to_3d_grid(snap, qty, nx, ny, nz, x1, x2, y1, y2, z1, z2, out_units, xy_units, kernel, smooth,
+                               snap_slice=particles, x_slab=(x_slab_start, x_slab_stop))
+
+    im = renderer(qty, out_units)
+    if denoise:
+        flat = renderer('__one', None)
+        im_units = im.units
+        im = im / flat
+        im.units = im_units
+    return im
+
+
+def _to_3d_grid_slabs(snap, qty, nx, ny, nz, x1, x2, y1, y2, z1, z2, out_units,
+                      xy_units, kernel, smooth, denoise, out_file, slab_pixels, snap_slice, num_threads=1,
+                      approximate_fast=False):
+    """Grid the particles one slab of x-pixels at a time, into a memory-mapped .npy file if out_file is given.
+
+    With num_threads>1, slabs are handed out to a pool of threads. Each slab is written by exactly one
+    thread, so no reduction over per-thread grids is needed and, without approximate_fast, the result is
+    identical to a single-threaded render."""
+
+    if snap_slice is not None:
+        snap = snap[snap_slice]
+
+    num_threads = max(int(num_threads), 1)
+
+    if slab_pixels is None:
+        slab_pixels = (1 << 26) // (ny * nz)
+        if num_threads > 1:
+            # several slabs per thread, so that threads finishing early can pick up more work
+            slab_pixels = min(slab_pixels, -(-nx // (4 * num_threads)))
+    slab_pixels = max(int(slab_pixels), 1)
+
+    levels = _grid_levels(nx) if approximate_fast else 1
+
+    if out_file is not None:
+        result = np.lib.format.open_memmap(out_file, mode='w+', dtype=np.float32, shape=(nx, ny, nz))
+    else:
+        result = np.empty((nx, ny, nz), dtype=np.float32)
+
+    if xy_units is None:
+        xy_units = snap['x'].units
+
+    x = snap['x'].in_units(xy_units).view(np.ndarray)
+    reach = max(2.0, float(kernel.max_d)) * snap[smooth].in_units(xy_units).view(np.ndarray)
+    if levels > 1:
+        # the coarse grids extend one coarse pixel either side of each slab
+        reach += (1 << (levels - 1)) * (x2 - x1) / nx
+    particles, boundaries = _assign_particles_to_slabs(x, reach, x1, x2, nx, slab_pixels,
+                                                       _calculate_wrapping_repeat_array(snap, x1, x2, xy_units))
+    del x, reach
+
+    # make sure any derived arrays are calculated before the threads start
+    for arname in qty, 'mass', 'rho':
+        snap[arname]
+
+    if denoise:
+        snap['__one'] = 1
+
+    # hand out the most expensive slabs first, to balance the load between threads
+    slab_queue = iter(np.argsort(-np.diff(boundaries), kind='stable'))
+    queue_lock = threading.Lock()
+    result_units = []
+
+    def grid_slabs(thread_index):
+        while True:
+            with queue_lock:
+                slab = next(slab_queue, None)
+            if slab is None:
+                return
+            x_slab_start = slab * slab_pixels
+            x_slab_stop = min(x_slab_start + slab_pixels, nx)
+            im = _to_3d_grid_slab(snap, qty, nx, ny, nz, x1, x2, y1, y2, z1, z2, out_units,
+                                  xy_units, kernel, smooth, denoise, particles[boundaries[slab]:boundaries[slab + 1]],
+                                  x_slab_start, x_slab_stop, levels)
+            result[x_slab_start:x_slab_stop] = im
+            result_units.append(im.units)
+            logger.info("Gridded x-pixels %d to %d of %d" % (x_slab_start, x_slab_stop, nx))
+
+    try:
+        if num_threads > 1:
+            _thread_map(grid_slabs, range(num_threads))
+        else:
+            grid_slabs(0)
+    finally:
+        if denoise:
+            del snap.ancestor['__one']
+
+    if out_file is not None:
+        result.flush()
+
+    result = result.view(array.SimArray)
+    if len(result_units) > 0:
+        result.units = result_units[0]
+    result.sim = snap
+    return result
+
+
 def _to_3d_grid(snap, qty, nx, ny, nz, x1, x2, y1, y2, z1, z2, out_units,
                 xy_units, kernel, smooth, __threaded=False, res_downgrade=None,
                 snap_slice=None,
-                smooth_range=None):
+                smooth_range=None, x_slab=None):
 
     snap_proxy = {}
 
@@ -831,9 +1493,6 @@ def _to_3d_grid(snap, qty, nx, ny, nz, x1, x2, y1, y2, z1, z2, out_units,
         y2 += sy
         z2 += sz
 
-    result = np.zeros((nx, ny, nz), dtype=np.float32)
-    n_part = len(snap)
-
     if xy_units is None:
         xy_units = snap_proxy['x'].units
 
@@ -866,11 +1525,15 @@ def _to_3d_grid(snap, qty, nx, ny, nz, x1, x2, y1, y2, z1, z2, out_units,
 
     logger.info("Gridding particles")
 
+    if x_slab is None:
+        x_slab = (0, nx)
+
     result = _render.to_3d_grid(nx,ny,nz,x,y,z,sm,x1,x2,y1,y2,z1,z2,
                                 qty,mass,rho,smooth_lo,smooth_hi,kernel,
                                 _calculate_wrapping_repeat_array(snap, x1, x2, xy_units),
                                 _calculate_wrapping_repeat_array(snap, y1, y2, xy_units),
-                                _calculate_wrapping_repeat_array(snap, z1, z2, xy_units))
+                                _calculate_wrapping_repeat_array(snap, z1, z2, xy_units),
+                                x_slab[0], x_slab[1])
     result = result.view(array.SimArray)
 
     # The weighting works such that there is a factor of (M_u/rho_u)h_u^3
@@ -892,121 +1555,191 @@ def _to_3d_grid(snap, qty, nx, ny, nz, x1, x2, y1, y2, z1, z2, out_units,
     result.sim = snap
     return result
 
+# Rest wavelength (Angstrom) and oscillator strength of the strongest transition of each ion
+_absorption_lines = {('H', 'I'): (1215.6701, 0.4164),
+                     ('He', 'II'): (303.7822, 0.4162),
+                     ('C', 'IV'): (1548.2040, 0.1899),
+                     ('O', 'VI'): (1031.9261, 0.1325),
+                     ('Mg', 'II'): (2796.3540, 0.6155),
+                     ('Si', 'IV'): (1393.7550, 0.5140)}
+
+_nucleons = {'H': 1, 'He': 4, 'Li': 6, 'Ne': 10, 'C': 12, 'N': 14, 'O': 16, 'Mg': 24, 'Si': 28,
+             'S': 32, 'Ca': 40, 'Fe': 56}
+
+
+def _sightline_particles(snap, x_sight, y_sight, xy_units, kernel, smooth, num_threads=1):
+    """Find the particles whose smoothing region meets each sightline (parallel to the z axis).
+
+    The sightlines are shared between num_threads threads; the tree searches release the GIL.
+
+    Returns (offsets, particles), such that the particles contributing to sightline s are
+    particles[offsets[s]:offsets[s+1]], in increasing order."""
+
+    sm = snap[smooth]
+    try:
+        build_tree(snap)
+        tree = snap.kdtree
+        to_tree = xy_units.ratio(tree._pos.units, **snap.conversion_context())
+        sm_to_tree = sm.units.ratio(tree._pos.units, **snap.conversion_context())
+    except (units.UnitsException, AttributeError):
+        tree = None
+
+    if tree is not None:
+        h_factor = float(kernel.max_d) * sm_to_tree
+
+        def find(xs, ys):
+            return np.sort(tree.particles_in_box((xs * to_tree, ys * to_tree, -np.inf),
+                                                 (xs * to_tree, ys * to_tree, np.inf), sm, h_factor))
+    else:
+        # positions can't be related to the tree, so fall back to a brute-force search
+        x = snap['x'].in_units(xy_units).view(np.ndarray)
+        y = snap['y'].in_units(xy_units).view(np.ndarray)
+        reach = float(kernel.max_d) * sm.in_units(xy_units).view(np.ndarray)
+
+        def find(xs, ys):
+            return np.where((np.abs(x - xs) < reach) & (np.abs(y - ys) < reach))[0]
+
+    found = [None] * len(x_sight)
+    if len(found) > 0:
+        # the first tree search calculates the maximum smoothing length in each node, which the
+        # others then only read, so it must happen before the threads start
+        found[0] = find(x_sight[0], y_sight[0])
+
+    def find_sightlines(thread_index):
+        for s in range(1 + thread_index, len(found), num_threads):
+            found[s] = find(x_sight[s], y_sight[s])
+
+    if num_threads > 1:
+        _thread_map(find_sightlines, range(num_threads))
+    else:
+        find_sightlines(0)
+
+    offsets = np.zeros(len(found) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(f) for f in found])
+    if len(found) > 0:
+        particles = np.concatenate(found).astype(np.int64)
+    else:
+        particles = np.zeros(0, dtype=np.int64)
+    return offsets, particles
+
+
 def spectra(snap, qty='rho', x1=0.0, y1=0.0, v2=400, nvel=200, v1=None,
             element='H', ion='I',
-            xy_units=units.Unit('kpc'), vel_units = units.Unit('km s^-1'),
-            smooth='smooth', __threaded=False) :
-
+            xy_units=units.Unit('kpc'), vel_units=units.Unit('km s^-1'),
+            smooth='smooth', threaded=None):
     """
 
-    Render an SPH spectrum using a (mass/rho)-weighted 'scatter'
-    scheme of all the particles that have a smoothing length within
-    2 h_sm of the position.
+    Render SPH absorption spectra along one or more sightlines parallel to the z axis,
+    using a (mass/rho)-weighted 'scatter' scheme of all the particles whose smoothing
+    region meets each sightline.
+
+    Each particle contributes a column density, which is spread in velocity about its
+    z-velocity with a Gaussian profile of thermal Doppler parameter b = sqrt(2kT/m).
+    The particles contributing to each sightline are found with the snapshot's KD-tree
+    (built if necessary), and sightlines are shared between threads.
 
     **Keyword arguments:**
 
-    *qty* ('rho'): The name of the array within the simulation to render
+    *qty* ('rho'): The name of the array within the simulation giving the (mass)
+      density of the absorbing ion
 
-    *x1* (0.0): The x-coordinate of the line of sight.
+    *x1* (0.0): The x-coordinate of the line of sight, or an array of x-coordinates
 
-    *y1* (0.0): The y-coordinate of the line of sight.
+    *y1* (0.0): The y-coordinate of the line of sight, or an array of y-coordinates
 
-    *v1* (-400.0): The minimum velocity of the spectrum
+    *v1* (-v2): The minimum velocity of the spectrum
 
     *v2* (400.0): The maximum velocity of the spectrum
 
-    *nvel* (500): The number of resolution elements in spectrum
+    *nvel* (200): The number of resolution elements in spectrum
+
+    *element* ('H'), *ion* ('I'): The absorbing species; the strongest transition of
+      the ion is used
 
     *xy_units* ('kpc'): The units for the x and y axes
 
+    *vel_units* ('km s^-1'): The units for the velocity axis
+
     *smooth*: The name of the array which contains the smoothing lengths
       (default 'smooth')
 
+    *threaded*: if False, render on a single core. Otherwise, the number of threads to
+      use (defaults to a value specified in your configuration files)
+
+    **Returns:** (vels, tau), the centres of the velocity bins and the mean optical depth
+    in each bin. If x1 and y1 are arrays, tau has shape (n_sightlines, nvel); otherwise
+    it has shape (nvel,).
+
     """
 
-    global config
+    if (element, ion) not in _absorption_lines:
+        raise ValueError("No line data for %s %s; available ions are %s" %
+                         (element, ion, ", ".join(e + " " + i for e, i in _absorption_lines)))
+    wavelength, f_osc = _absorption_lines[(element, ion)]
+    nnucleons = _nucleons[element]
+
+    kernel = Kernel2D()
 
-    if config["tracktime"] :
-        import time
-        in_time = time.time()
-    
-    kernel=Kernel2D()
-            
     if v1 is None:
         v1 = -v2
+    v1, v2, nvel = float(v1), float(v2), int(nvel)
     dvel = (v2 - v1) / nvel
-    v1, v2, dvel, nvel = (float(q) for q in (v1,v2,dvel,nvel))
-    vels = np.arange(v1+0.5*dvel, v2, dvel)
+    vels = array.SimArray(v1 + dvel * (np.arange(nvel) + 0.5), vel_units)
 
-    tau = np.zeros((nvel),dtype=np.float32)
-    
-    n_part = len(snap)
-
-    if xy_units is None :
+    if xy_units is None:
         xy_units = snap['x'].units
+    if isinstance(xy_units, str):
+        xy_units = units.Unit(xy_units)
+    if isinstance(vel_units, str):
+        vel_units = units.Unit(vel_units)
 
-    x = snap['x'].in_units(xy_units) - x1
-    y = snap['y'].in_units(xy_units) - y1
-    vz = snap['vz'].in_units(vel_units)
-    temp = snap['temp'].in_units(units.Unit('K'))
+    single = np.ndim(x1) == 0 and np.ndim(y1) == 0
+    x_sight, y_sight = np.broadcast_arrays(np.atleast_1d(np.asarray(x1, dtype=np.float64)),
+                                           np.atleast_1d(np.asarray(y1, dtype=np.float64)))
+    x_sight = np.ascontiguousarray(x_sight)
+    y_sight = np.ascontiguousarray(y_sight)
 
-    sm = snap[smooth]
-
-    if sm.units!=x.units :
-        sm = sm.in_units(x.units)
+    if threaded is None:
+        threaded = _get_threaded_image()
+    num_threads = max(int(threaded), 1)
 
-    nucleons = {'H':1, 'He':4, 'Li':6, 'Ne':10, 'C':12, 'N':14, 'O':16, 'Mg':24, 'Si':28,
-                'S':32, 'Ca':40, 'Fe':56}
+    offsets, particles = _sightline_particles(snap, x_sight, y_sight, xy_units, kernel, smooth, num_threads)
 
-    nnucleons = nucleons[element]
-    
-    qty_s = qty
+    x = snap['x'].in_units(xy_units)
+    y = snap['y'].in_units(xy_units)
+    vz = snap['vz'].in_units(vel_units)
+    temp = snap['temp'].in_units('K')
+    sm = snap[smooth].in_units(xy_units)
     qty = snap[qty]
     mass = snap['mass']
     rho = snap['rho']
 
-    conv_ratio = (qty.units*mass.units/(rho.units*sm.units**kernel.h_power)).ratio(str(nnucleons)+' m_p cm^-2', **x.conversion_context())
+    conv_ratio = (qty.units * mass.units / (rho.units * sm.units ** kernel.h_power)).ratio(
+        str(nnucleons) + ' m_p cm^-2', **x.conversion_context())
 
-    try :
-        kernel.safe.acquire(True)
-        code = kernel.get_c_code()
-    finally :
-        kernel.safe.release()
+    b_ratio = (2 * units.k * units.K / (nnucleons * units.m_p)).ratio(vel_units ** 2)
+    b = np.sqrt(b_ratio * temp.view(np.ndarray))
+    column = (qty * mass / rho).view(np.ndarray)
 
-    if __threaded :
-        code+="#define THREAD 1\n"
-    
-        
-    code+=file(os.path.join(os.path.dirname(__file__),'sph_spectra.c')).read()
-
-    # before inlining, the views on the arrays must be standard np.ndarray
-    # otherwise the normal numpy macros are not generated
-    x,y,vz,temp,sm,qty, mass, rho = (q.view(np.ndarray) for q in (x,y,vz,temp,sm,qty, mass, rho))
-
-    if config['verbose']: print("Constructing SPH spectrum", file=sys.stderr)
-
-    if config["tracktime"] :
-        print("Beginning SPH render at %.2f s"%(time.time()-in_time), file=sys.stderr)
-    #import pdb; pdb.set_trace()
-    util.threadsafe_inline( code, ['tau', 'nvel', 'x', 'y', 'vz', 'temp', 'sm', 'v1', 'v2',
-                   'nnucleons','qty', 'mass', 'rho'],verbose=2)
-
-    if config["tracktime"] :
-        print("Render done at %.2f s"%(time.time()-in_time), file=sys.stderr)
-
-    mass_e = 9.10938188e-28
-    e = 4.803206e-10
-    c = 2.99792458e10
-    pi = 3.14159267
-    tauconst = pi*e*e / mass_e / c / np.sqrt(pi)
-    oscwav0 = 1031.9261*0.13250*1e-8
-    tau = tauconst*oscwav0*tau*conv_ratio
-    #tau = tau*conv_ratio
-    print("tauconst: %g oscwav0: %g"%(tauconst,oscwav0))
-    print("tauconst*oscwav0: %g"%(tauconst*oscwav0))
-    print("conv_ratio: %g"%conv_ratio)
-    print("max(N): %g"%(np.max(tau)))
-    tau = tau.view(array.SimArray)
+    x, y, vz, b, sm, column = (np.ascontiguousarray(q, dtype=np.float64)
+                               for q in (x, y, vz, b, sm, column))
+
+    logger.info("Rendering %d SPH spectra" % len(x_sight))
+    start = time.time()
+    N = _render.render_spectra(offsets, particles, x_sight, y_sight, x, y, vz, b, sm, column,
+                               v1, v2, nvel, kernel, num_threads)
+    logger.info("Spectra done in %5.3g s" % (time.time() - start))
 
+    # tau = (pi e^2 / m_e c) f lambda N(v), with N(v) the column density per unit velocity
+    # averaged over each bin (cgs)
+    sigma_line = np.pi * 4.80320425e-10 ** 2 / (9.1093837015e-28 * 2.99792458e10) * f_osc * wavelength * 1e-8
+    dvel_cgs = dvel * vel_units.ratio('cm s^-1')
+    tau = N * (conv_ratio * sigma_line / dvel_cgs)
+
+    if single:
+        tau = tau[0]
+
+    tau = tau.view(array.SimArray)
+    tau.units = units.Unit("1")
     tau.sim = snap
     return vels, tau
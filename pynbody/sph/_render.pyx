@@ -3,7 +3,8 @@ import numpy as np
 cimport numpy as np
 cimport cython
 cimport libc.math as cmath
-from libc.math cimport atan, pow
+from cython.parallel import prange
+from libc.math cimport atan, pow, erf, floor
 from libc.stdlib cimport malloc, free
 
 # The following slightly odd repetitiveness is to force Cython to generate
@@ -119,22 +120,44 @@ cdef image_output_type get_kernel_xyz(fixed_input_type x, fixed_input_type y, fi
 
 
 
+def render_image(int nx, int ny, x, y, z, sm, x1, x2, y1, y2, z_camera, z0, qty, mass, rho, smooth_lo, smooth_hi,
+                 kernel, wrap_offsets_x=[0], wrap_offsets_y=[0], **tile) :
+    """Render the (mass/rho)-weighted SPH image of qty, with shape (ny, nx), onto the frame
+    [x1,x2]x[y1,y2] (at z=z0 for 3D kernels). If z_camera is non-zero, a perspective image is
+    made from a camera at that position. Only particles with smoothing lengths between smooth_lo
+    and smooth_hi pixels are included. See render_image_multi, which does the work and describes
+    the optional tile keywords."""
+    return render_image_multi(nx, ny, x, y, z, sm, x1, x2, y1, y2, z_camera, z0, qty[np.newaxis, :], mass, rho,
+                              smooth_lo, smooth_hi, kernel, wrap_offsets_x, wrap_offsets_y, **tile)[0]
+
+
+
+
 @cython.boundscheck(False)
 @cython.wraparound(False)
 @cython.cdivision(True)
-def render_image(int nx, int ny,
+def render_image_multi(int nx, int ny,
                  np.ndarray[fused_input_type_1,ndim=1] x,
                  np.ndarray[fused_input_type_1,ndim=1] y,
                  np.ndarray[fused_input_type_1,ndim=1] z,
                  np.ndarray[fused_input_type_2,ndim=1] sm,
                  fixed_input_type x1,fixed_input_type x2,fixed_input_type y1,
                  fixed_input_type y2,fixed_input_type z_camera, fixed_input_type z0,
-                 np.ndarray[fused_input_type_3,ndim=1] qty,
+                 np.ndarray[fused_input_type_3,ndim=2] qty,
                  np.ndarray[fused_input_type_4,ndim=1] mass,
                  np.ndarray[fused_input_type_5,ndim=1] rho,
                  fixed_input_type smooth_lo, fixed_input_type smooth_hi,
                  kernel,
-                 wrap_offsets_x=[0], wrap_offsets_y=[0]) :
+                 wrap_offsets_x=[0], wrap_offsets_y=[0],
+                 int x_tile_start=0, int x_tile_stop=-1, int y_tile_start=0, int y_tile_stop=-1) :
+    """As render_image, but for several quantities at once. qty has shape (nq, n_part) and the
+    result has shape (nq, ny, nx). The kernel is evaluated once for each particle and pixel, and
+    each image is identical to rendering the corresponding quantity alone.
+
+    If the tile keywords are given, only the pixels in [x_tile_start, x_tile_stop) and
+    [y_tile_start, y_tile_stop) are computed, and the result has shape
+    (nq, y_tile_stop-y_tile_start, x_tile_stop-x_tile_start). The values are identical to the
+    corresponding part of the full image. Tiles are not supported for perspective images."""
 
     cdef fixed_input_type pixel_dx = (x2-x1)/nx
     cdef fixed_input_type pixel_dy = (y2-y1)/ny
@@ -142,7 +165,10 @@ def render_image(int nx, int ny,
     cdef fixed_input_type y_start = y1+pixel_dy/2
     cdef int n_part = len(x)
     cdef int nn=0, i=0
-    cdef fixed_input_type x_i, y_i, z_i, sm_i, qty_i
+    cdef fixed_input_type x_i, y_i, z_i, sm_i
+    cdef image_output_type kernel_val
+    cdef int nq = qty.shape[0]
+    cdef int k
     cdef fixed_input_type x_pixel, y_pixel, z_pixel
     cdef int x_pos, y_pos
     cdef int x_pix_start, x_pix_stop, y_pix_start, y_pix_stop
@@ -168,7 +194,22 @@ def render_image(int nx, int ny,
 
     cdef fixed_input_type kernel_max_2 # minimize casting when same type as input
 
-    cdef np.ndarray[image_output_type,ndim=2] result = np.zeros((ny,nx),dtype=np_image_output_type)
+    if x_tile_stop<0 or x_tile_stop>nx :
+        x_tile_stop = nx
+    if x_tile_start<0 :
+        x_tile_start = 0
+    if y_tile_stop<0 or y_tile_stop>ny :
+        y_tile_stop = ny
+    if y_tile_start<0 :
+        y_tile_start = 0
+
+    assert z_camera==0.0 or (x_tile_start==0 and x_tile_stop==nx and y_tile_start==0 and y_tile_stop==ny), \
+        "Tiles are not supported for perspective images"
+
+    cdef np.ndarray[image_output_type,ndim=3] result = np.zeros((nq,max(y_tile_stop-y_tile_start, 0),
+                                                                 max(x_tile_stop-x_tile_start, 0)),
+                                                                dtype=np_image_output_type)
+    cdef np.ndarray[fixed_input_type,ndim=1] qty_i = np.zeros(nq,dtype=np.float64)
 
     z_pixel = z0
     cdef int total_ptcls = 0
@@ -176,7 +217,7 @@ def render_image(int nx, int ny,
     cdef int use_z = 1 if kernel_dim>=3 else 0
 
     assert kernel_dim==2 or kernel_dim==3, "Only kernels of dimension 2 or 3 currently supported"
-    assert len(x) == len(y) == len(z) == len(sm) == len(qty) == len(mass) == len(rho), "Inconsistent array lengths passed to render_image_core"
+    assert len(x) == len(y) == len(z) == len(sm) == qty.shape[1] == len(mass) == len(rho), "Inconsistent array lengths passed to render_image_multi"
 
     for wrap_offset_x in wrap_offsets_x :
         for wrap_offset_y in wrap_offsets_y :
@@ -184,7 +225,7 @@ def render_image(int nx, int ny,
                 for i in range(n_part) :
                     # load particle details
                     x_i = x[i]+wrap_offset_x; y_i=y[i]+wrap_offset_y;
-                    z_i=z[i]; sm_i = sm[i]; qty_i = qty[i]*mass[i]/rho[i]
+                    z_i=z[i]; sm_i = sm[i]
 
                     if z_camera!=0.0 :
                         # perspective image -
@@ -213,6 +254,9 @@ def render_image(int nx, int ny,
                             and x_i>x1-2*sm_i and x_i<x2+2*sm_i and y_i>y1-2*sm_i and y_i<y2+2*sm_i) :
                         continue
 
+                    for k in range(nq) :
+                        qty_i[k] = qty[k,i]*mass[i]/rho[i]
+
                     # pre-cache sm^kdim and (sm*max_d_over_h)**2; tests showed massive speedups when doing this
                     if kernel_dim==2 :
                         sm_to_kdim = sm_i*sm_i
@@ -233,38 +277,28 @@ def render_image(int nx, int ny,
                         y_pixel = (pixel_dy*<fixed_input_type>(y_pos)+y_start)
 
                         # final bounds check
-                        if x_pos>=0 and x_pos<nx and y_pos>=0 and y_pos<ny :
-                            result[y_pos,x_pos]+=qty_i*get_kernel_xyz(x_i-x_pixel, y_i-y_pixel, (z_i-z_pixel)*use_z, kernel_max_2 ,sm_to_kdim,num_samples,samples_c)
+                        if x_pos>=x_tile_start and x_pos<x_tile_stop and y_pos>=y_tile_start and y_pos<y_tile_stop :
+                            kernel_val = get_kernel_xyz(x_i-x_pixel, y_i-y_pixel, (z_i-z_pixel)*use_z, kernel_max_2 ,sm_to_kdim,num_samples,samples_c)
+                            for k in range(nq) :
+                                result[k,y_pos-y_tile_start,x_pos-x_tile_start]+=qty_i[k]*kernel_val
                     else :
                         # multi-pixel
                         x_pix_start = int((x_i-max_d_over_h*sm_i-x1)/pixel_dx)
                         x_pix_stop =  int((x_i+max_d_over_h*sm_i-x1)/pixel_dx)
                         y_pix_start = int((y_i-max_d_over_h*sm_i-y1)/pixel_dy)
                         y_pix_stop =  int((y_i+max_d_over_h*sm_i-y1)/pixel_dy)
-                        if x_pix_start<0 : x_pix_start = 0
-                        if x_pix_stop>nx : x_pix_stop = nx
-                        if y_pix_start<0 : y_pix_start = 0
-                        if y_pix_stop>ny : y_pix_stop = ny
+                        if x_pix_start<x_tile_start : x_pix_start = x_tile_start
+                        if x_pix_stop>x_tile_stop : x_pix_stop = x_tile_stop
+                        if y_pix_start<y_tile_start : y_pix_start = y_tile_start
+                        if y_pix_stop>y_tile_stop : y_pix_stop = y_tile_stop
                         for x_pos in range(x_pix_start, x_pix_stop) :
                             x_pixel = pixel_dx*<fixed_input_type>(x_pos)+x_start
                             for y_pos in range(y_pix_start, y_pix_stop) :
                                 y_pixel = pixel_dy*<fixed_input_type>(y_pos)+y_start
 
-                                # could accessing the buffer manually be
-                                # faster? It seems to be FAR faster (x10!) but
-                                # only when using stack-allocated memory for
-                                # c_result, and when writing to memory, not
-                                # also reading (i.e. = instead of +=).  The
-                                # instruction that, according to Instruments,
-                                # holds everything up and disappears is
-                                # cvtss2sd, but it's not clear to me why this
-                                # disappears from the compiled version in the
-                                # instance described above.  Anyway for now, there
-                                # is no advantage to the manual approach -
-
-                                #c_result[x_pos+nx*y_pos]+=qty_i*get_kernel_xyz(x_i-x_pixel, y_i-y_pixel, (z_i-z_pixel)*use_z, kernel_max_2 ,sm_to_kdim,num_samples,samples_c)
-
-                                result[y_pos,x_pos]+=qty_i*get_kernel_xyz(x_i-x_pixel, y_i-y_pixel, (z_i-z_pixel)*use_z, kernel_max_2 ,sm_to_kdim,num_samples,samples_c)
+                                kernel_val = get_kernel_xyz(x_i-x_pixel, y_i-y_pixel, (z_i-z_pixel)*use_z, kernel_max_2 ,sm_to_kdim,num_samples,samples_c)
+                                for k in range(nq) :
+                                    result[k,y_pos-y_tile_start,x_pos-x_tile_start]+=qty_i[k]*kernel_val
 
     return result
 
@@ -286,13 +320,18 @@ def to_3d_grid(int nx, int ny, int nz,
                  np.ndarray[fused_input_type_5,ndim=1] rho,
                  fixed_input_type smooth_lo, fixed_input_type smooth_hi,
                  kernel,
-                 wrap_offsets_x=[0], wrap_offsets_y=[0],wrap_offsets_z=[0]) :
+                 wrap_offsets_x=[0], wrap_offsets_y=[0],wrap_offsets_z=[0],
+                 int x_slab_start=0, int x_slab_stop=-1) :
+    """Grid particles onto the (nx, ny, nz) cube spanning [x1,x2]x[y1,y2]x[z1,z2].
 
+    If x_slab_start and x_slab_stop are given, only the x-pixels in [x_slab_start, x_slab_stop)
+    are computed and an array of shape (x_slab_stop-x_slab_start, ny, nz) is returned. The
+    values are identical to the corresponding slab of the full cube."""
 
 
     cdef fixed_input_type pixel_dx = (x2-x1)/nx
     cdef fixed_input_type pixel_dy = (y2-y1)/ny
-    cdef fixed_input_type pixel_dz = (z2-z1)/ny
+    cdef fixed_input_type pixel_dz = (z2-z1)/nz
     cdef fixed_input_type x_start = x1+pixel_dx/2
     cdef fixed_input_type y_start = y1+pixel_dy/2
     cdef fixed_input_type z_start = z1+pixel_dz/2
@@ -313,7 +352,12 @@ def to_3d_grid(int nx, int ny, int nz,
 
     cdef fixed_input_type kernel_max_2 # minimize casting when same type as input
 
-    cdef np.ndarray[image_output_type,ndim=3] result = np.zeros((nx,ny,nz),dtype=np_image_output_type)
+    if x_slab_stop<0 or x_slab_stop>nx :
+        x_slab_stop = nx
+    if x_slab_start<0 :
+        x_slab_start = 0
+
+    cdef np.ndarray[image_output_type,ndim=3] result = np.zeros((max(x_slab_stop-x_slab_start, 0),ny,nz),dtype=np_image_output_type)
 
     cdef int total_ptcls = 0
 
@@ -372,9 +416,9 @@ def to_3d_grid(int nx, int ny, int nz,
                             z_pixel = (pixel_dz*<fixed_input_type>(z_pos)+z_start)
 
                             # final bounds check
-                            if x_pos>=0 and x_pos<nx and y_pos>=0 and y_pos<ny \
+                            if x_pos>=x_slab_start and x_pos<x_slab_stop and y_pos>=0 and y_pos<ny \
                                and z_pos>=0 and z_pos<nz :
-                                result[x_pos,y_pos,z_pos]+=qty_i*get_kernel_xyz(x_i-x_pixel, y_i-y_pixel, (z_i-z_pixel)*use_z, kernel_max_2 ,sm_to_kdim,num_samples,samples_c)
+                                result[x_pos-x_slab_start,y_pos,z_pos]+=qty_i*get_kernel_xyz(x_i-x_pixel, y_i-y_pixel, (z_i-z_pixel)*use_z, kernel_max_2 ,sm_to_kdim,num_samples,samples_c)
                         else :
                             # multi-pixel
                             x_pix_start = int((x_i-max_d_over_h*sm_i-x1)/pixel_dx)
@@ -383,8 +427,8 @@ def to_3d_grid(int nx, int ny, int nz,
                             y_pix_stop =  int((y_i+max_d_over_h*sm_i-y1)/pixel_dy)
                             z_pix_start = int((z_i-max_d_over_h*sm_i-z1)/pixel_dz)
                             z_pix_stop =  int((z_i+max_d_over_h*sm_i-z1)/pixel_dz)
-                            if x_pix_start<0 : x_pix_start = 0
-                            if x_pix_stop>nx : x_pix_stop = nx
+                            if x_pix_start<x_slab_start : x_pix_start = x_slab_start
+                            if x_pix_stop>x_slab_stop : x_pix_stop = x_slab_stop
                             if y_pix_start<0 : y_pix_start = 0
                             if y_pix_stop>ny : y_pix_stop = ny
                             if z_pix_start<0 : z_pix_start = 0
@@ -396,6 +440,115 @@ def to_3d_grid(int nx, int ny, int nz,
 
                                     for z_pos in range(z_pix_start,z_pix_stop) :
                                         z_pixel = pixel_dz*<fixed_input_type>(z_pos)+z_start
-                                        result[x_pos,y_pos,z_pos]+=qty_i*get_kernel_xyz(x_i-x_pixel, y_i-y_pixel, (z_i-z_pixel), kernel_max_2 ,sm_to_kdim,num_samples,samples_c)
+                                        result[x_pos-x_slab_start,y_pos,z_pos]+=qty_i*get_kernel_xyz(x_i-x_pixel, y_i-y_pixel, (z_i-z_pixel), kernel_max_2 ,sm_to_kdim,num_samples,samples_c)
+
+    return result
+
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+cdef void _render_one_spectrum(np.int64_t start, np.int64_t stop, np.int64_t* particles,
+                               fixed_input_type x_sight, fixed_input_type y_sight,
+                               fixed_input_type* x, fixed_input_type* y, fixed_input_type* vz,
+                               fixed_input_type* b, fixed_input_type* sm, fixed_input_type* column,
+                               fixed_input_type v1, fixed_input_type dvel, int nvel,
+                               fixed_input_type max_d_over_h, int num_samples,
+                               image_output_type* samples_c, fixed_input_type* result) nogil :
+    cdef np.int64_t j, i
+    cdef int k, k_start, k_stop
+    cdef fixed_input_type dx, dy, sm_i, b_i, vz_i, n_i, erf_lo, erf_hi
+
+    for j in range(start, stop) :
+        i = particles[j]
+        dx = x[i]-x_sight
+        dy = y[i]-y_sight
+        sm_i = sm[i]
+
+        # column density contributed by this particle along the sightline
+        n_i = column[i]*get_kernel(dx*dx+dy*dy, (sm_i*sm_i)*(max_d_over_h*max_d_over_h),
+                                   sm_i*sm_i, num_samples, samples_c)
+        if n_i==0 : continue
+
+        vz_i = vz[i]
+        b_i = b[i]
+
+        if b_i<=0 :
+            # no thermal broadening; everything lands in a single bin
+            k = <int>floor((vz_i-v1)/dvel)
+            if k>=0 and k<nvel :
+                result[k]+=n_i
+            continue
+
+        # spread over the velocity bins with a Gaussian line profile, truncated at 6b
+        k_start = <int>floor((vz_i-6*b_i-v1)/dvel)
+        k_stop = <int>floor((vz_i+6*b_i-v1)/dvel)+1
+        if k_start<0 : k_start = 0
+        if k_stop>nvel : k_stop = nvel
+
+        erf_lo = erf((v1+k_start*dvel-vz_i)/b_i)
+        for k in range(k_start, k_stop) :
+            erf_hi = erf((v1+(k+1)*dvel-vz_i)/b_i)
+            result[k]+=0.5*n_i*(erf_hi-erf_lo)
+            erf_lo = erf_hi
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+def render_spectra(np.ndarray[np.int64_t,ndim=1,mode='c'] offsets,
+                   np.ndarray[np.int64_t,ndim=1,mode='c'] particles,
+                   np.ndarray[fixed_input_type,ndim=1,mode='c'] x_sight,
+                   np.ndarray[fixed_input_type,ndim=1,mode='c'] y_sight,
+                   np.ndarray[fixed_input_type,ndim=1,mode='c'] x,
+                   np.ndarray[fixed_input_type,ndim=1,mode='c'] y,
+                   np.ndarray[fixed_input_type,ndim=1,mode='c'] vz,
+                   np.ndarray[fixed_input_type,ndim=1,mode='c'] b,
+                   np.ndarray[fixed_input_type,ndim=1,mode='c'] sm,
+                   np.ndarray[fixed_input_type,ndim=1,mode='c'] column,
+                   fixed_input_type v1, fixed_input_type v2, int nvel,
+                   kernel, int num_threads) :
+    """Render column density spectra along many sightlines parallel to the z axis.
+
+    The particles contributing to sightline s are particles[offsets[s]:offsets[s+1]]. Each
+    particle adds column[i]*W_2D(d, sm[i]) to the spectrum, spread in velocity about vz[i] with a
+    Gaussian profile of Doppler parameter b[i]. Sightlines are distributed dynamically across
+    num_threads threads. Returns an (n_sightlines, nvel) array of the column density in each
+    velocity bin."""
+
+    cdef Py_ssize_t n_sight = len(x_sight)
+    cdef Py_ssize_t s
+    cdef fixed_input_type dvel = (v2-v1)/nvel
+    cdef fixed_input_type max_d_over_h = kernel.max_d
+
+    cdef np.ndarray[image_output_type,ndim=1] samples = kernel.get_samples(dtype=np_image_output_type)
+    cdef int num_samples = len(samples)
+    cdef image_output_type* samples_c = <image_output_type*>samples.data
+
+    cdef np.ndarray[fixed_input_type,ndim=2] result = np.zeros((n_sight, nvel), dtype=np.float64)
+
+    assert kernel.h_power==2, "Spectra require a 2D (projected) kernel"
+    assert len(offsets) == n_sight+1 and len(y_sight) == n_sight, "Inconsistent sightline arrays passed to render_spectra"
+    assert len(x) == len(y) == len(vz) == len(b) == len(sm) == len(column), "Inconsistent array lengths passed to render_spectra"
+    if len(particles)>0 :
+        assert 0 <= particles.min() and particles.max() < len(x), "Particle index out of range in render_spectra"
+
+    cdef np.int64_t* offsets_c = <np.int64_t*>offsets.data
+    cdef np.int64_t* particles_c = <np.int64_t*>particles.data
+    cdef fixed_input_type* x_sight_c = <fixed_input_type*>x_sight.data
+    cdef fixed_input_type* y_sight_c = <fixed_input_type*>y_sight.data
+    cdef fixed_input_type* x_c = <fixed_input_type*>x.data
+    cdef fixed_input_type* y_c = <fixed_input_type*>y.data
+    cdef fixed_input_type* vz_c = <fixed_input_type*>vz.data
+    cdef fixed_input_type* b_c = <fixed_input_type*>b.data
+    cdef fixed_input_type* sm_c = <fixed_input_type*>sm.data
+    cdef fixed_input_type* column_c = <fixed_input_type*>column.data
+    cdef fixed_input_type* result_c = <fixed_input_type*>result.data
+
+    for s in prange(n_sight, nogil=True, schedule='dynamic', num_threads=num_threads) :
+        _render_one_spectrum(offsets_c[s], offsets_c[s+1], particles_c, x_sight_c[s], y_sight_c[s],
+                             x_c, y_c, vz_c, b_c, sm_c, column_c, v1, dvel, nvel,
+                             max_d_over_h, num_samples, samples_c, result_c+s*nvel)
 
     return result
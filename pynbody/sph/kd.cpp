@@ -18,6 +18,8 @@ int kdInit(KD *pkd,int nBucket)
 	kd->nBucket = nBucket;
 	kd->p = NULL;
 	kd->kdNodes = NULL;
+	kd->fNodeHmax = NULL;
+	kd->pNumpyTreeParticles = NULL;
 	*pkd = kd;
 	return(1);
 }
@@ -60,8 +62,10 @@ void kdOrder(KD kd)
 
 void kdFinish(KD kd)
 {
-	free(kd->p);
+	// If the particle list was borrowed from a numpy array, it is not ours to free
+	if (kd->pNumpyTreeParticles == NULL) free(kd->p);
 	free(kd->kdNodes);
+	free(kd->fNodeHmax);
 	free(kd);
 }
 
@@ -184,6 +188,30 @@ void kdBuildTree(KD kd)
 	kdUpPass<T>(kd,ROOT);
 }
 
+template <typename T>
+void kdRefreshSplits(KD kd,int iCell)
+{
+	KDN *c = kd->kdNodes;
+	int m;
+	if (c[iCell].iDim != -1) {
+		m = (c[iCell].pLower + c[iCell].pUpper)/2;
+		c[iCell].fSplit = GET2<T>(kd->pNumpyPos,kd->p[m].iOrder,c[iCell].iDim);
+		kdRefreshSplits<T>(kd,LOWER(iCell));
+		kdRefreshSplits<T>(kd,UPPER(iCell));
+		}
+	}
+
+template <typename T>
+void kdRefreshTree(KD kd)
+{
+	// Recompute split points and bounds of an existing tree topology from the
+	// current particle positions. The particle ordering and node structure are
+	// left untouched, so the tree remains valid (if not optimally balanced)
+	// whatever has happened to the positions since it was built.
+	kdRefreshSplits<T>(kd,ROOT);
+	kdUpPass<T>(kd,ROOT);
+}
+
 struct KDargs {
 	KD kd;
 	int local_root;
@@ -325,6 +353,9 @@ void kdBuildNodeRemote<double>(struct KDargs *a);
 template
 void kdBuildNode<double>(KD kd, int local_root);
 
+template
+void kdRefreshTree<double>(KD kd);
+
 
 
 template
@@ -341,3 +372,6 @@ void kdBuildNodeRemote<float>(struct KDargs *a);
 
 template
 void kdBuildNode<float>(KD kd, int local_root);
+
+template
+void kdRefreshTree<float>(KD kd);
@@ -65,6 +65,8 @@ typedef struct kdContext {
 	PyObject *pNumpyDen;  // Nx1 Numpy array of density
 	PyObject *pNumpyQty;  // Nx1 Numpy array of density
 	PyObject *pNumpyQtySmoothed;  // Nx1 Numpy array of density
+	PyObject *pNumpyTreeParticles; // Nx2 Numpy array owning p, if the tree was loaded from a cache (otherwise NULL)
+	float *fNodeHmax; // maximum smoothing length within each node, used to cull particles for rendering
 	} * KD;
 
 
@@ -175,6 +177,10 @@ void kdFinish(KD);
 
 template<typename T>
 void kdBuildNode(KD, int);
+template<typename T>
+void kdUpPass(KD, int);
+template<typename T>
+void kdRefreshTree(KD);
 void kdCombine(KDN *p1,KDN *p2,KDN *pOut);
 
 
@@ -9,6 +9,10 @@
 #include <stdlib.h>
 #include <string.h>
 #include <math.h>
+#include <vector>
+#include <queue>
+#include <utility>
+#include <algorithm>
 
 #include "kd.h"
 #include "smooth.h"
@@ -42,6 +46,10 @@ long total_alloc = 0;
 
 PyObject *kdinit(PyObject *self, PyObject *args);
 PyObject *kdfree(PyObject *self, PyObject *args);
+PyObject *kdinit_from_cache(PyObject *self, PyObject *args);
+PyObject *get_tree_data(PyObject *self, PyObject *args);
+PyObject *kdrefresh(PyObject *self, PyObject *args);
+PyObject *leaf_extent(PyObject *self, PyObject *args);
 
 PyObject *nn_start(PyObject *self, PyObject *args);
 PyObject *nn_next(PyObject *self, PyObject *args);
@@ -55,6 +63,11 @@ PyObject *set_arrayref(PyObject *self, PyObject *args);
 PyObject *get_arrayref(PyObject *self, PyObject *args);
 PyObject *has_threading(PyObject *self, PyObject *args);
 
+PyObject *particles_in_sphere(PyObject *self, PyObject *args);
+PyObject *particles_in_box(PyObject *self, PyObject *args);
+PyObject *nearest_neighbours(PyObject *self, PyObject *args);
+PyObject *particles_in_balls(PyObject *self, PyObject *args);
+
 template<typename T>
 int checkArray(PyObject *check, const char *name);
 
@@ -75,6 +88,10 @@ static PyMethodDef kdmain_methods[] =
 {
     {"init", kdinit, METH_VARARGS, "init"},
     {"free", kdfree, METH_VARARGS, "free"},
+    {"init_from_cache", kdinit_from_cache, METH_VARARGS, "init_from_cache"},
+    {"get_tree_data", get_tree_data, METH_VARARGS, "get_tree_data"},
+    {"refresh", kdrefresh, METH_VARARGS, "refresh"},
+    {"leaf_extent", leaf_extent, METH_VARARGS, "leaf_extent"},
 
     {"nn_start",  nn_start,  METH_VARARGS, "nn_start"},
     {"nn_next",   nn_next,   METH_VARARGS, "nn_next"},
@@ -89,6 +106,11 @@ static PyMethodDef kdmain_methods[] =
 
     {"has_threading",  has_threading,  METH_VARARGS, "populate"},
 
+    {"particles_in_sphere", particles_in_sphere, METH_VARARGS, "particles_in_sphere"},
+    {"particles_in_box", particles_in_box, METH_VARARGS, "particles_in_box"},
+    {"nearest_neighbours", nearest_neighbours, METH_VARARGS, "nearest_neighbours"},
+    {"particles_in_balls", particles_in_balls, METH_VARARGS, "particles_in_balls"},
+
     {NULL, NULL, 0, NULL}
 };
 
@@ -109,6 +131,7 @@ PyInit_kdmain(void)
 initkdmain(void)
 #endif
 {
+  import_array();
   #if PY_MAJOR_VERSION>=3
     return PyModule_Create(&ourdef);
   #else
@@ -158,7 +181,7 @@ PyObject *kdinit(PyObject *self, PyObject *args)
         if(checkArray<float>(mass, "mass")) return NULL;
     }
 
-    KD kd = (KD)malloc(sizeof(*kd));
+    KD kd;
     kdInit(&kd, nBucket);
 
     int nbodies = PyArray_DIM(pos, 0);
@@ -211,12 +234,263 @@ PyObject *kdfree(PyObject *self, PyObject *args)
     PyArg_ParseTuple(args, "O", &kdobj);
     kd = (KD)PyCapsule_GetPointer(kdobj, NULL);
 
-    kdFinish(kd);
     Py_XDECREF(kd->pNumpyPos);
     Py_XDECREF(kd->pNumpyMass);
     Py_XDECREF(kd->pNumpySmooth);
     Py_XDECREF(kd->pNumpyDen);
-    return Py_None;
+    Py_XDECREF(kd->pNumpyTreeParticles);
+    kdFinish(kd);
+    Py_RETURN_NONE;
+}
+
+/*==========================================================================*/
+/* kdrefresh                                                                */
+/*==========================================================================*/
+PyObject *kdrefresh(PyObject *self, PyObject *args)
+{
+    // Point an existing tree at new (or modified) position and mass arrays for the same
+    // particles, and recompute its split points and bounds without changing the topology
+    KD kd;
+    PyObject *kdobj, *pos, *mass;
+
+    if (!PyArg_ParseTuple(args, "OOO", &kdobj, &pos, &mass))
+        return NULL;
+    kd = (KD)PyCapsule_GetPointer(kdobj, NULL);
+    if(!kd) return NULL;
+
+    if(kd->nBitDepth==64) {
+        if(checkArray<double>(pos, "pos")) return NULL;
+        if(checkArray<double>(mass, "mass")) return NULL;
+    } else {
+        if(checkArray<float>(pos, "pos")) return NULL;
+        if(checkArray<float>(mass, "mass")) return NULL;
+    }
+
+    if(PyArray_NDIM((PyArrayObject*)pos)!=2 || PyArray_DIM((PyArrayObject*)pos,0)!=kd->nActive ||
+       PyArray_DIM((PyArrayObject*)pos,1)!=3) {
+        PyErr_SetString(PyExc_ValueError, "Position array does not match the particles in the tree");
+        return NULL;
+    }
+
+    Py_INCREF(pos);
+    Py_INCREF(mass);
+    Py_XDECREF(kd->pNumpyPos);
+    Py_XDECREF(kd->pNumpyMass);
+    kd->pNumpyPos = pos;
+    kd->pNumpyMass = mass;
+
+    Py_BEGIN_ALLOW_THREADS
+
+    if(kd->nBitDepth==64)
+        kdRefreshTree<double>(kd);
+    else
+        kdRefreshTree<float>(kd);
+
+    Py_END_ALLOW_THREADS
+
+    Py_RETURN_NONE;
+}
+
+/*==========================================================================*/
+/* leaf_extent                                                              */
+/*==========================================================================*/
+double leafExtent(KD kd, int iCell)
+{
+    KDN *c = &kd->kdNodes[iCell];
+    if (iCell<kd->nSplit && c->iDim!=-1)
+        return leafExtent(kd, LOWER(iCell)) + leafExtent(kd, UPPER(iCell));
+    return (double)(c->bnd.fMax[0]-c->bnd.fMin[0]) + (double)(c->bnd.fMax[1]-c->bnd.fMin[1]) +
+           (double)(c->bnd.fMax[2]-c->bnd.fMin[2]);
+}
+
+PyObject *leaf_extent(PyObject *self, PyObject *args)
+{
+    // Return the sum over leaf cells of the side lengths of their bounding boxes, a measure of how
+    // compact the leaves are and so of how efficiently the tree can be searched
+    KD kd;
+    PyObject *kdobj;
+
+    if (!PyArg_ParseTuple(args, "O", &kdobj))
+        return NULL;
+    kd = (KD)PyCapsule_GetPointer(kdobj, NULL);
+    if(!kd) return NULL;
+
+    return PyFloat_FromDouble(leafExtent(kd, ROOT));
+}
+
+/*==========================================================================*/
+/* get_tree_data                                                            */
+/*==========================================================================*/
+PyObject *get_tree_data(PyObject *self, PyObject *args)
+{
+    // Return copies of the particle ordering, as an Nx2 int32 array, and of the
+    // node structures, as raw bytes of shape (nNodes, sizeof(KDN)), so that
+    // the tree can be stored and later passed back to init_from_cache
+    KD kd;
+    PyObject *kdobj;
+
+    if (!PyArg_ParseTuple(args, "O", &kdobj))
+        return NULL;
+    kd = (KD)PyCapsule_GetPointer(kdobj, NULL);
+    if(kd==NULL) return NULL;
+
+    npy_intp pdims[2] = {kd->nActive, 2};
+    npy_intp ndims[2] = {kd->nNodes, (npy_intp) sizeof(KDN)};
+
+    PyObject *particles = PyArray_SimpleNew(2, pdims, NPY_INT32);
+    if(particles==NULL) return NULL;
+    PyObject *nodes = PyArray_ZEROS(2, ndims, NPY_UINT8, 0);
+    if(nodes==NULL) {
+        Py_DECREF(particles);
+        return NULL;
+    }
+
+    memcpy(PyArray_DATA((PyArrayObject*)particles), kd->p, kd->nActive*sizeof(PARTICLE));
+    // node 0 is never used; leave it zeroed rather than storing uninitialised memory
+    memcpy((char*)PyArray_DATA((PyArrayObject*)nodes)+sizeof(KDN), kd->kdNodes+1, (kd->nNodes-1)*sizeof(KDN));
+
+    return Py_BuildValue("NN", particles, nodes);
+}
+
+int checkCachedNodes(KDN *nodes, int iCell, int nSplit, int nParticles)
+{
+    // Verify that the subtree at iCell partitions its particle range in the way kdBuildNode would have,
+    // so that a corrupted or mismatched cache cannot lead to out-of-bounds reads during searches
+    KDN *c = &nodes[iCell];
+    if (c->pLower<0 || c->pUpper>=nParticles || c->pUpper<c->pLower)
+        return 0;
+    if (c->iDim == -1)
+        return 1;
+    if (iCell>=nSplit || c->iDim<0 || c->iDim>2)
+        return 0;
+    int m = (c->pLower + c->pUpper)/2;
+    KDN *l = &nodes[LOWER(iCell)], *u = &nodes[UPPER(iCell)];
+    if (l->pLower!=c->pLower || l->pUpper!=m || u->pLower!=m+1 || u->pUpper!=c->pUpper)
+        return 0;
+    return checkCachedNodes(nodes, LOWER(iCell), nSplit, nParticles) &&
+           checkCachedNodes(nodes, UPPER(iCell), nSplit, nParticles);
+}
+
+/*==========================================================================*/
+/* kdinit_from_cache                                                        */
+/*==========================================================================*/
+PyObject *kdinit_from_cache(PyObject *self, PyObject *args)
+{
+    // Reconstruct a tree from the output of get_tree_data. The particle array
+    // is used in place (so may be memory-mapped from disk) while the nodes are
+    // copied; split points and bounds are then recomputed from pos.
+    int nBucket;
+    int i;
+
+    PyObject *pos;  // Nx3 Numpy array of positions
+    PyObject *mass; // Nx1 Numpy array of masses
+    PyObject *particles; // Nx2 int32 array of (iOrder, iMark)
+    PyObject *nodes; // raw node data
+
+    if (!PyArg_ParseTuple(args, "OOiOO", &pos, &mass, &nBucket, &particles, &nodes))
+        return NULL;
+
+    int bitdepth = getBitDepth(pos);
+    if(bitdepth==0) {
+        PyErr_SetString(PyExc_ValueError, "Unsupported array dtype for kdtree");
+        return NULL;
+    }
+    if(bitdepth!=getBitDepth(mass)) {
+        PyErr_SetString(PyExc_ValueError, "pos and mass arrays must have matching dtypes for kdtree");
+        return NULL;
+    }
+
+    if(bitdepth==64) {
+        if(checkArray<double>(pos, "pos")) return NULL;
+        if(checkArray<double>(mass, "mass")) return NULL;
+    } else {
+        if(checkArray<float>(pos, "pos")) return NULL;
+        if(checkArray<float>(mass, "mass")) return NULL;
+    }
+
+    int nbodies = PyArray_DIM(pos, 0);
+
+    if(!PyArray_Check(particles) || PyArray_TYPE((PyArrayObject*)particles)!=NPY_INT32 ||
+       PyArray_NDIM((PyArrayObject*)particles)!=2 || PyArray_DIM((PyArrayObject*)particles,0)!=nbodies ||
+       PyArray_DIM((PyArrayObject*)particles,1)!=2 || !PyArray_ISCARRAY_RO((PyArrayObject*)particles)) {
+        PyErr_SetString(PyExc_ValueError, "Cached tree particle list must be a contiguous Nx2 int32 array matching pos");
+        return NULL;
+    }
+
+    if(!PyArray_Check(nodes) || PyArray_TYPE((PyArrayObject*)nodes)!=NPY_UINT8 ||
+       PyArray_NBYTES((PyArrayObject*)nodes)%sizeof(KDN)!=0 || !PyArray_ISCARRAY_RO((PyArrayObject*)nodes)) {
+        PyErr_SetString(PyExc_ValueError, "Cached tree node data has an unexpected format");
+        return NULL;
+    }
+
+    PARTICLE *p = (PARTICLE*)PyArray_DATA((PyArrayObject*)particles);
+    std::vector<char> seen(nbodies, 0);
+    for(i=0; i<nbodies; i++) {
+        int iOrder = p[i].iOrder;
+        if(iOrder<0 || iOrder>=nbodies || seen[iOrder]) {
+            PyErr_SetString(PyExc_ValueError, "Cached tree particle list is not a permutation of the particles");
+            return NULL;
+        }
+        seen[iOrder] = 1;
+    }
+
+    KD kd;
+    kdInit(&kd, nBucket);
+
+    kd->nParticles = nbodies;
+    kd->nActive = nbodies;
+
+    // Reproduce the node-count calculation of kdBuildTree
+    int n = nbodies, l = 1;
+    kd->nLevels = 1;
+    while (n > kd->nBucket) {
+        n = n>>1;
+        l = l<<1;
+        ++kd->nLevels;
+    }
+    kd->nSplit = l;
+    kd->nNodes = l<<1;
+
+    if((npy_intp)(kd->nNodes*sizeof(KDN))!=PyArray_NBYTES((PyArrayObject*)nodes)) {
+        kdFinish(kd);
+        PyErr_SetString(PyExc_ValueError, "Cached tree node count does not match the particle number and leaf size");
+        return NULL;
+    }
+
+    kd->kdNodes = (KDN *)malloc(kd->nNodes*sizeof(KDN));
+    assert(kd->kdNodes != NULL);
+    memcpy(kd->kdNodes, PyArray_DATA((PyArrayObject*)nodes), kd->nNodes*sizeof(KDN));
+
+    if(nbodies==0 || !checkCachedNodes(kd->kdNodes, ROOT, kd->nSplit, nbodies)) {
+        kdFinish(kd);
+        PyErr_SetString(PyExc_ValueError, "Cached tree node structure is inconsistent");
+        return NULL;
+    }
+
+    kd->p = p;
+    kd->nBitDepth = bitdepth;
+    kd->pNumpyPos = pos;
+    kd->pNumpyMass = mass;
+    kd->pNumpySmooth = NULL;
+    kd->pNumpyDen = NULL;
+    kd->pNumpyQty = NULL;
+    kd->pNumpyQtySmoothed = NULL;
+    kd->pNumpyTreeParticles = particles;
+
+    Py_INCREF(pos);
+    Py_INCREF(mass);
+    Py_INCREF(particles);
+
+    Py_BEGIN_ALLOW_THREADS
+
+    if(bitdepth==64)
+        kdRefreshTree<double>(kd);
+    else
+        kdRefreshTree<float>(kd);
+
+    Py_END_ALLOW_THREADS
+
+    return PyCapsule_New((void *)kd, NULL, NULL);
 }
 
 #define BIGFLOAT ((float)1.0e37)
@@ -710,3 +984,478 @@ PyObject *populate(PyObject *self, PyObject *args)
         return NULL;
     }
 }
+
+
+/*==========================================================================*/
+/* particles_in_sphere                                                      */
+/*==========================================================================*/
+
+template<typename T>
+void typed_particles_in_sphere(KD kd, double x, double y, double z, double r, float period,
+                               std::vector<npy_intp> &result)
+{
+    KDN *c = kd->kdNodes;
+    PARTICLE *p = kd->p;
+    int pj, cp;
+    double dx, dy, dz;
+    float lx = period, ly = period, lz = period;
+    float sx, sy, sz;
+    double r2 = r*r;
+    // cells are tested in single precision, so pad the test radius to be sure not to miss any particles;
+    // particles themselves are then tested exactly
+    float fBall2 = (float)(r2*(1.0+1e-5)) + 1e-30f;
+    float fx = (float)x, fy = (float)y, fz = (float)z;
+
+    cp = ROOT;
+    while (1) {
+        INTERSECT(c,cp,fBall2,lx,ly,lz,fx,fy,fz,sx,sy,sz);
+        if (cp < kd->nSplit) {
+            cp = LOWER(cp);
+            continue;
+        }
+        else {
+            // sx, sy, sz include any periodic shift of the centre for this cell; apply it in full precision
+            double ox = x + (sx>fx ? (double)period : (sx<fx ? -(double)period : 0.0));
+            double oy = y + (sy>fy ? (double)period : (sy<fy ? -(double)period : 0.0));
+            double oz = z + (sz>fz ? (double)period : (sz<fz ? -(double)period : 0.0));
+            for (pj=c[cp].pLower;pj<=c[cp].pUpper;++pj) {
+                dx = ox - GET2<T>(kd->pNumpyPos,p[pj].iOrder,0);
+                dy = oy - GET2<T>(kd->pNumpyPos,p[pj].iOrder,1);
+                dz = oz - GET2<T>(kd->pNumpyPos,p[pj].iOrder,2);
+                if (dx*dx + dy*dy + dz*dz <= r2)
+                    result.push_back(p[pj].iOrder);
+            }
+        }
+    GetNextCell:
+        SETNEXT(cp,ROOT);
+        if (cp == ROOT) break;
+    }
+}
+
+PyObject *particles_in_sphere(PyObject *self, PyObject *args)
+{
+    // Return the indices of all particles within distance r of (x,y,z), as a numpy array
+    KD kd;
+    PyObject *kdobj;
+    double x, y, z, r;
+    float period = BIGFLOAT;
+
+    if (!PyArg_ParseTuple(args, "Odddd|f", &kdobj, &x, &y, &z, &r, &period))
+        return NULL;
+    kd = (KD)PyCapsule_GetPointer(kdobj, NULL);
+    if(!kd) return NULL;
+
+    if(period<=0)
+        period = BIGFLOAT;
+
+    std::vector<npy_intp> result;
+
+    Py_BEGIN_ALLOW_THREADS
+
+    if(kd->nBitDepth==32)
+        typed_particles_in_sphere<float>(kd, x, y, z, r, period, result);
+    else
+        typed_particles_in_sphere<double>(kd, x, y, z, r, period, result);
+
+    Py_END_ALLOW_THREADS
+
+    npy_intp n = result.size();
+    PyObject *numpy_result = PyArray_SimpleNew(1, &n, NPY_INTP);
+    if(numpy_result==NULL) return NULL;
+    if(n>0)
+        memcpy(PyArray_DATA((PyArrayObject*)numpy_result), result.data(), n*sizeof(npy_intp));
+
+    return numpy_result;
+}
+
+
+/*==========================================================================*/
+/* particles_in_box                                                         */
+/*==========================================================================*/
+
+template<typename Ts>
+float nodeHmaxUpPass(KD kd, PyObject *smooth, int iCell)
+{
+    KDN *c = kd->kdNodes;
+    float hmax, h;
+    int pj;
+    if (iCell < kd->nSplit && c[iCell].iDim != -1) {
+        hmax = nodeHmaxUpPass<Ts>(kd, smooth, LOWER(iCell));
+        h = nodeHmaxUpPass<Ts>(kd, smooth, UPPER(iCell));
+        if (h > hmax) hmax = h;
+    } else {
+        hmax = 0;
+        for (pj=c[iCell].pLower; pj<=c[iCell].pUpper; ++pj) {
+            h = (float)GET<Ts>(smooth, kd->p[pj].iOrder);
+            if (h > hmax) hmax = h;
+        }
+    }
+    kd->fNodeHmax[iCell] = hmax;
+    return hmax;
+}
+
+template<typename T, typename Ts>
+void typed_particles_in_box(KD kd, PyObject *smooth, double *lo, double *hi, double h_factor,
+                            std::vector<npy_intp> &result)
+{
+    KDN *c = kd->kdNodes;
+    PARTICLE *p = kd->p;
+    int pj, cp, d;
+    bool inside;
+    double x, h, pad, bmin, bmax, tol;
+
+    cp = ROOT;
+    while (1) {
+        // cell bounds and smoothing lengths are stored in single precision, so pad the test slightly
+        pad = h_factor*kd->fNodeHmax[cp]*(1.0+1e-6);
+        inside = true;
+        for (d=0; d<3; ++d) {
+            bmin = c[cp].bnd.fMin[d];
+            bmax = c[cp].bnd.fMax[d];
+            tol = 1e-6*(fabs(bmin)+fabs(bmax));
+            if (bmax+tol < lo[d]-pad || bmin-tol > hi[d]+pad) {
+                inside = false;
+                break;
+            }
+        }
+        if (inside) {
+            if (cp < kd->nSplit) {
+                cp = LOWER(cp);
+                continue;
+            }
+            for (pj=c[cp].pLower; pj<=c[cp].pUpper; ++pj) {
+                h = h_factor*GET<Ts>(smooth, p[pj].iOrder);
+                inside = true;
+                for (d=0; d<3; ++d) {
+                    x = GET2<T>(kd->pNumpyPos, p[pj].iOrder, d);
+                    if (!(x > lo[d]-h && x < hi[d]+h)) {
+                        inside = false;
+                        break;
+                    }
+                }
+                if (inside)
+                    result.push_back(p[pj].iOrder);
+            }
+        }
+        SETNEXT(cp,ROOT);
+        if (cp == ROOT) break;
+    }
+}
+
+PyObject *particles_in_box(PyObject *self, PyObject *args)
+{
+    // Return the indices of all particles for which lo-h_factor*smooth < pos < hi+h_factor*smooth
+    // in each dimension, as a numpy array. The maximum smoothing length in each tree node is
+    // calculated on the first call, or if update_hmax is true; otherwise the values from the
+    // previous call are reused, and it is up to the caller to know that smooth is unchanged.
+    KD kd;
+    PyObject *kdobj, *smooth;
+    double lo[3], hi[3], h_factor;
+    int update_hmax;
+
+    if (!PyArg_ParseTuple(args, "OOdddddddp", &kdobj, &smooth, &lo[0], &hi[0], &lo[1], &hi[1], &lo[2], &hi[2],
+                          &h_factor, &update_hmax))
+        return NULL;
+    kd = (KD)PyCapsule_GetPointer(kdobj, NULL);
+    if(!kd) return NULL;
+
+    int smooth_bitdepth = getBitDepth(smooth);
+    if(smooth_bitdepth==0 || PyArray_NDIM((PyArrayObject*)smooth)!=1 ||
+       PyArray_DIM((PyArrayObject*)smooth,0)!=kd->nActive) {
+        PyErr_SetString(PyExc_ValueError, "Smoothing array must be a 1D float array with one entry per particle");
+        return NULL;
+    }
+
+    std::vector<npy_intp> result;
+
+    if(update_hmax || kd->fNodeHmax==NULL) {
+        if(kd->fNodeHmax==NULL)
+            kd->fNodeHmax = (float*)malloc(kd->nNodes*sizeof(float));
+        if(smooth_bitdepth==32)
+            nodeHmaxUpPass<float>(kd, smooth, ROOT);
+        else
+            nodeHmaxUpPass<double>(kd, smooth, ROOT);
+    }
+
+    Py_BEGIN_ALLOW_THREADS
+
+    if(kd->nBitDepth==32) {
+        if(smooth_bitdepth==32)
+            typed_particles_in_box<float,float>(kd, smooth, lo, hi, h_factor, result);
+        else
+            typed_particles_in_box<float,double>(kd, smooth, lo, hi, h_factor, result);
+    } else {
+        if(smooth_bitdepth==32)
+            typed_particles_in_box<double,float>(kd, smooth, lo, hi, h_factor, result);
+        else
+            typed_particles_in_box<double,double>(kd, smooth, lo, hi, h_factor, result);
+    }
+
+    Py_END_ALLOW_THREADS
+
+    npy_intp n = result.size();
+    PyObject *numpy_result = PyArray_SimpleNew(1, &n, NPY_INTP);
+    if(numpy_result==NULL) return NULL;
+    if(n>0)
+        memcpy(PyArray_DATA((PyArrayObject*)numpy_result), result.data(), n*sizeof(npy_intp));
+
+    return numpy_result;
+}
+
+
+/*==========================================================================*/
+/* nearest_neighbours and particles_in_balls                                */
+/*==========================================================================*/
+
+// Both searches below walk the tree recursively from an arbitrary point, in
+// double precision. Node bounds are stored in single precision, so they are
+// padded slightly to be sure that no particles are missed. If period>0, the
+// nearest periodic image of each particle is used.
+
+inline double periodicOffset(double dx, double period)
+{
+    if (period>0)
+        dx -= period*floor(dx/period+0.5);
+    return dx;
+}
+
+double nodeDistance2(KDN *c, const double *x, double period)
+{
+    double d2 = 0, a, b, tol, xd;
+    for (int d=0; d<3; ++d) {
+        a = c->bnd.fMin[d];
+        b = c->bnd.fMax[d];
+        tol = 1e-6*(fabs(a)+fabs(b));
+        a -= tol;
+        b += tol;
+        if (period>0 && b-a>=period)
+            continue;
+        xd = (a+b)/2 + periodicOffset(x[d]-(a+b)/2, period);
+        if (xd<a)
+            d2 += (a-xd)*(a-xd);
+        else if (xd>b)
+            d2 += (xd-b)*(xd-b);
+    }
+    return d2;
+}
+
+template<typename T>
+inline double particleDistance2(KD kd, npy_intp iOrder, const double *x, double period)
+{
+    double d2 = 0, dx;
+    for (int d=0; d<3; ++d) {
+        dx = periodicOffset(x[d] - GET2<T>(kd->pNumpyPos, iOrder, d), period);
+        d2 += dx*dx;
+    }
+    return d2;
+}
+
+inline bool isLeaf(KD kd, int iCell)
+{
+    return iCell>=kd->nSplit || kd->kdNodes[iCell].iDim==-1;
+}
+
+typedef std::priority_queue<std::pair<double, npy_intp> > NeighbourHeap;
+
+template<typename T>
+void nearestSearch(KD kd, int iCell, const double *x, double period, size_t k, NeighbourHeap &heap)
+{
+    KDN *c = kd->kdNodes;
+    if (isLeaf(kd, iCell)) {
+        for (int pj=c[iCell].pLower; pj<=c[iCell].pUpper; ++pj) {
+            npy_intp iOrder = kd->p[pj].iOrder;
+            double d2 = particleDistance2<T>(kd, iOrder, x, period);
+            if (heap.size()<k)
+                heap.push(std::make_pair(d2, iOrder));
+            else if (d2<heap.top().first) {
+                heap.pop();
+                heap.push(std::make_pair(d2, iOrder));
+            }
+        }
+        return;
+    }
+
+    int near = LOWER(iCell), far = UPPER(iCell);
+    double d2_near = nodeDistance2(&c[near], x, period);
+    double d2_far = nodeDistance2(&c[far], x, period);
+    if (d2_far<d2_near) {
+        std::swap(near, far);
+        std::swap(d2_near, d2_far);
+    }
+    if (heap.size()<k || d2_near<=heap.top().first)
+        nearestSearch<T>(kd, near, x, period, k, heap);
+    if (heap.size()<k || d2_far<=heap.top().first)
+        nearestSearch<T>(kd, far, x, period, k, heap);
+}
+
+template<typename T>
+void typed_nearest_neighbours(KD kd, PyArrayObject *points, double period, int k,
+                              PyArrayObject *indices, PyArrayObject *distances)
+{
+    npy_intp n = PyArray_DIM(points, 0);
+    NeighbourHeap heap;
+    for (npy_intp i=0; i<n; ++i) {
+        const double *x = (double*)PyArray_GETPTR2(points, i, 0);
+        nearestSearch<T>(kd, ROOT, x, period, (size_t)k, heap);
+        // heap pops furthest first, so fill the output rows from the end
+        for (int j=k-1; j>=0; --j) {
+            *((npy_intp*)PyArray_GETPTR2(indices, i, j)) = heap.top().second;
+            *((double*)PyArray_GETPTR2(distances, i, j)) = sqrt(heap.top().first);
+            heap.pop();
+        }
+    }
+}
+
+int checkPointsArray(PyArrayObject *points)
+{
+    if (PyArray_TYPE(points)!=NPY_DOUBLE || PyArray_NDIM(points)!=2 || PyArray_DIM(points,1)!=3) {
+        PyErr_SetString(PyExc_ValueError, "Query points must be an Nx3 float64 array");
+        return 1;
+    }
+    return 0;
+}
+
+PyObject *nearest_neighbours(PyObject *self, PyObject *args)
+{
+    // Find the k nearest particles to each query point, writing their indices and distances
+    // (in order of increasing distance) into the Nxk output arrays supplied
+    KD kd;
+    PyObject *kdobj;
+    PyArrayObject *points, *indices, *distances;
+    int k;
+    double period;
+
+    if (!PyArg_ParseTuple(args, "OO!idO!O!", &kdobj, &PyArray_Type, &points, &k, &period,
+                          &PyArray_Type, &indices, &PyArray_Type, &distances))
+        return NULL;
+    kd = (KD)PyCapsule_GetPointer(kdobj, NULL);
+    if(!kd) return NULL;
+
+    if(checkPointsArray(points)) return NULL;
+
+    if(k<1 || k>kd->nActive) {
+        PyErr_SetString(PyExc_ValueError, "Number of neighbours must be between 1 and the number of particles in the tree");
+        return NULL;
+    }
+
+    npy_intp n = PyArray_DIM(points, 0);
+    if(PyArray_TYPE(indices)!=NPY_INTP || PyArray_NDIM(indices)!=2 || PyArray_DIM(indices,0)!=n ||
+       PyArray_DIM(indices,1)!=k || !PyArray_ISWRITEABLE(indices) ||
+       PyArray_TYPE(distances)!=NPY_DOUBLE || PyArray_NDIM(distances)!=2 || PyArray_DIM(distances,0)!=n ||
+       PyArray_DIM(distances,1)!=k || !PyArray_ISWRITEABLE(distances)) {
+        PyErr_SetString(PyExc_ValueError, "Output arrays for nearest_neighbours have the wrong type or shape");
+        return NULL;
+    }
+
+    Py_BEGIN_ALLOW_THREADS
+
+    if(kd->nBitDepth==32)
+        typed_nearest_neighbours<float>(kd, points, period, k, indices, distances);
+    else
+        typed_nearest_neighbours<double>(kd, points, period, k, indices, distances);
+
+    Py_END_ALLOW_THREADS
+
+    Py_RETURN_NONE;
+}
+
+template<typename T>
+void ballSearch(KD kd, int iCell, const double *x, double period, double r2, npy_intp &count,
+                std::vector<npy_intp> *indices, std::vector<double> *distances)
+{
+    KDN *c = kd->kdNodes;
+    if (nodeDistance2(&c[iCell], x, period)>r2)
+        return;
+    if (!isLeaf(kd, iCell)) {
+        ballSearch<T>(kd, LOWER(iCell), x, period, r2, count, indices, distances);
+        ballSearch<T>(kd, UPPER(iCell), x, period, r2, count, indices, distances);
+        return;
+    }
+    for (int pj=c[iCell].pLower; pj<=c[iCell].pUpper; ++pj) {
+        npy_intp iOrder = kd->p[pj].iOrder;
+        double d2 = particleDistance2<T>(kd, iOrder, x, period);
+        if (d2<=r2) {
+            ++count;
+            if (indices!=NULL) {
+                indices->push_back(iOrder);
+                distances->push_back(sqrt(d2));
+            }
+        }
+    }
+}
+
+template<typename T>
+void typed_particles_in_balls(KD kd, PyArrayObject *points, PyArrayObject *radii, double period,
+                              PyArrayObject *counts, std::vector<npy_intp> *indices,
+                              std::vector<double> *distances)
+{
+    npy_intp n = PyArray_DIM(points, 0);
+    for (npy_intp i=0; i<n; ++i) {
+        const double *x = (double*)PyArray_GETPTR2(points, i, 0);
+        double r = *((double*)PyArray_GETPTR1(radii, i));
+        npy_intp count = 0;
+        ballSearch<T>(kd, ROOT, x, period, r*r, count, indices, distances);
+        *((npy_intp*)PyArray_GETPTR1(counts, i)) = count;
+    }
+}
+
+PyObject *particles_in_balls(PyObject *self, PyObject *args)
+{
+    // Find all particles within a radius of each query point. Returns the number found for each point
+    // and, unless count_only is set, the concatenated particle indices and distances.
+    KD kd;
+    PyObject *kdobj;
+    PyArrayObject *points, *radii;
+    double period;
+    int count_only;
+
+    if (!PyArg_ParseTuple(args, "OO!O!di", &kdobj, &PyArray_Type, &points, &PyArray_Type, &radii, &period,
+                          &count_only))
+        return NULL;
+    kd = (KD)PyCapsule_GetPointer(kdobj, NULL);
+    if(!kd) return NULL;
+
+    if(checkPointsArray(points)) return NULL;
+
+    npy_intp n = PyArray_DIM(points, 0);
+    if(PyArray_TYPE(radii)!=NPY_DOUBLE || PyArray_NDIM(radii)!=1 || PyArray_DIM(radii,0)!=n) {
+        PyErr_SetString(PyExc_ValueError, "Radii must be a float64 array with one entry per query point");
+        return NULL;
+    }
+
+    PyObject *counts = PyArray_SimpleNew(1, &n, NPY_INTP);
+    if(counts==NULL) return NULL;
+
+    std::vector<npy_intp> indices;
+    std::vector<double> distances;
+    std::vector<npy_intp> *indices_ptr = count_only ? NULL : &indices;
+    std::vector<double> *distances_ptr = count_only ? NULL : &distances;
+
+    Py_BEGIN_ALLOW_THREADS
+
+    if(kd->nBitDepth==32)
+        typed_particles_in_balls<float>(kd, points, radii, period, (PyArrayObject*)counts, indices_ptr, distances_ptr);
+    else
+        typed_particles_in_balls<double>(kd, points, radii, period, (PyArrayObject*)counts, indices_ptr, distances_ptr);
+
+    Py_END_ALLOW_THREADS
+
+    if(count_only)
+        return counts;
+
+    npy_intp n_found = indices.size();
+    PyObject *numpy_indices = PyArray_SimpleNew(1, &n_found, NPY_INTP);
+    PyObject *numpy_distances = PyArray_SimpleNew(1, &n_found, NPY_DOUBLE);
+    if(numpy_indices==NULL || numpy_distances==NULL) {
+        Py_DECREF(counts);
+        Py_XDECREF(numpy_indices);
+        Py_XDECREF(numpy_distances);
+        return NULL;
+    }
+    if(n_found>0) {
+        memcpy(PyArray_DATA((PyArrayObject*)numpy_indices), indices.data(), n_found*sizeof(npy_intp));
+        memcpy(PyArray_DATA((PyArrayObject*)numpy_distances), distances.data(), n_found*sizeof(double));
+    }
+
+    return Py_BuildValue("NNN", counts, numpy_indices, numpy_distances);
+}
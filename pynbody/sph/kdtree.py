@@ -42,12 +42,119 @@ class KDTree:
         boxsize : float, optional
             Boxsize (default None).
         """
-        self.kdtree = kdmain.init(pos, mass, int(leafsize))
+        self._setup(kdmain.init(pos, mass, int(leafsize)), pos, leafsize, boxsize, "built")
+
+    def _setup(self, kdtree, pos, leafsize, boxsize, origin):
+        self.kdtree = kdtree
         self.derived = True
         self.boxsize = boxsize
+        self.leafsize = int(leafsize)
         self._pos = pos
         self.s_len = len(pos)
         self.flags = {"WRITEABLE": False}
+        # origin is "built", "cache" or "refreshed", recording how the tree was last brought up to date
+        self.origin = origin
+        self._initial_leaf_extent = kdmain.leaf_extent(self.kdtree)
+        # the smoothing array from which particles_in_box last calculated the maximum smoothing length in
+        # each node, kept alive so that its memory cannot be reused by a different array
+        self._cull_smooth = None
+        self._cull_smooth_key = None
+
+    def refresh(self, pos, mass, tolerance=2.0):
+        """Bring the tree up to date with moved particles, without rebuilding it.
+
+        The particle ordering and node structure are kept, and only the split points and bounds of the
+        nodes are recomputed from the new positions. This costs O(N) rather than the O(N log N) of a
+        rebuild. The result is always a correct tree, but searches become slower as the particles move
+        relative to each other; for rigid translations the refreshed tree is as good as a new one.
+
+        Parameters
+        ----------
+        pos : pynbody.array.SimArray
+            New particle positions; must be the same particles, in the same order, as when the tree was built.
+        mass : pynbody.array.SimArray
+            Particle masses.
+        tolerance : float, optional
+            Maximum factor by which the summed side lengths of the leaf cells may grow compared to when the
+            tree was built before the refreshed tree is considered too degraded to use (default 2.0).
+
+        Returns
+        -------
+        acceptable : bool
+            True if the refreshed tree is within tolerance. If False, the tree remains valid but it will
+            usually be quicker to build a new one.
+        """
+        if len(pos) != self.s_len or pos.dtype != self._pos.dtype:
+            raise ValueError("KDTree can only be refreshed for the same particles and position dtype")
+        kdmain.refresh(self.kdtree, pos, mass)
+        self._pos = pos
+        self.origin = "refreshed"
+        return kdmain.leaf_extent(self.kdtree) <= tolerance * self._initial_leaf_extent
+
+    # Version of the on-disk format written by save; bump if the layout of the node structures changes
+    _CACHE_FORMAT_VERSION = 1
+
+    def save(self, filename, source_mtime=0.0):
+        """Write the tree structure to disk so that it can be reloaded with :meth:`load`.
+
+        Only the particle ordering and the node structure are stored; positions are not. The file
+        consists of three consecutive .npy arrays: a small header, the node data and the particle
+        ordering (which is memory-mapped on reload).
+
+        Parameters
+        ----------
+        filename : str
+            File to write.
+        source_mtime : float, optional
+            Modification time of the snapshot the tree was built from, checked by :meth:`load`.
+        """
+        particles, nodes = kdmain.get_tree_data(self.kdtree)
+        header = np.array([self._CACHE_FORMAT_VERSION, self.s_len, self.leafsize, source_mtime],
+                          dtype=np.float64)
+        with open(filename, "wb") as f:
+            for array in header, nodes, particles:
+                np.lib.format.write_array(f, array, allow_pickle=False)
+
+    @classmethod
+    def load(cls, filename, pos, mass, leafsize=32, boxsize=None, source_mtime=0.0):
+        """Reconstruct a tree previously written by :meth:`save`.
+
+        The particle ordering is memory-mapped rather than read into memory. Split points and node
+        bounds are recomputed from *pos*, so the tree is valid even if the positions have been
+        transformed since it was saved.
+
+        Parameters
+        ----------
+        filename : str
+            File written by :meth:`save`.
+        pos, mass, leafsize, boxsize :
+            As for the constructor.
+        source_mtime : float, optional
+            Expected modification time of the snapshot the tree was built from.
+
+        Raises
+        ------
+        ValueError
+            If the file does not describe a tree for the given particles, leafsize and source_mtime.
+        """
+        with open(filename, "rb") as f:
+            header = np.lib.format.read_array(f, allow_pickle=False)
+            if len(header) != 4 or header[0] != cls._CACHE_FORMAT_VERSION:
+                raise ValueError("Unrecognised KDTree cache format")
+            if header[1] != len(pos) or header[2] != leafsize or header[3] != source_mtime:
+                raise ValueError("KDTree cache does not match the particles, leafsize or file modification time")
+            nodes = np.lib.format.read_array(f, allow_pickle=False)
+            if np.lib.format.read_magic(f) == (1, 0):
+                shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+            else:
+                shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+            particles = np.memmap(filename, dtype=dtype, mode="r", offset=f.tell(), shape=shape,
+                                  order="F" if fortran_order else "C")
+
+        self = cls.__new__(cls)
+        self._setup(kdmain.init_from_cache(pos, mass, int(leafsize), particles, nodes), pos, leafsize, boxsize,
+                    "cache")
+        return self
 
     def nn(self, nn=None):
         """Generator of neighbour list.
@@ -156,6 +263,182 @@ class KDTree:
         else:
             raise ValueError("Unknown smoothing request %s" % name)
 
+    def particles_in_sphere(self, centre, radius):
+        """Find all particles within a sphere.
+
+        The search releases the GIL, so many spheres can be searched concurrently from different threads.
+
+        Parameters
+        ----------
+        centre : array-like
+            Centre of the sphere, in the units of the positions used to build the tree.
+        radius : float
+            Radius of the sphere. Periodic images are included if the tree has a boxsize.
+
+        Returns
+        -------
+        indices : numpy.ndarray
+            Unsorted indices of the particles within the sphere.
+        """
+        x, y, z = (float(c) for c in centre)
+        return kdmain.particles_in_sphere(self.kdtree, x, y, z, float(radius), self._period())
+
+    def particles_in_box(self, lo, hi, smooth, h_factor=2.0):
+        """Find all particles whose smoothing region overlaps an axis-aligned box.
+
+        A particle is returned if, in every dimension, lo - h_factor*smooth < pos < hi + h_factor*smooth.
+        The maximum smoothing length within each tree node is calculated the first time a given
+        smoothing array is passed, so repeated queries cost in proportion to the number of
+        particles returned. The calculation is repeated if a different array is passed, or after
+        :meth:`smooth_array_changed` has been called, which SimSnap does whenever the array is modified.
+
+        Parameters
+        ----------
+        lo, hi : array-like
+            Lower and upper corners of the box, in the units of the positions used to build the tree.
+            Infinite values may be used to leave a dimension unbounded.
+        smooth : numpy.ndarray
+            Smoothing length of each particle.
+        h_factor : float, optional
+            Multiple of the smoothing length by which to extend the box (default 2.0)
+
+        Returns
+        -------
+        indices : numpy.ndarray
+            Unsorted indices of the particles overlapping the box.
+        """
+        if not isinstance(smooth, np.ndarray):
+            smooth = np.asarray(smooth)
+        return kdmain.particles_in_box(self.kdtree, smooth, float(lo[0]), float(hi[0]), float(lo[1]), float(hi[1]),
+                                       float(lo[2]), float(hi[2]), float(h_factor), self._update_cull_smooth(smooth))
+
+    def _update_cull_smooth(self, smooth):
+        """Record smooth as the array used for culling, returning True if the maximum smoothing length in
+        each node needs to be recalculated"""
+        # views of the same memory (e.g. the same array taken from different subsnaps) share a key
+        key = (smooth.__array_interface__['data'][0], smooth.shape, smooth.strides, smooth.dtype.str)
+        if self._cull_smooth is not None and key == self._cull_smooth_key:
+            return False
+        self._cull_smooth = smooth
+        self._cull_smooth_key = key
+        return True
+
+    def smooth_array_changed(self, name=None):
+        """Declare that a smoothing array passed to :meth:`particles_in_box` has been modified in place.
+
+        If name is given, the cached smoothing lengths are only discarded if they came from a SimArray of
+        that name (or from an unnamed array)."""
+        if self._cull_smooth is not None and getattr(self._cull_smooth, 'name', None) in (name, None):
+            self._cull_smooth = None
+
+    def _period(self):
+        if self.boxsize is None or self.boxsize <= 0:
+            return -1.0
+        return float(self.boxsize)
+
+    @staticmethod
+    def _query_points(points):
+        points = np.ascontiguousarray(points, dtype=np.float64)
+        if points.ndim == 1:
+            points = points.reshape(1, -1)
+        if points.ndim != 2 or points.shape[1] != 3:
+            raise ValueError("Query points must have shape (N, 3)")
+        return points
+
+    @staticmethod
+    def _query_chunks(n_points, threaded):
+        if threaded is None:
+            threaded = config["number_of_threads"]
+        n_chunks = max(1, min(int(threaded), n_points))
+        boundaries = np.linspace(0, n_points, n_chunks + 1).astype(np.intp)
+        return [slice(start, stop) for start, stop in zip(boundaries[:-1], boundaries[1:])]
+
+    def nearest_neighbours(self, points, k=1, threaded=None):
+        """Find the k nearest particles to each of a set of points.
+
+        The points need not be particle positions. Periodic images are taken into account if the tree has a boxsize.
+
+        Parameters
+        ----------
+        points : array-like
+            Query points of shape (N, 3), in the units of the positions used to build the tree.
+        k : int, optional
+            Number of neighbours to find for each point (default 1).
+        threaded : int, optional
+            Number of threads to use; defaults to the number_of_threads configuration option.
+
+        Returns
+        -------
+        distances : numpy.ndarray
+            Array of shape (N, k) giving the distances to the neighbours, in increasing order.
+        indices : numpy.ndarray
+            Array of shape (N, k) giving the indices of the neighbours.
+        """
+        from . import _thread_map
+
+        points = self._query_points(points)
+        k = int(k)
+        indices = np.empty((len(points), k), dtype=np.intp)
+        distances = np.empty((len(points), k), dtype=np.float64)
+        chunks = self._query_chunks(len(points), threaded)
+        _thread_map(lambda chunk: kdmain.nearest_neighbours(self.kdtree, points[chunk], k, self._period(),
+                                                             indices[chunk], distances[chunk]),
+                    chunks)
+        return distances, indices
+
+    def _particles_in_balls(self, points, radius, threaded, count_only):
+        from . import _thread_map
+
+        points = self._query_points(points)
+        radii = np.ascontiguousarray(np.broadcast_to(radius, (len(points),)), dtype=np.float64)
+        chunks = self._query_chunks(len(points), threaded)
+        results = [None] * len(chunks)
+
+        def search(i):
+            results[i] = kdmain.particles_in_balls(self.kdtree, points[chunks[i]], radii[chunks[i]],
+                                                   self._period(), count_only)
+
+        _thread_map(search, range(len(chunks)))
+        return results
+
+    def particles_in_balls(self, points, radius, threaded=None):
+        """Find all particles within a given distance of each of a set of points.
+
+        The results are returned in compressed sparse row form: the particles around point i are
+        indices[offsets[i]:offsets[i+1]], at distances distances[offsets[i]:offsets[i+1]]. Periodic
+        images are taken into account if the tree has a boxsize.
+
+        Parameters
+        ----------
+        points : array-like
+            Query points of shape (N, 3), in the units of the positions used to build the tree.
+        radius : float or array-like
+            Search radius, either a single value or one per point.
+        threaded : int, optional
+            Number of threads to use; defaults to the number_of_threads configuration option.
+
+        Returns
+        -------
+        offsets : numpy.ndarray
+            Array of length N+1 giving the start of each point's entries in indices and distances.
+        indices : numpy.ndarray
+            Unsorted indices of the particles found around each point.
+        distances : numpy.ndarray
+            Distance from the point to each particle found.
+        """
+        results = self._particles_in_balls(points, radius, threaded, False)
+        counts = np.concatenate([r[0] for r in results])
+        offsets = np.zeros(len(counts) + 1, dtype=np.intp)
+        np.cumsum(counts, out=offsets[1:])
+        return offsets, np.concatenate([r[1] for r in results]), np.concatenate([r[2] for r in results])
+
+    def count_in_balls(self, points, radius, threaded=None):
+        """Count the particles within a given distance of each of a set of points.
+
+        Parameters are as for :meth:`particles_in_balls`. Returns an array of length N.
+        """
+        return np.concatenate(self._particles_in_balls(points, radius, threaded, True))
+
     def populate(self, mode, nn):
         """Create the KDTree and perform the operation specified by `mode`.
 
@@ -219,7 +219,8 @@ kdmain = Extension('pynbody/sph/kdmain',
 gravity = Extension('pynbody.gravity._gravity',
                         sources = ["pynbody/gravity/_gravity.pyx"],
                         include_dirs=incdir,
-                        extra_compile_args=openmp_args,
+                        depends=["pynbody/gravity/direct_kernel.h"],
+                        extra_compile_args=openmp_args+['-fno-math-errno'],
                         extra_link_args=openmp_args)
 
 omp_commands = Extension('pynbody.openmp',
@@ -234,7 +235,9 @@ chunkscan = Extension('pynbody.chunk.scan',
 
 sph_render = Extension('pynbody.sph._render',
                   sources=['pynbody/sph/_render.pyx'],
-                  include_dirs=incdir)
+                  include_dirs=incdir,
+                  extra_compile_args=openmp_args,
+                  extra_link_args=openmp_args)
 
 halo_pyx = Extension('pynbody.analysis._com',
                      sources=['pynbody/analysis/_com.pyx'],
@@ -308,7 +311,7 @@ install_requires = [
     'matplotlib>=3.0.0',
     'numpy>=1.14.0',
     'posix_ipc>=0.8',
-    'scipy>=1.0.0'
+    'scipy>=1.4.0'
 ]
 
 tests_require = [
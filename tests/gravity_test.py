@@ -1,6 +1,9 @@
+import logging
+
 import pynbody
 import numpy as np
 import numpy.testing as npt
+import pytest
 
 
 def test_gravity():
@@ -68,3 +71,240 @@ def test_eps_retrieval_number():
                             -0.06739005, -0.06748439, -0.0695245,
                             -0.06803885, -0.0679833,  -0.07277965, -0.07189107])
     npt.assert_allclose(f['phi'][:10], true_phi_10)
+
+
+def _plummer_sphere(n, seed=1):
+    rng = np.random.default_rng(seed)
+    f = pynbody.new(n)
+    r = 1.0 / np.sqrt(rng.uniform(0.01, 1, n) ** (-2. / 3) - 1)
+    direction = rng.normal(size=(n, 3))
+    f['pos'] = direction * (r / np.linalg.norm(direction, axis=1))[:, np.newaxis]
+    f['mass'] = rng.uniform(0.5, 1.5, n) / n
+    f['eps'] = 0.01
+    return f
+
+
+@pytest.fixture
+def plummer():
+    return _plummer_sphere(5000)
+
+
+def test_tree_matches_direct(plummer):
+    f = plummer
+    pynbody.gravity.calc.all_direct(f)
+    phi_direct, acc_direct = f['phi'].copy(), f['acc'].copy()
+
+    pynbody.gravity.calc.all_tree(f, theta=0.5)
+    assert f['phi'].units == phi_direct.units
+    npt.assert_allclose(f['phi'], phi_direct, rtol=1e-3)
+    acc_error = np.linalg.norm(f['acc'] - acc_direct, axis=1) / np.linalg.norm(acc_direct, axis=1)
+    assert np.median(acc_error) < 1e-3
+    assert acc_error.max() < 0.03
+
+
+def test_tree_at_points(plummer):
+    f = plummer
+    points = np.random.default_rng(2).uniform(-3, 3, size=(300, 3))
+    phi_direct, acc_direct = pynbody.gravity.calc.direct(f, points)
+    phi, acc = pynbody.gravity.calc.treecalc(f, points, theta=0.3)
+    npt.assert_allclose(phi, phi_direct, rtol=1e-4)
+    npt.assert_allclose(acc, acc_direct, rtol=1e-3, atol=1e-3 * np.abs(acc_direct).max())
+
+
+def test_pm_periodic_plane_wave():
+    # a lattice of particles whose masses follow a plane wave has an analytic periodic potential
+    n = 16
+    f = pynbody.new(n ** 3)
+    cells = (np.indices((n, n, n)).reshape(3, -1).T + 0.5) / n
+    f['pos'] = cells
+    k = 2 * np.pi
+    f['mass'] = (1 + 0.1 * np.cos(k * cells[:, 0])) / n ** 3
+    f['eps'] = 1e-3
+
+    # particles at cell centres are assigned exactly by NGP and CIC, but not by TSC
+    for assignment, deconvolve in ('ngp', False), ('cic', False), ('tsc', True):
+        phi, acc = pynbody.gravity.calc.pm(f, cells, ngrid=n, x0=0, x1=1, periodic=True,
+                                           assignment=assignment, deconvolve=deconvolve)
+        npt.assert_allclose(phi, -4 * np.pi * 0.1 * np.cos(k * cells[:, 0]) / k ** 2, atol=1e-3)
+        npt.assert_allclose(acc[:, 0], -4 * np.pi * 0.1 * np.sin(k * cells[:, 0]) / k, atol=3e-3)
+        npt.assert_allclose(acc[:, 1:], 0, atol=1e-10)
+
+
+def test_pm_and_treepm_isolated(plummer):
+    f = plummer
+    f = f[pynbody.filt.Sphere(5.0)]
+    # avoid the particles themselves, where the mesh cannot resolve their own softened contribution
+    points = np.random.default_rng(2).uniform(-3, 3, size=(500, 3))
+    phi_direct, acc_direct = pynbody.gravity.calc.direct(f, points)
+    acc_scale = np.linalg.norm(acc_direct, axis=1)
+
+    phi, acc = pynbody.gravity.calc.pm(f, points, ngrid=64, assignment='tsc')
+    assert phi.units == phi_direct.units
+    npt.assert_allclose(phi, phi_direct, rtol=0.05)
+    assert np.median(np.linalg.norm(acc - acc_direct, axis=1) / acc_scale) < 0.05
+
+    phi, acc = pynbody.gravity.calc.treepm(f, points, ngrid=32)
+    npt.assert_allclose(phi, phi_direct, rtol=5e-3)
+    assert (np.linalg.norm(acc - acc_direct, axis=1) / acc_scale).max() < 0.02
+
+
+def test_treepm_threads(plummer):
+    f = plummer
+    points = np.random.default_rng(2).uniform(-2, 2, size=(2000, 3))
+    old_threads = pynbody.config['number_of_threads']
+    try:
+        results = []
+        for num_threads in 1, 8:
+            pynbody.config['number_of_threads'] = num_threads
+            results.append(pynbody.gravity.calc.treepm(f, points, ngrid=32))
+    finally:
+        pynbody.config['number_of_threads'] = old_threads
+    npt.assert_allclose(results[1][0], results[0][0], rtol=1e-12)
+    npt.assert_allclose(results[1][1], results[0][1], rtol=1e-12, atol=1e-12)
+
+
+def test_derived_phi_and_accg(plummer):
+    f = plummer
+    phi_direct, acc_direct = pynbody.gravity.calc.direct(f, f['pos'].view(np.ndarray))
+
+    npt.assert_allclose(f['phi'], phi_direct)
+    npt.assert_allclose(f['accg'], acc_direct)
+    assert f['phi'].units == phi_direct.units
+    npt.assert_allclose(f[::7]['accg'], acc_direct[::7])
+
+    # derived arrays are recalculated when their inputs change
+    f['mass'] *= 2
+    npt.assert_allclose(f['phi'], 2 * phi_direct)
+    npt.assert_allclose(f['accg'], 2 * acc_direct)
+
+
+def test_derived_phi_across_families(plummer):
+    f = pynbody.new(dm=2500, star=2500)
+    for name in 'pos', 'mass', 'eps':
+        f[name] = plummer[name]
+    star_phi = f.st['phi'].copy()
+    star_accg = f.st['accg'].copy()
+
+    # the stars feel the dark matter, so changing its mass changes their potential
+    f.dm['mass'] *= 3
+    phi_direct, acc_direct = pynbody.gravity.calc.direct(f, f.st['pos'].view(np.ndarray))
+    npt.assert_allclose(f.st['phi'], phi_direct)
+    npt.assert_allclose(f.st['accg'], acc_direct)
+    assert not np.allclose(f.st['phi'], star_phi)
+    assert not np.allclose(f.st['accg'], star_accg)
+
+
+def test_derived_phi_warns(plummer, caplog):
+    f = plummer
+
+    # a stored potential is used as it is
+    f['phi'] = np.zeros(len(f))
+    with caplog.at_level(logging.WARNING, logger="pynbody.gravity"):
+        pynbody.analysis.halo.potential_minimum(f)
+    assert caplog.text == ""
+
+    del f['phi']
+    with caplog.at_level(logging.WARNING, logger="pynbody.gravity"):
+        f[:10]['phi']
+    assert "all 5000 particles" in caplog.text
+
+
+def test_derived_phi_solver_selection(plummer):
+    f = plummer
+    phi_direct, _ = pynbody.gravity.calc.direct(f, f['pos'].view(np.ndarray))
+    old_limit = pynbody.config_parser.get('gravity', 'direct-max-particles')
+    pynbody.config_parser.set('gravity', 'direct-max-particles', '100')
+    try:
+        assert pynbody.gravity._solver_for(len(f)) == 'tree'
+        phi = f['phi']
+    finally:
+        pynbody.config_parser.set('gravity', 'direct-max-particles', old_limit)
+    npt.assert_allclose(phi, phi_direct, rtol=1e-3)
+    assert not np.array_equal(phi, phi_direct)
+
+
+def test_direct_accumulation_precision(plummer):
+    f = plummer
+    points = np.random.default_rng(2).uniform(-2, 2, size=(500, 3))
+    dx = points[:, np.newaxis, :] - f['pos'].view(np.ndarray)[np.newaxis, :, :]
+    r2 = (dx ** 2).sum(axis=2) + 0.01 ** 2
+    phi_expected = -(f['mass'].view(np.ndarray) / np.sqrt(r2)).sum(axis=1)
+    acc_expected = -(f['mass'].view(np.ndarray)[:, np.newaxis] * dx / r2[:, :, np.newaxis] ** 1.5).sum(axis=1)
+
+    phi, acc = pynbody.gravity.calc.direct(f, points)
+    npt.assert_allclose(phi, phi_expected, rtol=1e-12)
+    npt.assert_allclose(acc, acc_expected, rtol=1e-12, atol=1e-12)
+
+    phi, acc = pynbody.gravity.calc.direct(f, points, accumulate=np.float32)
+    assert phi.dtype == np.float64
+    npt.assert_allclose(phi, phi_expected, rtol=1e-5)
+    npt.assert_allclose(acc, acc_expected, rtol=1e-4, atol=1e-5 * np.abs(acc_expected).max())
+
+
+def test_midplane_rot_curve_azimuths(plummer):
+    f = plummer
+    radii = np.linspace(0.1, 3, 20)
+    v_circ = pynbody.gravity.calc.midplane_rot_curve(f, radii, n_azimuth=8, mode='direct')
+
+    angles = 2 * np.pi * np.arange(8) / 8
+    expected = []
+    for r in radii:
+        points = r * np.stack((np.cos(angles), np.sin(angles), np.zeros(8)), axis=1)
+        _, acc = pynbody.gravity.calc.direct(f, points)
+        expected.append(np.sqrt(max(-(acc * points).sum(axis=1).mean(), 0)))
+    npt.assert_allclose(v_circ, expected, rtol=1e-10)
+
+    pot = pynbody.gravity.calc.midplane_potential(f, radii, mode='direct')
+    assert pot.shape == radii.shape
+    assert (np.diff(pot) > 0).all()
+
+
+def test_multipole_point_masses():
+    # away from the particles, the expansion of a few point masses converges to the exact potential
+    f = pynbody.new(3)
+    f['pos'] = [[1.0, 0.5, -0.3], [-2.0, 1.0, 1.5], [0.2, -0.4, 3.0]]
+    f['mass'] = [1.0, 2.0, 0.5]
+    f['eps'] = 1e-12
+    expansion = pynbody.gravity.multipole.MultipolePotential(f, lmax=20)
+
+    rng = np.random.default_rng(2)
+    for radius in 0.2, 6.0:
+        direction = rng.normal(size=(50, 3))
+        points = radius * direction / np.linalg.norm(direction, axis=1)[:, np.newaxis]
+        phi_direct, acc_direct = pynbody.gravity.calc.direct(f, points)
+        acc, phi = expansion.calc(points)
+        npt.assert_allclose(phi, phi_direct, rtol=1e-5)
+        npt.assert_allclose(acc, acc_direct, rtol=1e-5, atol=1e-5 * np.abs(acc_direct).max())
+
+
+def test_multipole_plummer(tmp_path):
+    # enough particles that their shot noise is small compared with the truncation error
+    f = _plummer_sphere(20000)
+    points = np.random.default_rng(2).uniform(-3, 3, size=(500, 3))
+    points = points[np.linalg.norm(points, axis=1) > 0.3]
+    phi_direct, acc_direct = pynbody.gravity.calc.direct(f, points)
+
+    phi, acc = pynbody.gravity.calc.multipole(f, points, lmax=4)
+    assert phi.units == phi_direct.units
+    npt.assert_allclose(phi, phi_direct, rtol=0.01)
+    acc_error = np.linalg.norm(acc - acc_direct, axis=1) / np.linalg.norm(acc_direct, axis=1)
+    assert np.median(acc_error) < 0.02
+
+    radii = np.linspace(0.5, 3, 6)
+    v_circ_direct = pynbody.gravity.calc.midplane_rot_curve(f, radii, mode='direct', n_azimuth=16)
+    npt.assert_allclose(pynbody.gravity.calc.midplane_rot_curve(f, radii, mode='multipole', n_azimuth=16),
+                        v_circ_direct, rtol=0.02)
+
+    # a saved expansion gives identical results without the particles, in units that are not round numbers
+    f['pos'].units = '3.085678e21 cm'
+    f['mass'].units = '232505 Msol'
+    expansion = pynbody.gravity.multipole.MultipolePotential(f, lmax=4)
+    expansion.save(tmp_path / "expansion.npz")
+    loaded = pynbody.gravity.multipole.MultipolePotential.load(tmp_path / "expansion.npz")
+    npt.assert_array_equal(loaded.phi(points), expansion.phi(points))
+    npt.assert_array_equal(loaded.accel(points), expansion.accel(points))
+    assert loaded.pos_units.ratio(f['pos'].units) == 1.0
+    assert loaded.mass_units.ratio(f['mass'].units) == 1.0
+    npt.assert_allclose(loaded.phi(points).in_units('km^2 s^-2'), expansion.phi(points).in_units('km^2 s^-2'),
+                        rtol=1e-14)
+    npt.assert_allclose(loaded.v_circ(radii), v_circ_direct.view(np.ndarray), rtol=0.02)
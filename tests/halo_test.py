@@ -0,0 +1,168 @@
+import logging
+
+import numpy as np
+import numpy.testing as npt
+import pytest
+
+import pynbody
+
+
+def make_triaxial_halo(npart=50000, ba=0.7, ca=0.5, seed=1):
+    rng = np.random.default_rng(seed)
+    f = pynbody.new(dm=npart)
+    pos = rng.normal(size=(npart, 3))
+    pos *= (rng.uniform(size=npart) ** 1.5 / np.linalg.norm(pos, axis=1))[:, np.newaxis] * 50
+    pos *= [1.0, ba, ca]
+    f['pos'] = pos
+    f['pos'].units = 'kpc'
+    f['mass'] = 1.0
+    f['mass'].units = 'Msol'
+    return f
+
+
+def test_halo_shape():
+    f = make_triaxial_halo()
+    rbin, ba, ca, angle, Es = pynbody.analysis.halo.halo_shape(f, N=5)
+    assert rbin.units == 'kpc'
+    npt.assert_allclose(ba, 0.7, atol=0.05)
+    npt.assert_allclose(ca, 0.5, atol=0.05)
+
+
+def test_halo_shape_unequal_masses():
+    # doubling the mass of a particle is the same as duplicating it
+    f = make_triaxial_halo(20000)
+    heavy = np.arange(0, 20000, 3)
+    f['mass'][heavy] = 2.0
+    duplicated = pynbody.new(dm=20000 + len(heavy))
+    duplicated['pos'] = np.concatenate((f['pos'], f['pos'][heavy]))
+    duplicated['pos'].units = 'kpc'
+    duplicated['mass'] = 1.0
+    duplicated['mass'].units = 'Msol'
+
+    args = dict(N=4, rin=5., rout=40., bins='log')
+    shape = pynbody.analysis.halo.halo_shape(f, **args)
+    expected = pynbody.analysis.halo.halo_shape(duplicated, **args)
+    for i in range(1, 4):
+        npt.assert_allclose(shape[i], expected[i], rtol=1e-6)
+
+
+@pytest.fixture
+def halo_field():
+    rng = np.random.default_rng(2)
+    nhalo, npart = 12, 500
+    n_total = nhalo * npart + 1000
+    f = pynbody.new(dm=n_total)
+    centres = rng.uniform(-5000, 5000, size=(nhalo, 3))
+    pos = rng.uniform(-5000, 5000, size=(n_total, 3))
+    grp = np.full(n_total, -1)
+    for i in range(nhalo):
+        sl = slice(i * npart, (i + 1) * npart)
+        r = rng.normal(size=(npart, 3)) * rng.uniform(size=(npart, 1)) ** 2 * 30
+        pos[sl] = centres[i] + r
+        grp[sl] = i + 1
+    # shuffle so that halo particles are not contiguous in the snapshot
+    perm = rng.permutation(n_total)
+    f['pos'] = pos[perm]
+    f['pos'].units = 'kpc'
+    f['mass'] = rng.uniform(0.5, 1.5, n_total)
+    f['mass'].units = 'Msol'
+    f['phi'] = -f['mass'] * rng.uniform(size=n_total)
+    f['grp'] = grp[perm]
+    return f
+
+
+def test_batch_center(halo_field):
+    f = halo_field
+    h = pynbody.halo.GrpCatalogue(f, ignore=-1)
+
+    ssc = pynbody.analysis.halo.batch_center(h, mode='ssc', num_threads=3)
+    com = pynbody.analysis.halo.batch_center(h, mode='com')
+    pot = pynbody.analysis.halo.batch_center(f, mode='pot', group_array='grp')
+    assert ssc.shape == (12, 3)
+    assert ssc.units == 'kpc'
+
+    for i in range(12):
+        halo = h[i + 1]
+        # shrink_sphere_center accumulates radii in single precision, the batch version in double
+        npt.assert_allclose(ssc[i], pynbody.analysis.halo.shrink_sphere_center(halo, num_threads=1), rtol=1e-6)
+        npt.assert_allclose(com[i], pynbody.analysis.halo.center_of_mass(halo), rtol=1e-10)
+        npt.assert_array_equal(pot[i], pynbody.analysis.halo.potential_minimum(halo))
+
+    # selection and ordering of halos, including one that does not exist
+    sub = pynbody.analysis.halo.batch_center(h, mode='com', halo_ids=[5, 2, 99])
+    npt.assert_allclose(sub[:2], com[[4, 1]])
+    assert np.isnan(sub[2]).all()
+
+
+def test_batch_center_without_group_array(halo_field, caplog):
+    f = halo_field
+    h = pynbody.halo.GrpCatalogue(f, ignore=-1)
+    expected = pynbody.analysis.halo.batch_center(h, mode='com', halo_ids=[3, 1, 4])
+
+    def no_group_array():
+        raise NotImplementedError
+    h.get_group_array = no_group_array
+    with caplog.at_level(logging.WARNING, logger="pynbody.analysis.halo"):
+        com = pynbody.analysis.halo.batch_center(h, mode='com', halo_ids=[3, 1, 4])
+    assert "much slower" in caplog.text
+    npt.assert_allclose(com, expected)
+
+
+def test_virial_radius():
+    f = make_triaxial_halo(ba=1.0, ca=1.0)
+    f['mass'] = 1e5
+    f.properties.update(dict(omegaM0=0.3, omegaL0=0.7, h=0.7, z=0.0, a=1.0))
+
+    r200c = pynbody.analysis.halo.virial_radius(f, overden=200, rho_def='critical')
+    target = 200 * pynbody.analysis.cosmology.rho_crit(f, z=0)
+    enclosed = f['mass'][f['r'] < r200c].sum()
+    npt.assert_allclose(enclosed / (4 * np.pi * r200c ** 3 / 3), target, rtol=1e-3)
+
+    radii = pynbody.analysis.halo.virial_radius(f, overden=[178, '200c', '500c', '200m'])
+    assert radii.shape == (4,)
+    npt.assert_allclose(radii[1], r200c)
+    npt.assert_allclose(radii[0], pynbody.analysis.halo.virial_radius(f))
+    npt.assert_allclose(radii[3], pynbody.analysis.halo.virial_radius(f, overden=200, rho_def='matter'))
+    assert radii[2] < radii[1] < radii[3] < radii[0]
+
+
+def test_batch_virial_radius(halo_field):
+    f = halo_field
+    f['mass'] *= 1e8
+    f.properties.update(dict(omegaM0=0.3, omegaL0=0.7, h=0.7, z=0.0, a=1.0))
+    h = pynbody.halo.GrpCatalogue(f, ignore=-1)
+
+    cen = pynbody.analysis.halo.batch_center(h)
+    radii = pynbody.analysis.halo.batch_virial_radius(h, overden=['200c', '500c'])
+    assert radii.shape == (12, 2)
+    for i in range(12):
+        expected = pynbody.analysis.halo.virial_radius(h[i + 1], cen=cen[i], overden=['200c', '500c'])
+        npt.assert_allclose(radii[i], expected, rtol=1e-10)
+
+
+def test_spherical_overdensity_catalogue(halo_field):
+    f = halo_field
+    f['mass'] *= 1e8
+    f.properties.update(dict(omegaM0=0.3, omegaL0=0.7, h=0.7, z=0.0, a=1.0))
+    h = pynbody.halo.GrpCatalogue(f, ignore=-1)
+
+    table = pynbody.analysis.halo.spherical_overdensity_catalogue(h, num_threads=3)
+    assert len(table) == 12
+    npt.assert_array_equal(table['halo_id'], np.arange(1, 13))
+    npt.assert_allclose(table['cen'], pynbody.analysis.halo.batch_center(h))
+
+    G = pynbody.units.G.ratio("km^2 s^-2 kpc Msol^-1")
+    for row in table[:4]:
+        expected = pynbody.analysis.halo.virial_radius(f, cen=row['cen'], overden=[178, '200c', '500c', '200m'],
+                                                       r_max=1000.)
+        npt.assert_allclose([row['r178'], row['r200c'], row['r500c'], row['r200m']], expected, rtol=1e-10)
+
+        r = np.sqrt(((f['pos'] - row['cen']) ** 2).sum(axis=1))
+        npt.assert_allclose(row['m200c'], f['mass'][r < row['r200c']].sum(), rtol=1e-10)
+
+        order = np.argsort(r)
+        r, enclosed = r[order], np.cumsum(f['mass'][order])
+        inside = r <= row['r178']
+        vcirc = np.sqrt(G * enclosed[inside] / r[inside])
+        npt.assert_allclose(row['vmax'], vcirc.max(), rtol=1e-10)
+        npt.assert_allclose(row['rmax'], r[inside][vcirc.argmax()])
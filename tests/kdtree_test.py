@@ -0,0 +1,210 @@
+import numpy as np
+import numpy.testing as npt
+import pytest
+
+import pynbody
+
+
+def make_periodic_gas(npart=50000, seed=3):
+    rng = np.random.default_rng(seed)
+    f = pynbody.new(gas=npart)
+    f['pos'] = rng.uniform(-50, 50, (npart, 3))
+    f['pos'].units = 'kpc'
+    f['mass'] = rng.uniform(0.5, 1.5, npart)
+    f['mass'].units = 'Msol'
+    f.properties['boxsize'] = pynbody.units.Unit('100 kpc')
+    return f
+
+
+@pytest.fixture
+def periodic_gas():
+    return make_periodic_gas()
+
+
+def test_particles_in_sphere(periodic_gas):
+    f = periodic_gas
+    pynbody.sph.build_tree(f)
+    centre = np.array([48.0, -2.0, 10.0])
+    found = np.sort(f.kdtree.particles_in_sphere(centre, 5.0))
+    offset = (f['pos'] - centre + 50) % 100 - 50
+    expected = np.where((offset ** 2).sum(axis=1) <= 25.0)[0]
+    npt.assert_array_equal(found, expected)
+
+
+def test_particles_in_sphere_without_boxsize(periodic_gas):
+    f = periodic_gas
+    tree = pynbody.sph.kdtree.KDTree(f['pos'], f['mass'])
+    centre = np.array([48.0, -2.0, 10.0])
+    found = np.sort(tree.particles_in_sphere(centre, 5.0))
+    expected = np.where(((f['pos'] - centre) ** 2).sum(axis=1) <= 25.0)[0]
+    npt.assert_array_equal(found, expected)
+
+
+def test_particles_in_box(periodic_gas):
+    f = periodic_gas
+    pynbody.sph.build_tree(f)
+    smooth = np.random.default_rng(4).uniform(0, 1, len(f)) ** 4 * 3
+    found = np.sort(f.kdtree.particles_in_box((0, 0, -np.inf), (5, 10, np.inf), smooth))
+    expected = np.where((f['x'] > -2 * smooth) & (f['x'] < 5 + 2 * smooth) &
+                        (f['y'] > -2 * smooth) & (f['y'] < 10 + 2 * smooth))[0]
+    npt.assert_array_equal(found, expected)
+
+
+def test_render_z_plane():
+    f = make_periodic_gas(20000)
+    f['smooth']
+    f['rho']
+    shifted = pynbody.new(gas=len(f))
+    for name in 'pos', 'mass', 'smooth', 'rho':
+        shifted[name] = f[name]
+    shifted['z'] -= 20.
+
+    # with a 3D kernel, the image is a slice at z_plane
+    args = dict(x2=10., nx=40, threaded=False, approximate_fast=False, denoise=False)
+    im = pynbody.sph.render_image(f, z_plane=20., **args)
+    npt.assert_allclose(im, pynbody.sph.render_image(shifted, **args), rtol=1e-4, atol=1e-6 * im.max())
+    assert not np.allclose(im, pynbody.sph.render_image(f, **args))
+
+
+@pytest.mark.parametrize("kernel", [pynbody.sph.Kernel(), pynbody.sph.Kernel2D()])
+def test_tree_culled_render(periodic_gas, kernel):
+    f = periodic_gas
+    f['smooth']
+    f['rho']
+    assert hasattr(f, 'kdtree')
+
+    # zoomed frame straddling the periodic boundary
+    args = dict(x1=45., x2=55., y1=-5., y2=5., nx=50, kernel=kernel, threaded=False, approximate_fast=False)
+    culled = pynbody.sph.render_image(f, **args)
+    pynbody.sph._tree_cull_image = False
+    try:
+        full = pynbody.sph.render_image(f, **args)
+    finally:
+        pynbody.sph._tree_cull_image = True
+
+    npt.assert_array_equal(culled, full)
+    assert culled.units == full.units
+
+
+def test_tree_culled_render_after_smooth_changes(periodic_gas):
+    f = periodic_gas
+    f['smooth']
+    f['rho']
+    args = dict(x1=45., x2=55., y1=-5., y2=5., nx=50, threaded=False, approximate_fast=False)
+    pynbody.sph.render_image(f, **args)
+
+    # views of the same smoothing lengths reuse the per-node maxima, but in-place edits discard them
+    assert not f.kdtree._update_cull_smooth(f.gas['smooth'])
+    f['smooth'] *= 4
+    assert f.kdtree._cull_smooth is None
+
+    culled = pynbody.sph.render_image(f, **args)
+    pynbody.sph._tree_cull_image = False
+    try:
+        full = pynbody.sph.render_image(f, **args)
+    finally:
+        pynbody.sph._tree_cull_image = True
+    npt.assert_array_equal(culled, full)
+
+
+def test_tree_cache_roundtrip(periodic_gas, tmp_path):
+    f = periodic_gas
+    leafsize = pynbody.config['sph']['tree-leafsize']
+    pynbody.sph.build_tree(f)
+    smooth_built = np.array(f['smooth'])
+    filename = str(tmp_path / "test.kdtree")
+    f.kdtree.save(filename, source_mtime=123.0)
+
+    tree = pynbody.sph.kdtree.KDTree.load(filename, f['pos'], f['mass'], leafsize=leafsize,
+                                          boxsize=100.0, source_mtime=123.0)
+    tree.set_array_ref('smooth', np.empty_like(smooth_built))
+    tree.populate('hsm', pynbody.config['sph']['smooth-particles'])
+    npt.assert_allclose(tree.get_array_ref('smooth'), smooth_built, rtol=1e-6)
+
+    # node bounds are recomputed on load, so the cached tree remains valid for moved particles
+    pos = np.ascontiguousarray(f['pos'][:, [2, 0, 1]] * 0.5 + 3.0)
+    tree = pynbody.sph.kdtree.KDTree.load(filename, pos, f['mass'], leafsize=leafsize,
+                                          boxsize=100.0, source_mtime=123.0)
+    centre = np.array([20.0, -2.0, 10.0])
+    found = np.sort(tree.particles_in_sphere(centre, 5.0))
+    offset = (pos - centre + 50) % 100 - 50
+    expected = np.where((offset ** 2).sum(axis=1) <= 25.0)[0]
+    npt.assert_array_equal(found, expected)
+
+
+def test_tree_cache_rejects_mismatch(tmp_path):
+    f = make_periodic_gas(npart=1000)
+    leafsize = pynbody.config['sph']['tree-leafsize']
+    pynbody.sph.build_tree(f)
+    filename = str(tmp_path / "test.kdtree")
+    f.kdtree.save(filename, source_mtime=123.0)
+    with pytest.raises(ValueError):
+        pynbody.sph.kdtree.KDTree.load(filename, f['pos'], f['mass'], leafsize=leafsize, source_mtime=124.0)
+    with pytest.raises(ValueError):
+        pynbody.sph.kdtree.KDTree.load(filename, f['pos'][:-1], f['mass'][:-1], leafsize=leafsize,
+                                       source_mtime=123.0)
+    with pytest.raises(ValueError):
+        pynbody.sph.kdtree.KDTree.load(filename, f['pos'], f['mass'], leafsize=leafsize * 2, source_mtime=123.0)
+
+
+def _periodic_distances(f, points):
+    offset = (points[:, np.newaxis, :] - np.asarray(f['pos'])[np.newaxis, :, :] + 50) % 100 - 50
+    return np.sqrt((offset ** 2).sum(axis=2))
+
+
+@pytest.mark.parametrize("threaded", [1, 3])
+def test_nearest_neighbours(threaded):
+    f = make_periodic_gas(npart=5000)
+    pynbody.sph.build_tree(f)
+    points = np.random.default_rng(4).uniform(-55, 55, (200, 3))
+    distances, indices = f.kdtree.nearest_neighbours(points, k=8, threaded=threaded)
+    r = _periodic_distances(f, points)
+    npt.assert_allclose(distances, np.sort(r, axis=1)[:, :8])
+    npt.assert_allclose(np.take_along_axis(r, indices, axis=1), distances)
+
+
+@pytest.mark.parametrize("threaded", [1, 3])
+def test_particles_in_balls(threaded):
+    f = make_periodic_gas(npart=5000)
+    pynbody.sph.build_tree(f)
+    rng = np.random.default_rng(4)
+    points = rng.uniform(-55, 55, (200, 3))
+    radii = rng.uniform(2, 10, 200)
+    offsets, indices, distances = f.kdtree.particles_in_balls(points, radii, threaded=threaded)
+    r = _periodic_distances(f, points)
+    for i in range(len(points)):
+        found = indices[offsets[i]:offsets[i + 1]]
+        npt.assert_array_equal(np.sort(found), np.where(r[i] <= radii[i])[0])
+        npt.assert_allclose(distances[offsets[i]:offsets[i + 1]], r[i, found])
+
+    npt.assert_array_equal(f.kdtree.count_in_balls(points, radii, threaded=threaded), np.diff(offsets))
+
+
+def test_tree_refresh_after_transformation():
+    f = make_periodic_gas(npart=5000)
+    pynbody.sph.build_tree(f)
+    tree = f.kdtree
+    assert tree.origin == "built"
+
+    f.rotate_z(30)
+    pynbody.transformation.translate(f, [3.0, -2.0, 1.0])
+    assert not hasattr(f, 'kdtree')
+    pynbody.sph.build_tree(f)
+    assert f.kdtree is tree
+    assert f.kdtree.origin == "refreshed"
+
+    centre = np.array([20.0, -2.0, 10.0])
+    found = np.sort(f.kdtree.particles_in_sphere(centre, 5.0))
+    offset = (f['pos'] - centre + 50) % 100 - 50
+    expected = np.where((offset ** 2).sum(axis=1) <= 25.0)[0]
+    npt.assert_array_equal(found, expected)
+
+
+def test_tree_rebuilt_after_large_displacement():
+    f = make_periodic_gas(npart=5000)
+    pynbody.sph.build_tree(f)
+    tree = f.kdtree
+    f['pos'] = np.random.default_rng(4).uniform(-50, 50, (len(f), 3))
+    pynbody.sph.build_tree(f)
+    assert f.kdtree is not tree
+    assert f.kdtree.origin == "built"
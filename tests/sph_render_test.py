@@ -0,0 +1,168 @@
+import numpy as np
+import numpy.testing as npt
+import pytest
+
+import pynbody
+
+
+@pytest.fixture
+def gas():
+    rng = np.random.default_rng(5)
+    npart = 30000
+    f = pynbody.new(gas=npart)
+    f['pos'] = np.clip(rng.normal(size=(npart, 3)) * rng.uniform(size=(npart, 1)) ** 3 * 40, -49, 49)
+    f['pos'].units = 'kpc'
+    f['mass'] = rng.uniform(0.5, 1.5, npart)
+    f['mass'].units = 'Msol'
+    f.properties['boxsize'] = pynbody.units.Unit('100 kpc')
+    f['smooth']
+    f['rho']
+    return f
+
+
+@pytest.mark.parametrize("kernel", [pynbody.sph.Kernel(), pynbody.sph.Kernel2D()])
+@pytest.mark.parametrize("approximate_fast", [False, True])
+def test_tiled_render_matches_single_thread(gas, kernel, approximate_fast):
+    # deliberately not a multiple of the tile size, and wide enough to wrap
+    args = dict(x2=60., nx=150, ny=130, kernel=kernel, approximate_fast=approximate_fast)
+    single = pynbody.sph.render_image(gas, threaded=False, **args)
+    tiled = pynbody.sph.render_image(gas, threaded=3, **args)
+    npt.assert_array_equal(tiled, single)
+    npt.assert_array_equal(pynbody.sph.render_image(gas, threaded=2, **args), tiled)
+    assert tiled.units == single.units
+
+
+def test_tiles_use_frame_geometry(gas, monkeypatch):
+    # small tiles on a frame whose pixel size is not exactly representable
+    monkeypatch.setattr(pynbody.sph, '_image_tile_size', 7)
+    args = dict(x1=-13.7, x2=31.1, y1=-29.3, y2=7.9, nx=97, ny=83, approximate_fast=False, denoise=False)
+    npt.assert_array_equal(pynbody.sph.render_image(gas, threaded=3, **args),
+                           pynbody.sph.render_image(gas, threaded=False, **args))
+
+    x, y, z, sm = (np.asarray(gas[k], dtype=np.float64) for k in ('x', 'y', 'z', 'smooth'))
+    qty = np.asarray(gas['rho'])
+    full = pynbody.sph._render.render_image(97, 83, x, y, z, sm, -13.7, 31.1, -29.3, 7.9, 0.0, 0.0, qty, qty, qty,
+                                            0.0, 1.e5, pynbody.sph.Kernel())
+    tile = pynbody.sph._render.render_image(97, 83, x, y, z, sm, -13.7, 31.1, -29.3, 7.9, 0.0, 0.0, qty, qty, qty,
+                                            0.0, 1.e5, pynbody.sph.Kernel(), x_tile_start=14, x_tile_stop=21,
+                                            y_tile_start=77, y_tile_stop=83)
+    npt.assert_array_equal(tile, full[77:83, 14:21])
+
+
+def test_tile_assignment_is_complete(gas):
+    x, y, sm = (np.asarray(gas[k], dtype=np.float64) for k in ('x', 'y', 'smooth'))
+    particles, _, _, tiles = pynbody.sph._assign_particles_to_tiles(100, 100, x, y, sm, -20., 20., -20., 20., 2.0,
+                                                                    [0.0], [0.0], 16)
+    assert tiles.max() < 49
+    assert np.all(np.diff(tiles) >= 0)
+    # a particle is never assigned to the same tile twice
+    assert len(np.unique(tiles * len(x) + particles)) == len(particles)
+
+
+def test_spectra(gas):
+    rng = np.random.default_rng(2)
+    gas['vel'] = rng.normal(size=(len(gas), 3)) * 50
+    gas['vel'].units = 'km s^-1'
+    gas['temp'] = rng.uniform(1.e4, 1.e5, len(gas))
+    gas['temp'].units = 'K'
+
+    xs, ys = rng.uniform(-5, 5, (2, 20))
+    vels, tau = pynbody.sph.spectra(gas, x1=xs, y1=ys, v2=600, nvel=300, threaded=1)
+    assert tau.shape == (20, 300)
+    assert len(vels) == 300
+    npt.assert_array_equal(pynbody.sph.spectra(gas, x1=xs, y1=ys, v2=600, nvel=300, threaded=3)[1], tau)
+    npt.assert_array_equal(pynbody.sph.spectra(gas, x1=xs[4], y1=ys[4], v2=600, nvel=300)[1], tau[4])
+
+    # integrated over velocity, the optical depth must reflect the projected column density
+    sigma = np.pi * 4.80320425e-10 ** 2 / (9.1093837015e-28 * 2.99792458e10) * 0.4164 * 1215.6701e-8
+    column = tau.sum(axis=1) * (vels[1] - vels[0]) * 1.e5 / sigma
+    conv = (gas['mass'].units / gas['smooth'].units ** 2).ratio('m_p cm^-2')
+    for s in range(3):
+        im = pynbody.sph.render_image(gas, kernel=pynbody.sph.Kernel2D(), x1=xs[s] - 1.e-3, x2=xs[s] + 1.e-3,
+                                      y1=ys[s] - 1.e-3, y2=ys[s] + 1.e-3, nx=1, ny=1,
+                                      threaded=False, approximate_fast=False)
+        npt.assert_allclose(column[s], float(im[0, 0]) * conv, rtol=1.e-5)
+
+
+def test_slab_grid_matches_full_grid(gas, tmp_path):
+    args = dict(nx=40, ny=36, nz=44, x2=30., threaded=False, approximate_fast=False, denoise=False)
+    full = pynbody.sph.to_3d_grid(gas, **args)
+    npt.assert_array_equal(pynbody.sph.to_3d_grid(gas, slab_pixels=7, **args), full)
+    npt.assert_array_equal(pynbody.sph.to_3d_grid(gas, **dict(args, threaded=3)), full)
+
+    filename = str(tmp_path / "grid.npy")
+    on_disk = pynbody.sph.to_3d_grid(gas, out_file=filename, slab_pixels=5, **args)
+    assert on_disk.units == full.units
+    npt.assert_array_equal(np.load(filename), full)
+
+
+def test_threaded_grid_honours_approximate_fast(gas, monkeypatch):
+    args = dict(nx=80, x2=30., denoise=False, approximate_fast=True)
+    single = pynbody.sph.to_3d_grid(gas, threaded=False, **args)
+    exact = pynbody.sph.to_3d_grid(gas, **dict(args, approximate_fast=False, threaded=False))
+
+    # threaded gridding is done slab by slab, never with a grid per thread
+    def no_threaded_render(*args, **kwargs):
+        raise AssertionError("threaded gridding used a grid per thread")
+    monkeypatch.setattr(pynbody.sph, '_threaded_render_image', no_threaded_render)
+
+    atol = 1e-3 * float(exact.max())
+    for slab_pixels in None, 3:
+        threaded = pynbody.sph.to_3d_grid(gas, threaded=2, slab_pixels=slab_pixels, **args)
+        npt.assert_allclose(threaded, single, rtol=1e-2, atol=atol)
+        npt.assert_allclose(threaded, exact, rtol=1e-2, atol=atol)
+        npt.assert_allclose(threaded.sum(), exact.sum(), rtol=1e-3)
+        assert not np.array_equal(threaded, exact)
+
+
+def test_slab_assignment_is_complete(gas):
+    x, sm = (np.asarray(gas[k], dtype=np.float64) for k in ('x', 'smooth'))
+    particles, boundaries = pynbody.sph._assign_particles_to_slabs(x, 2 * sm, -20., 20., 50, 8, [-100., 0., 100.])
+    assert len(boundaries) == 8
+    for slab in range(7):
+        in_slab = particles[boundaries[slab]:boundaries[slab + 1]]
+        assert np.all(np.diff(in_slab) > 0)
+        lo, hi = -20. + slab * 6.4, -20. + min(slab * 6.4 + 6.4, 40.)
+        reaching = np.where((x + 2 * sm > lo) & (x - 2 * sm < hi))[0]
+        assert np.all(np.isin(reaching, in_slab))
+
+
+def test_render_frames(gas, tmp_path):
+    del gas.properties['boxsize']  # frames are not periodically wrapped
+    angles = np.linspace(0, np.pi, 4)
+    rotations = [np.array([[np.cos(a), 0, np.sin(a)], [0, 1, 0], [-np.sin(a), 0, np.cos(a)]]) for a in angles]
+
+    filename = str(tmp_path / "frames.npy")
+    frames = pynbody.sph.render_frames(gas, rotations, x2=20., nx=60, threaded=3, out_file=filename)
+    assert frames.shape == (4, 60, 60)
+    npt.assert_array_equal(pynbody.sph.render_frames(gas, rotations, x2=20., nx=60, threaded=False), frames)
+    npt.assert_array_equal(np.load(filename), frames)
+
+    pos = gas['pos'].copy()
+    for rotation, frame in zip(rotations, frames):
+        gas['pos'] = np.dot(pos, rotation.T)
+        im = pynbody.sph.render_image(gas, x2=20., nx=60, threaded=False, approximate_fast=False, denoise=False)
+        assert frame.units == im.units
+        npt.assert_allclose(frame, im, atol=1.e-5 * im.max())
+
+    frames = pynbody.sph.render_frames(gas, x2=20., nx=60, z_camera=[50., 80.])
+    im = pynbody.sph.render_image(gas, x2=20., nx=60, z_camera=80., threaded=False, approximate_fast=False,
+                                  denoise=False)
+    npt.assert_allclose(frames[1], im, atol=1.e-5 * im.max())
+
+
+@pytest.mark.parametrize("threaded", [False, 3])
+@pytest.mark.parametrize("denoise", [False, True])
+def test_multi_quantity_render(gas, threaded, denoise):
+    gas['temp'] = np.random.default_rng(2).uniform(1.e4, 1.e5, len(gas))
+    gas['temp'].units = 'K'
+    args = dict(x2=30., nx=90, threaded=threaded, denoise=denoise)
+    images = pynbody.sph.render_image(gas, qty=['rho', 'temp'], **args)
+    assert images.shape == (2, 90, 90)
+    for qty, image in zip(['rho', 'temp'], images):
+        # the quantities have different units, so none are attached to the combined array
+        npt.assert_array_equal(np.asarray(image), np.asarray(pynbody.sph.render_image(gas, qty=qty, **args)))
+
+    images = pynbody.sph.render_image(gas, qty=['rho', 'rho'], out_units=['Msol kpc^-3', 'g cm^-3'], **args)
+    assert images.units == pynbody.units.NoUnit()
+    npt.assert_allclose(np.asarray(images[1]), np.asarray(images[0]) * pynbody.units.Unit("Msol kpc^-3").ratio("g cm^-3"), rtol=1.e-6)
@@ -1,6 +1,7 @@
 import pynbody
 import numpy as np
 import numpy.testing as npt
+import pytest
 
 np.random.seed(1)
 
@@ -88,4 +89,222 @@ def test_write_profile():
     npt.assert_allclose(read_profile.max, p.max)
     npt.assert_allclose(read_profile.nbins, p.nbins)
     npt.assert_allclose(read_profile['rbins'], p['rbins'])
-    npt.assert_allclose(read_profile['density'], p['density'])
\ No newline at end of file
+    npt.assert_allclose(read_profile['density'], p['density'])
+
+@pytest.fixture
+def random_snap():
+    rng = np.random.default_rng(2)
+    f = pynbody.new(3000)
+    f['pos'] = rng.normal(size=(3000, 3))
+    f['pos'].units = 'kpc'
+    f['vel'] = rng.normal(size=(3000, 3))
+    f['vel'].units = 'km s^-1'
+    f['mass'] = rng.uniform(0.5, 1.5, size=3000)
+    f['mass'].units = 'Msol'
+    f['temp'] = rng.lognormal(size=3000)
+    f['temp'].units = 'K'
+    return f
+
+
+def test_vectorized_profile_matches_per_bin_loop(random_snap):
+    f = random_snap
+
+    p = pynbody.analysis.profile.Profile(f, ndim=3, nbins=20, rmin=0.1, rmax=3.0)
+
+    mean = np.zeros(p.nbins)
+    disp = np.zeros(p.nbins)
+    rms = np.zeros(p.nbins)
+    med = np.zeros(p.nbins)
+    for i in range(p.nbins):
+        t = f['temp'][p.binind[i]].view(np.ndarray)
+        m = f['mass'][p.binind[i]].view(np.ndarray)
+        mean[i] = (t * m).sum() / m.sum()
+        disp[i] = np.sqrt((t ** 2 * m).sum() / m.sum() - mean[i] ** 2)
+        rms[i] = np.sqrt((t ** 2 * m).sum() / m.sum())
+        med[i] = sorted(t)[len(t) // 2]
+
+    npt.assert_allclose(p['mass'], [f['mass'][b].sum() for b in p.binind])
+    npt.assert_allclose(p['temp'], mean)
+    npt.assert_allclose(p['temp_disp'], disp)
+    npt.assert_allclose(p['temp_rms'], rms)
+    npt.assert_array_equal(p['temp_med'], med)
+    assert p['temp'].units == 'K'
+
+
+def test_profile_empty_bins():
+    f = pynbody.new(10)
+    f['pos'] = np.zeros((10, 3))
+    f['x'] = np.linspace(1.0, 1.4, 10)
+    f['mass'] = 1.0
+    f['temp'] = np.arange(10.0)
+
+    p = pynbody.analysis.profile.Profile(f, nbins=4, rmin=0.5, rmax=2.5)
+    assert (p['n'] == [0, 10, 0, 0]).all()
+    assert np.isnan(p['temp'][0]) and np.isnan(p['temp_med'][0])
+    assert p['temp_med'][1] == 5.0
+
+
+def test_batched_profiles_match_individual(random_snap):
+    f = random_snap
+
+    names = ['temp', 'vr_disp', 'temp_rms', 'vz', 'temp_med', 'density', 'vz_disp']
+    reference = pynbody.analysis.profile.Profile(f, ndim=3, nbins=30)
+    expected = [reference[n] for n in names]
+
+    p = pynbody.analysis.profile.Profile(f, ndim=3, nbins=30)
+    # use a small chunk size to make sure bins straddling chunks are correctly accumulated
+    results = p.compute(names, chunk_size=97)
+
+    for name, r, e in zip(names, results, expected):
+        npt.assert_allclose(r, e, atol=1e-7, err_msg=name)
+        assert r.units == e.units
+        assert p[name] is r
+
+
+def test_compact_profile(random_snap):
+    f = random_snap
+
+    p = pynbody.analysis.profile.Profile(f, nbins=25, rmin=0.05, rmax=2.5)
+    p_compact = pynbody.analysis.profile.Profile(f, nbins=25, rmin=0.05, rmax=2.5, compact=True)
+
+    assert p_compact.partbin is None
+    assert len(p_compact.binind) == p.nbins
+    partbin = np.digitize(p._x, p['bin_edges'])
+    for i, ind in enumerate(p_compact.binind):
+        npt.assert_array_equal(ind, np.where(partbin == i + 1)[0])
+
+    for name in ['mass', 'density', 'temp', 'temp_disp', 'temp_rms', 'temp_med']:
+        npt.assert_allclose(p_compact[name], p[name], atol=1e-7, err_msg=name)
+    npt.assert_allclose(p_compact.compute(['temp_disp'])[0], p['temp_disp'], atol=1e-7)
+
+
+def test_streaming_profile(random_snap):
+    f = random_snap
+
+    p = pynbody.analysis.profile.Profile(f, ndim=3, type='log', nbins=15, rmin=0.1, rmax=3.0)
+    ps = pynbody.analysis.profile.StreamingProfile(
+        pynbody.analysis.profile.iterate_chunks(f, 333), ['temp'], ndim=3, type='log', nbins=15,
+        rmin=0.1, rmax=3.0, medians=True, sketch_size=50)
+
+    npt.assert_array_equal(ps['n'], p['n'])
+    npt.assert_allclose(ps['bin_edges'], p['bin_edges'])
+    for name in ['mass', 'density', 'mass_enc', 'temp', 'temp_disp', 'temp_rms']:
+        npt.assert_allclose(ps[name], p[name], atol=1e-7, err_msg=name)
+        assert ps[name].units == p[name].units
+
+    # medians are approximate, with rank errors of order 1/sketch_size
+    for i, ind in enumerate(p.binind):
+        if len(ind) < 50:
+            # bins smaller than the sketch are summarised exactly
+            npt.assert_equal(ps['temp_med'][i], p['temp_med'][i])
+        else:
+            t = np.sort(f['temp'][ind])
+            rank = np.searchsorted(t, ps['temp_med'][i]) / len(t)
+            assert abs(rank - 0.5) < 0.05
+
+    # the median of an even number of values follows Profile's convention
+    g = pynbody.new(4)
+    g['pos'] = np.array([[0.6, 0, 0], [0.7, 0, 0], [0.8, 0, 0], [0.9, 0, 0]])
+    g['temp'] = np.array([4., 2., 3., 1.])
+    args = dict(ndim=3, type='lin', nbins=2, rmin=0.5, rmax=2.0)
+    ps_even = pynbody.analysis.profile.StreamingProfile([g], ['temp'], medians=True, **args)
+    assert ps_even['temp_med'][0] == pynbody.analysis.profile.Profile(g, **args)['temp_med'][0] == 3.
+
+    with pytest.raises(KeyError):
+        ps['vx']
+
+    with pytest.raises(ValueError):
+        pynbody.analysis.profile.StreamingProfile([f], ['temp'], nbins=15)
+
+
+def _reference_quantiles(values, weights, quantiles):
+    # straightforward per-bin implementation of the QuantileProfile definitions
+    order = np.argsort(values, kind='stable')
+    sorted_values = values[order]
+    result = []
+    for q in quantiles:
+        if weights is None:
+            topind = len(values) - 1
+            ilow = int(np.floor(q * topind))
+            inc = q * topind - ilow
+            hival = sorted_values[min(ilow + 1, topind)]
+            result.append(sorted_values[ilow] + inc * (hival - sorted_values[ilow]))
+        else:
+            cumw = np.cumsum(weights[order]) / np.sum(weights)
+            imin = min(np.arange(len(values)), key=lambda x: abs(cumw[x] - q))
+            inc = q - cumw[imin]
+            if inc > 0:
+                nextval = sorted_values[imin + 1]
+            elif imin == 0:
+                nextval = sorted_values[imin]
+            else:
+                nextval = sorted_values[imin - 1]
+            result.append(sorted_values[imin] + inc * (nextval - sorted_values[imin]))
+    return result
+
+
+@pytest.mark.parametrize("weighted", [False, True])
+def test_quantile_profile(random_snap, weighted):
+    f = random_snap
+
+    weights = f['mass'] if weighted else None
+    p = pynbody.analysis.profile.QuantileProfile(f, q=(0.1, 0.5, 0.9), weights=weights, nbins=20, rmax=3.0)
+    result = p['temp']
+    assert result.shape == (20, 3)
+
+    for i, ind in enumerate(p.binind):
+        if len(ind) == 0:
+            assert np.isnan(result[i]).all()
+            assert np.isnan(p['rbins'][i])
+        else:
+            w = None if weights is None else np.asarray(weights)[ind]
+            expected = _reference_quantiles(np.asarray(f['temp'])[ind], w, p.quantiles)
+            npt.assert_allclose(result[i], expected)
+
+    p_approx = pynbody.analysis.profile.QuantileProfile(f, q=(0.1, 0.5, 0.9), weights=weights, nbins=20,
+                                                        rmax=3.0, approximate=True, sketch_size=20)
+    nonempty = p['n'] > 200
+    npt.assert_allclose(p_approx['temp'][nonempty], result[nonempty], rtol=0.2)
+
+
+def test_profile_cache(random_snap, tmp_path):
+    f = random_snap
+
+    cache = pynbody.analysis.profile.ProfileCache(str(tmp_path))
+    p = pynbody.analysis.profile.Profile(f, nbins=10, cache=cache)
+    temp_disp = p['temp_disp']
+    density = p['density']
+    vz = p['vz']
+    d_temp = p['d_temp']
+    assert len(list(tmp_path.iterdir())) > 0
+
+    p2 = pynbody.analysis.profile.Profile(f, nbins=10, cache=str(tmp_path))
+    p2._auto_profile = None  # would fail if anything were recomputed
+    npt.assert_array_equal(p2['temp_disp'], temp_disp)
+    npt.assert_array_equal(p2['density'], density)
+    assert p2['temp_disp'].units == temp_disp.units
+    assert p2['temp_disp'].sim is f
+
+    npt.assert_array_equal(p2['d_temp'], d_temp)
+
+    # changing the array invalidates profiles derived from it, including derivatives
+    f['temp'] *= 2
+    p3 = pynbody.analysis.profile.Profile(f, nbins=10, cache=cache)
+    npt.assert_allclose(p3['temp_disp'], 2 * temp_disp)
+    assert p3._cache_key('d_temp') not in cache
+    npt.assert_allclose(p3['d_temp'], 2 * d_temp)
+
+    # profiles with unknown inputs are never cached
+    assert p3._cache_key('magnitudes') is None
+
+    # rotating the snapshot invalidates all profiles
+    f.rotate_x(90)
+    p4 = pynbody.analysis.profile.Profile(f, nbins=10, cache=cache)
+    assert not np.allclose(p4['vz'], vz)
+
+    # least-recently-used entries are evicted once the cache is too large
+    small_cache = pynbody.analysis.profile.ProfileCache(str(tmp_path), max_size=cache.size() // 2)
+    small_cache.evict()
+    assert 0 < small_cache.size() <= small_cache.max_size
+    small_cache.clear()
+    assert small_cache.size() == 0